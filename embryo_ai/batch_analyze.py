@@ -0,0 +1,447 @@
+"""
+Offline Batch Analysis
+
+Runs archived images and time-lapses (videos, zip / TIFF exports, frame
+folders) through the same models as the API, without HTTP:
+
+  - inputs from a directory walk or a manifest (.txt paths, .csv / .jsonl with
+    a `path` column and optional patient_id / cycle_id / embryo_id)
+  - models are loaded once in the parent and shared copy-on-write by a fork
+    process pool; each worker decodes a chunk of inputs, gates all of them in
+    one CLIP forward and runs one batched model forward per chunk
+  - every finished input is appended to checkpoint.jsonl, so a killed run
+    resumes where it stopped
+  - results.parquet (and frame_logits.parquet with --logits) plus a
+    throughput summary are written at the end
+
+Usage:
+    python batch_analyze.py /archive/videos --output runs/study1 --workers 4
+    python batch_analyze.py manifest.csv --output runs/study1 --logits
+"""
+
+import argparse
+import csv
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import sys
+import time
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+if CURRENT_DIR not in sys.path:
+    sys.path.append(CURRENT_DIR)
+
+import numpy as np
+
+from sequence_ingest import IMAGE_EXTS, open_sequence
+from image_decode import read_image
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    HAS_ARROW = True
+except ImportError:
+    HAS_ARROW = False
+
+VIDEO_EXTS = (".mp4", ".avi", ".mkv", ".mov", ".webm")
+TIMELAPSE_EXTS = VIDEO_EXTS + (".zip",)
+# fsync the checkpoint at least this often (rows / seconds)
+CHECKPOINT_SYNC_ROWS = 50
+CHECKPOINT_SYNC_SECONDS = 5.0
+
+RESULT_COLUMNS = ["item_id", "path", "patient_id", "cycle_id", "embryo_id", "kind", "analysis_type", "status",
+                  "error", "gate_score", "stage", "stage_confidence", "expansion", "icm", "te",
+                  "grade_confidence", "viability_score", "milestones", "frames", "decode_seconds",
+                  "infer_seconds", "worker_pid"]
+
+# Set in the parent before the pool forks; shared copy-on-write by the workers
+_engine = None
+_options = None
+
+
+# ---- inputs -----------------------------------------------------------------
+
+def _item_id(path):
+    """Stable id of an input: path + size + mtime (no need to hash archived videos)."""
+    st = os.stat(path)
+    return hashlib.sha1(f"{os.path.abspath(path)}|{st.st_size}|{int(st.st_mtime)}".encode()).hexdigest()[:20]
+
+
+def _classify(path):
+    """'timelapse' or 'image' (TIFFs are inspected: multi-page stacks are time-lapses)."""
+    lower = path.lower()
+    if os.path.isdir(path) or lower.endswith(TIMELAPSE_EXTS):
+        return "timelapse"
+    if lower.endswith((".tif", ".tiff")):
+        source = open_sequence(path)
+        if source is not None:
+            source.release()
+            return "timelapse"
+    return "image"
+
+
+def read_manifest(path):
+    """Yields item dicts ({'path', optional ids}) from a directory or a manifest file."""
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(IMAGE_EXTS + TIMELAPSE_EXTS) and not name.startswith("."):
+                    yield {"path": os.path.join(root, name)}
+        return
+
+    base = os.path.dirname(os.path.abspath(path))
+    if path.lower().endswith(".csv"):
+        with open(path, newline="") as f:
+            rows = list(csv.DictReader(f))
+    elif path.lower().endswith((".jsonl", ".ndjson")):
+        with open(path) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    else:
+        with open(path) as f:
+            rows = [{"path": line.strip()} for line in f if line.strip() and not line.startswith("#")]
+
+    for row in rows:
+        item = {k: (str(v) if v is not None else None) for k, v in row.items()
+                if k in ("path", "patient_id", "cycle_id", "embryo_id", "analysis_type")}
+        item["path"] = os.path.join(base, item["path"]) if not os.path.isabs(item["path"]) else item["path"]
+        yield item
+
+
+def load_checkpoint(path, retry_errors=False):
+    """item_id -> row for every input already finished (a torn last line is ignored)."""
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue
+            if retry_errors and row.get("status") == "error":
+                done.pop(row["item_id"], None)
+                continue
+            done[row["item_id"]] = row
+    return done
+
+
+# ---- workers ----------------------------------------------------------------
+
+def _init_worker(threads):
+    import torch
+    torch.set_num_threads(threads)
+
+
+def _base_row(item, kind, analysis_type):
+    return {"item_id": item["item_id"], "path": item["path"], "patient_id": item.get("patient_id"),
+            "cycle_id": item.get("cycle_id"), "embryo_id": item.get("embryo_id"), "kind": kind,
+            "analysis_type": analysis_type, "status": "ok", "error": None, "worker_pid": os.getpid()}
+
+
+def _gate(rows, frame_lists):
+    """Gates every input of a chunk in one batched CLIP forward; marks rejected rows."""
+    from embryo_gate import score_embryo_frames, aggregate_frame_scores
+    flat = [f for frames in frame_lists for f in frames]
+    if not flat:
+        return
+    scores, reasons = score_embryo_frames(flat)
+    pos = 0
+    for row, frames in zip(rows, frame_lists):
+        s, r = scores[pos:pos + len(frames)], reasons[pos:pos + len(frames)]
+        pos += len(frames)
+        is_valid, reason, confidence = aggregate_frame_scores(s, r)
+        row["gate_score"] = round(float(confidence if is_valid else 1.0 - confidence), 4)
+        if not is_valid:
+            row["status"], row["error"] = "rejected", reason
+
+
+def _stage_fields(row, pred_row):
+    """Stage + confidence from per-frame staging logits (T x classes), last frame decides."""
+    import torch
+    last = pred_row[-1]
+    stage_idx = int(torch.argmax(last))
+    row["stage"] = _engine.get_label_name(stage_idx)
+    row["stage_confidence"] = round(float(torch.softmax(last, dim=0)[stage_idx]), 4)
+    return stage_idx, row["stage_confidence"]
+
+
+def _finish(row, stage_idx, confidence, gardner, milestones=None):
+    row["expansion"], row["icm"], row["te"] = gardner.get("expansion"), gardner.get("icm"), gardner.get("te")
+    row["grade_confidence"] = gardner.get("grade_confidence")
+    concordance = _engine._generate_concordance(stage_idx, confidence, gardner, "Day 5", row["analysis_type"])
+    row["viability_score"] = concordance.get("viability_score")
+    row["milestones"] = json.dumps(milestones) if milestones else None
+
+
+def _save_logits(item_id, **arrays):
+    np.savez_compressed(os.path.join(_options["logits_dir"], f"{item_id}.npz"),
+                        **{k: v.float().numpy() for k, v in arrays.items()})
+
+
+def _process_images(items):
+    import torch
+    rows, frames = [], []
+    start = time.perf_counter()
+    for item in items:
+        row = _base_row(item, "image", "gardner")
+        try:
+            # Large stills are decoded near model resolution
+            frame = read_image(item["path"], _engine.img_size)
+        except OSError:
+            frame = None
+        if frame is None:
+            row["status"], row["error"] = "error", "Unreadable image"
+        rows.append(row)
+        frames.append(frame)
+    decode_seconds = (time.perf_counter() - start) / max(1, len(items))
+
+    live = [i for i, f in enumerate(frames) if f is not None]
+    if _options["gate"]:
+        _gate([rows[i] for i in live], [[frames[i]] for i in live])
+    live = [i for i in live if rows[i]["status"] == "ok"]
+    if live:
+        start = time.perf_counter()
+        batch = torch.stack([_engine._preprocess_frame(frames[i]) for i in live])
+        grades, outputs = _engine.grade_batch(batch, return_outputs=True)
+        # Staging on N one-frame sequences: N x T(1) x P(1) x C x H x W, one forward
+        pred = _engine._run_staging(batch.unsqueeze(1).unsqueeze(2)) if _engine.model is not None else None
+        infer_seconds = (time.perf_counter() - start) / len(live)
+        for n, i in enumerate(live):
+            row = rows[i]
+            stage_idx, confidence = _stage_fields(row, pred[n]) if pred is not None else (13, 0.0)
+            _finish(row, stage_idx, confidence, grades[n])
+            row["frames"], row["infer_seconds"] = 1, round(infer_seconds, 4)
+            if _options["logits"]:
+                arrays = {f"gardner_{k}": v[n:n + 1] for k, v in outputs.items()} if outputs is not None else {}
+                if pred is not None:
+                    arrays["staging"] = pred[n]
+                _save_logits(row["item_id"], **arrays)
+    for row in rows:
+        row["decode_seconds"] = round(decode_seconds, 4)
+    return rows
+
+
+def _process_timelapses(items):
+    import torch
+    from embryo_gate import VIDEO_GATE_FRAMES
+    rows, tensors, gate_frames = [], [], []
+    for item in items:
+        analysis_type = item.get("analysis_type") or _options["analysis"]
+        analysis_type = "morphokinetics" if analysis_type == "auto" else analysis_type
+        row = _base_row(item, "timelapse", analysis_type)
+        start = time.perf_counter()
+        try:
+            tensor, frames = _engine.load_input(item["path"], keep_frames=VIDEO_GATE_FRAMES)
+        except Exception as e:
+            tensor, frames = None, []
+            row["error"] = f"Decode failed: {e}"
+        row["decode_seconds"] = round(time.perf_counter() - start, 4)
+        if tensor is None:
+            row["status"], row["error"] = "error", row["error"] or "No frames extracted"
+        elif tensor.shape[1] < 2 and analysis_type == "morphokinetics":
+            row["status"], row["error"] = "error", "Single-frame input"
+        rows.append(row)
+        tensors.append(tensor)
+        gate_frames.append(frames)
+
+    live = [i for i, t in enumerate(tensors) if rows[i]["status"] == "ok"]
+    if _options["gate"]:
+        _gate([rows[i] for i in live], [gate_frames[i] for i in live])
+        live = [i for i in live if rows[i]["status"] == "ok"]
+    del gate_frames
+
+    # All time-lapses of the chunk share one staging pass, whatever their lengths
+    works = []
+    for i in live:
+        t = tensors[i]
+        works.append(t.unsqueeze(2) if t.dim() == 5 else t)
+    preds = [None] * len(live)
+    infer_seconds = 0.0
+    if live and _engine.model is not None:
+        start = time.perf_counter()
+        preds = [p[0] for p in _engine.sequence_batcher.run_batch(works)]
+        infer_seconds = (time.perf_counter() - start) / len(live)
+    for i, work, pred in zip(live, works, preds):
+        row = rows[i]
+        stage_idx, confidence = _stage_fields(row, pred) if pred is not None else (13, 0.0)
+        start = time.perf_counter()
+        if row["analysis_type"] == "gardner":
+            gardner, milestones = _engine._derive_gardner_video(tensors[i]), None
+        else:
+            # The last-frame stage is already known: no second staging forward
+            gardner = {"expansion": "--", "icm": "--", "te": "--"}
+            milestones = _engine._derive_milestones(stage_idx, is_video=True, input_data=None)
+        _finish(row, stage_idx, confidence, gardner, milestones)
+        row["frames"] = int(work.shape[1])
+        row["infer_seconds"] = round(infer_seconds + time.perf_counter() - start, 4)
+        if _options["logits"] and pred is not None:
+            _save_logits(row["item_id"], staging=pred)
+    return rows
+
+
+def _process_chunk(task):
+    kind, items = task
+    try:
+        return _process_images(items) if kind == "image" else _process_timelapses(items)
+    except Exception as e:
+        # A failed batched forward fails the chunk; the items are retried with --retry-errors
+        return [dict(_base_row(item, kind, item.get("analysis_type") or _options["analysis"]),
+                     status="error", error=f"Chunk failed: {e}") for item in items]
+
+
+# ---- output -----------------------------------------------------------------
+
+def write_parquet(rows, output_dir, logits=False):
+    """Writes results.parquet (and frame_logits.parquet) from the checkpoint rows."""
+    if not HAS_ARROW:
+        print("⚠️ pyarrow not installed: results are only in checkpoint.jsonl (pip install pyarrow)")
+        return None
+    table = pa.Table.from_pylist([{c: row.get(c) for c in RESULT_COLUMNS} for row in rows])
+    results_path = os.path.join(output_dir, "results.parquet")
+    pq.write_table(table, results_path, compression="zstd")
+
+    if logits:
+        logits_dir = os.path.join(output_dir, "logits")
+        writer = None
+        for row in rows:
+            path = os.path.join(logits_dir, f"{row['item_id']}.npz")
+            if not os.path.exists(path):
+                continue
+            columns = {"item_id": [], "head": [], "frame": [], "logits": []}
+            with np.load(path) as arrays:
+                for head in arrays.files:
+                    values = arrays[head]
+                    for frame, vec in enumerate(values):
+                        columns["item_id"].append(row["item_id"])
+                        columns["head"].append(head)
+                        columns["frame"].append(frame)
+                        columns["logits"].append(vec.tolist())
+            part = pa.Table.from_pydict(columns, schema=pa.schema([
+                ("item_id", pa.string()), ("head", pa.string()), ("frame", pa.int32()),
+                ("logits", pa.list_(pa.float32()))]))
+            if writer is None:
+                writer = pq.ParquetWriter(os.path.join(output_dir, "frame_logits.parquet"), part.schema,
+                                          compression="zstd")
+            writer.write_table(part)
+        if writer is not None:
+            writer.close()
+    return results_path
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EMprion offline batch analysis")
+    parser.add_argument("input", help="directory to walk, or a manifest (.txt / .csv / .jsonl)")
+    parser.add_argument("--output", required=True, help="run directory (checkpoint, parquet, summary)")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument("--threads", type=int, default=0, help="torch threads per worker (0 = cores / workers)")
+    parser.add_argument("--image-batch", type=int, default=32, help="images per batched forward")
+    parser.add_argument("--video-batch", type=int, default=4, help="time-lapses per worker task")
+    parser.add_argument("--analysis", choices=("auto", "gardner", "morphokinetics"), default="auto",
+                        help="time-lapse analysis (images are always Gardner-graded)")
+    parser.add_argument("--logits", action="store_true", help="also write per-frame logits")
+    parser.add_argument("--no-gate", action="store_true", help="skip the CLIP embryo gate (curated archives only)")
+    parser.add_argument("--retry-errors", action="store_true", help="re-run inputs that failed previously")
+    args = parser.parse_args()
+
+    os.makedirs(args.output, exist_ok=True)
+    checkpoint_path = os.path.join(args.output, "checkpoint.jsonl")
+    logits_dir = os.path.join(args.output, "logits")
+    if args.logits:
+        os.makedirs(logits_dir, exist_ok=True)
+
+    done = load_checkpoint(checkpoint_path, retry_errors=args.retry_errors)
+    items, missing = [], 0
+    for item in read_manifest(args.input):
+        if not os.path.exists(item["path"]):
+            missing += 1
+            continue
+        item["item_id"] = _item_id(item["path"])
+        if item["item_id"] not in done:
+            items.append(item)
+    print(f"📂 {len(items)} inputs to analyse ({len(done)} already in checkpoint, {missing} missing paths)")
+
+    global _engine, _options
+    if items:
+        from inference import EmbryoInference
+        import torch
+        # No intra-op parallel region may run before the pool forks (parity
+        # checks and warm-up forwards would start an OpenMP pool that can
+        # deadlock in the children); workers set their own thread count.
+        torch.set_num_threads(1)
+        # Same model selection as the service
+        temp_engine = EmbryoInference(config_path=None, precision="fp32")
+        _engine = EmbryoInference(config_path=temp_engine._find_best_model(is_video=True))
+        if _engine.is_mock:
+            raise SystemExit("❌ Real model weights are required for batch analysis.")
+        if not args.no_gate:
+            import embryo_gate
+            embryo_gate._load_clip()
+        _options = {"analysis": args.analysis, "logits": args.logits, "gate": not args.no_gate,
+                    "logits_dir": logits_dir}
+
+        by_kind = {"image": [], "timelapse": []}
+        for item in items:
+            by_kind[_classify(item["path"])].append(item)
+        tasks = [("image", c) for c in _chunks(by_kind["image"], args.image_batch)]
+        tasks += [("timelapse", c) for c in _chunks(by_kind["timelapse"], args.video_batch)]
+
+        threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+        start = time.perf_counter()
+        finished, frames, last_sync, unsynced = 0, 0, time.monotonic(), 0
+        with open(checkpoint_path, "a") as checkpoint, \
+                mp.get_context("fork").Pool(args.workers, initializer=_init_worker, initargs=(threads,)) as pool:
+            for rows in pool.imap_unordered(_process_chunk, tasks):
+                for row in rows:
+                    checkpoint.write(json.dumps(row) + "\n")
+                    done[row["item_id"]] = row
+                    frames += row.get("frames") or 0
+                finished += len(rows)
+                unsynced += len(rows)
+                checkpoint.flush()
+                if unsynced >= CHECKPOINT_SYNC_ROWS or time.monotonic() - last_sync >= CHECKPOINT_SYNC_SECONDS:
+                    os.fsync(checkpoint.fileno())
+                    last_sync, unsynced = time.monotonic(), 0
+                elapsed = time.perf_counter() - start
+                print(f"   {finished}/{len(items)} done, {finished / elapsed:.2f} inputs/s, {frames / elapsed:.1f} frames/s")
+            os.fsync(checkpoint.fileno())
+        wall = time.perf_counter() - start
+    else:
+        wall, finished, frames = 0.0, 0, 0
+
+    rows = list(done.values())
+    results_path = write_parquet(rows, args.output, logits=args.logits)
+
+    statuses = {}
+    for row in rows:
+        statuses[row["status"]] = statuses.get(row["status"], 0) + 1
+    ok = [r for r in rows if r["status"] == "ok"]
+    summary = {
+        "inputs_total": len(rows),
+        "inputs_this_run": finished,
+        "missing_paths": missing,
+        "status_counts": statuses,
+        "wall_seconds": round(wall, 2),
+        "inputs_per_second": round(finished / wall, 3) if wall else None,
+        "frames_per_second": round(frames / wall, 2) if wall else None,
+        "mean_decode_seconds": round(float(np.mean([r.get("decode_seconds") or 0 for r in ok])), 4) if ok else None,
+        "mean_infer_seconds": round(float(np.mean([r.get("infer_seconds") or 0 for r in ok])), 4) if ok else None,
+        "workers": args.workers,
+        "results": results_path or checkpoint_path,
+    }
+    with open(os.path.join(args.output, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+
+    print("\n📊 BATCH SUMMARY")
+    for key, value in summary.items():
+        print(f"   {key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
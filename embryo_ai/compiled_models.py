@@ -0,0 +1,145 @@
+"""
+Compiled (TorchScript) Serving Path
+
+Eager dispatch overhead matters for the small ops in the GardnerNet heads and
+the staging model's LSTM time loop. With EMBRYO_COMPILE=on, both models are
+traced, frozen (weights/attributes inlined as constants) and passed through
+torch.jit.optimize_for_inference (conv/bn folding, conv+relu fusion and oneDNN
+layouts on CPU).
+
+The staging model is traced per input shape: images (T=1) and the standard
+video sampling length are compiled and warmed at startup; other shapes fall
+back to eager. Each traced output is checked against eager on the example
+input before it is used.
+
+Frozen modules are cached on disk, keyed by the weights file, torch version,
+CPU capability and input shape, so restarts skip tracing. optimize_for_inference
+is re-applied on load because oneDNN-packed weights can't be serialized.
+"""
+
+import hashlib
+import os
+import time
+
+import torch
+
+import metrics
+from content_cache import cache_path
+
+COMPILE_MODE = os.getenv("EMBRYO_COMPILE", "off").lower()
+# Max abs logit difference between compiled and eager on the example input
+COMPILE_TOLERANCE = float(os.getenv("EMBRYO_COMPILE_TOLERANCE", "1e-3"))
+# Extra staging sequence lengths to compile, e.g. "10,25"
+EXTRA_SHAPES = [int(v) for v in os.getenv("EMBRYO_COMPILE_SHAPES", "").split(",") if v.strip()]
+WARMUP_RUNS = int(os.getenv("EMBRYO_COMPILE_WARMUP", "3"))
+
+
+class _DictToTuple(torch.nn.Module):
+    """Tracing needs tensor / tuple outputs; the models return dicts."""
+
+    def __init__(self, model, keys):
+        super().__init__()
+        self.model = model
+        self.keys = keys
+
+    def forward(self, x):
+        out = self.model(x)
+        return tuple(out[k] for k in self.keys)
+
+
+def _fingerprint(weights_path, name, shape):
+    st = os.stat(weights_path) if weights_path and os.path.exists(weights_path) else None
+    capability = getattr(torch.backends.cpu, "get_cpu_capability", lambda: "unknown")()
+    parts = [name, os.path.abspath(weights_path or ""), str(st.st_size if st else 0),
+             str(int(st.st_mtime) if st else 0), torch.__version__, capability, "x".join(map(str, shape))]
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()[:24]
+
+
+class CompiledModel:
+    """A frozen, optimized TorchScript module for one input shape, called like the eager model."""
+
+    def __init__(self, module, keys, shape, batch_dynamic=False):
+        self.module = module
+        self.keys = keys
+        self.shape = tuple(shape)
+        # Verified on other batch sizes: usable for any N with the same per-item shape
+        self.batch_dynamic = batch_dynamic
+
+    def accepts(self, x):
+        if self.batch_dynamic:
+            return tuple(x.shape[1:]) == self.shape[1:]
+        return tuple(x.shape) == self.shape
+
+    def __call__(self, x):
+        return dict(zip(self.keys, self.module(x)))
+
+
+def _trace_and_freeze(model, keys, example):
+    wrapped = _DictToTuple(model, keys).eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(wrapped, example, check_trace=False)
+    return torch.jit.freeze(traced)
+
+
+def compile_model(model, name, keys, example, weights_path=None, check_inputs=()):
+    """
+    Traced + frozen + optimized version of `model` for example.shape, or None
+    if tracing fails or the compiled outputs don't match eager.
+
+    `check_inputs` (other batch sizes) are verified too; if they all match,
+    the compiled model is marked batch-dynamic, otherwise it only serves
+    example.shape.
+    """
+    shape = tuple(example.shape)
+    path = cache_path("compiled", f"{name}-{_fingerprint(weights_path, name, shape)}.pt")
+    start = time.perf_counter()
+    frozen, source = None, "cache"
+    if os.path.exists(path):
+        try:
+            frozen = torch.jit.load(path, map_location="cpu")
+        except Exception as e:
+            print(f"Compile: ignoring unreadable cache {path}: {e}")
+    if frozen is None:
+        source = "trace"
+        try:
+            frozen = _trace_and_freeze(model, keys, example)
+        except Exception as e:
+            print(f"Compile: tracing {name} {shape} failed, staying eager: {e}")
+            metrics.incr("compile.failed")
+            return None
+        tmp = path + ".tmp"
+        torch.jit.save(frozen, tmp)
+        os.replace(tmp, path)
+
+    optimized = torch.jit.optimize_for_inference(frozen)
+    compiled = CompiledModel(optimized, keys, shape)
+
+    def max_diff(x):
+        eager, traced = model(x), compiled(x)
+        return max(float((eager[k].float() - traced[k].float()).abs().max()) for k in keys)
+
+    try:
+        with torch.no_grad():
+            # Warm-up runs let the profiling executor specialize before real traffic
+            for _ in range(max(1, WARMUP_RUNS)):
+                compiled(example)
+            diff = max_diff(example)
+    except Exception as e:
+        print(f"Compile: {name} {shape} failed verification, staying eager: {e}")
+        metrics.incr("compile.parity_failed")
+        return None
+    elapsed = time.perf_counter() - start
+    if diff > COMPILE_TOLERANCE:
+        print(f"Compile: {name} {shape} differs from eager (max |diff| {diff:.2e}), staying eager")
+        metrics.incr("compile.parity_failed")
+        return None
+
+    if check_inputs:
+        try:
+            with torch.no_grad():
+                compiled.batch_dynamic = all(max_diff(x) <= COMPILE_TOLERANCE for x in check_inputs)
+        except Exception:
+            compiled.batch_dynamic = False
+    metrics.observe(f"compile.{source}.seconds", elapsed)
+    print(f"Compile: {name} {shape} ready from {source} in {elapsed:.1f}s (max |diff| vs eager {diff:.1e})")
+    return compiled
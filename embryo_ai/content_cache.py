@@ -0,0 +1,31 @@
+"""
+Content-Addressed Cache Helpers
+
+Shared location and hashing for artifacts that are keyed by the content of an
+upload (keyframe indexes, compiled models, heatmaps, media proxies...).
+"""
+
+import hashlib
+import os
+
+CACHE_DIR = os.getenv("EMBRYO_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "embryo_ai"))
+
+
+def cache_path(*parts) -> str:
+    """Path inside the cache directory; parent directories are created."""
+    path = os.path.join(CACHE_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def sha256_bytes(data) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def sha256_file(path, chunk_size=1 << 20) -> str:
+    """Streaming SHA-256 of a file (constant memory)."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
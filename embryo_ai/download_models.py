@@ -4,14 +4,33 @@ Model Weights Download Script
 This script downloads the required AI model weights from external storage.
 Run this after cloning the repository.
 
+Downloads are:
+  - parallel: large files are fetched as concurrent HTTP range requests
+  - resumable: progress is kept in <file>.part + <file>.part.json, so an
+    interrupted download continues where it stopped
+  - verified: SHA-256 is checked against the manifest (models.sha256.json,
+    or --manifest) before the file is atomically renamed into place
+  - mirror-aware: a local / NFS directory or file:// / http:// mirror
+    (EMBRYO_MODEL_MIRROR or --mirror) is tried before the public URL, so new
+    inference nodes come up from a LAN cache
+
 Usage:
     python download_models.py
+    python download_models.py --mirror /mnt/models --workers 8
+    python download_models.py --verify-only
+    python download_models.py --write-manifest   # record hashes of the local files
 """
 
+import argparse
+import hashlib
+import json
 import os
 import sys
+import threading
+import time
+import urllib.parse
 import urllib.request
-import hashlib
+from concurrent.futures import ThreadPoolExecutor
 
 # Configuration
 BASE_URL = "https://huggingface.co/vikramsona02/EMprion-models/resolve/main"
@@ -29,106 +48,390 @@ MODEL_URLS = {
 }
 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+# {name: {"sha256": ..., "size": bytes}}; written with --write-manifest from known-good files
+MANIFEST_PATH = os.getenv("EMBRYO_MODEL_MANIFEST", os.path.join(CURRENT_DIR, "models.sha256.json"))
+MIRROR = os.getenv("EMBRYO_MODEL_MIRROR", "")
+WORKERS = int(os.getenv("EMBRYO_DOWNLOAD_WORKERS", "4"))
+CHUNK_BYTES = int(os.getenv("EMBRYO_DOWNLOAD_CHUNK_MB", "8")) * 1024 * 1024
+RETRIES = 3
+TIMEOUT = 60
+
+
+class DownloadError(Exception):
+    pass
+
+
+def load_manifest(path=None):
+    path = path or MANIFEST_PATH
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def sha256_of(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(block)
+    return h.hexdigest()
 
 
-def check_existing_models():
-    """Check which models are already downloaded."""
+def verify_file(name, path, manifest):
+    """
+    (ok, reason) for a local weights file.
+
+    With a manifest entry the size and SHA-256 must match; without one, only
+    files clearly smaller than the expected size (partial downloads) fail.
+    """
+    if not os.path.exists(path):
+        return False, "missing"
+    size = os.path.getsize(path)
+    entry = manifest.get(name)
+    if entry:
+        if entry.get("size") is not None and size != entry["size"]:
+            return False, f"size {size} != {entry['size']}"
+        if entry.get("sha256") and sha256_of(path) != entry["sha256"]:
+            return False, "SHA-256 mismatch"
+        return True, "verified"
+    expected = MODEL_URLS.get(name, {}).get("size_mb")
+    if expected and size < expected * 1024 * 1024 * 0.95:
+        return False, f"partial ({size / (1024 * 1024):.1f} of ~{expected} MB)"
+    return True, "present (no manifest hash)"
+
+
+def check_existing_models(manifest=None):
+    """Check which models are already downloaded (and intact)."""
+    manifest = load_manifest() if manifest is None else manifest
     existing = []
     missing = []
-    
-    for name, info in MODEL_URLS.items():
-        path = os.path.join(CURRENT_DIR, name)
-        if os.path.exists(path):
+
+    for name in MODEL_URLS:
+        ok, _ = verify_file(name, os.path.join(CURRENT_DIR, name), manifest)
+        if ok:
             existing.append(name)
         else:
             missing.append(name)
-    
+
     return existing, missing
 
 
-def download_file(url: str, dest_path: str, description: str, token: str = None):
-    """Download a file with progress indicator."""
+# ---- progress ----------------------------------------------------------------
+
+class _Progress:
+    def __init__(self, total, done=0):
+        self.total, self.done = total, done
+        self.start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add(self, n):
+        with self._lock:
+            self.done += n
+            rate = self.done / max(time.perf_counter() - self.start, 1e-6) / (1024 * 1024)
+            if self.total > 0:
+                percent = min(100, self.done * 100 // self.total)
+                bar = '█' * (percent // 2) + '░' * (50 - percent // 2)
+                sys.stdout.write(f'\r   [{bar}] {percent}% {rate:.1f} MB/s')
+            else:
+                sys.stdout.write(f'\r   Downloaded {self.done / (1024*1024):.1f} MB')
+            sys.stdout.flush()
+
+
+# ---- sources -----------------------------------------------------------------
+
+def _local_path(source):
+    if source.startswith("file://"):
+        return urllib.request.url2pathname(urllib.parse.urlparse(source).path)
+    if "://" not in source:
+        return source
+    return None
+
+
+def _copy_local(src, part_path):
+    """Copies a mirror file into the .part file (resuming an earlier partial copy)."""
+    total = os.path.getsize(src)
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset > total:
+        offset = 0
+    progress = _Progress(total, offset)
+    with open(src, "rb") as fin, open(part_path, "r+b" if offset else "wb") as fout:
+        fin.seek(offset)
+        fout.seek(offset)
+        while True:
+            block = fin.read(CHUNK_BYTES)
+            if not block:
+                break
+            fout.write(block)
+            progress.add(len(block))
+        fout.truncate(total)
+
+
+def _open_url(url, headers, range_header=None):
+    request = urllib.request.Request(url, headers=dict(headers, **({"Range": range_header} if range_header else {})))
+    return urllib.request.urlopen(request, timeout=TIMEOUT)
+
+
+def _probe(url, headers):
+    """(final URL after redirects, total size or -1, supports ranges, validator)."""
+    with _open_url(url, headers, "bytes=0-0") as response:
+        final_url = response.geturl()
+        validator = response.headers.get("ETag") or response.headers.get("Last-Modified") or ""
+        content_range = response.headers.get("Content-Range", "")
+        if response.status == 206 and "/" in content_range and not content_range.endswith("/*"):
+            return final_url, int(content_range.rsplit("/", 1)[1]), True, validator
+        return final_url, int(response.headers.get("Content-Length", -1)), False, validator
+
+
+def _load_state(state_path, url_key, total, validator):
+    if os.path.exists(state_path):
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+            if (state.get("url") == url_key and state.get("size") == total
+                    and state.get("validator") == validator and state.get("chunk") == CHUNK_BYTES):
+                return state
+        except (OSError, ValueError):
+            pass
+    return {"url": url_key, "size": total, "validator": validator, "chunk": CHUNK_BYTES, "done": []}
+
+
+def _save_state(state_path, state):
+    tmp = state_path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, state_path)
+
+
+def _fetch_ranged(url, part_path, state_path, total, validator, headers, workers):
+    """Parallel range requests into a preallocated .part file; completed chunks survive restarts."""
+    state = _load_state(state_path, url.split("?", 1)[0], total, validator)
+    chunks = [(i, i * CHUNK_BYTES, min(total, (i + 1) * CHUNK_BYTES) - 1)
+              for i in range((total + CHUNK_BYTES - 1) // CHUNK_BYTES)]
+    done = set(state["done"]) if os.path.exists(part_path) else set()
+    if not os.path.exists(part_path) or os.path.getsize(part_path) != total:
+        done = set()
+        with open(part_path, "wb") as f:
+            f.truncate(total)
+    todo = [c for c in chunks if c[0] not in done]
+    if done:
+        print(f"   ↩️  Resuming: {len(done)}/{len(chunks)} chunks already downloaded")
+    progress = _Progress(total, sum(end - start + 1 for i, start, end in chunks if i in done))
+    lock = threading.Lock()
+    fd = os.open(part_path, os.O_RDWR)
+
+    def fetch(chunk):
+        index, start, end = chunk
+        for attempt in range(RETRIES):
+            try:
+                with _open_url(url, headers, f"bytes={start}-{end}") as response:
+                    if response.status != 206:
+                        raise DownloadError(f"server ignored range request (HTTP {response.status})")
+                    pos = start
+                    while True:
+                        block = response.read(256 * 1024)
+                        if not block:
+                            break
+                        os.pwrite(fd, block, pos)
+                        pos += len(block)
+                        progress.add(len(block))
+                if pos != end + 1:
+                    raise DownloadError(f"chunk {index} short read ({pos - start} of {end - start + 1} bytes)")
+                with lock:
+                    done.add(index)
+                    state["done"] = sorted(done)
+                    _save_state(state_path, state)
+                return
+            except Exception:
+                if attempt == RETRIES - 1:
+                    raise
+                time.sleep(2 ** attempt)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            for future in [pool.submit(fetch, c) for c in todo]:
+                future.result()
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fetch_stream(url, part_path, headers):
+    """Single-stream fetch for servers without range support."""
+    with _open_url(url, headers) as response, open(part_path, "wb") as out_file:
+        progress = _Progress(int(response.headers.get("Content-Length", -1)))
+        while True:
+            block = response.read(256 * 1024)
+            if not block:
+                break
+            out_file.write(block)
+            progress.add(len(block))
+
+
+def _sources(name, info, mirror):
+    """Where to look for a file, nearest first."""
+    sources = []
+    if mirror:
+        # Mirrors store files under their plain names
+        sources.append(mirror.rstrip("/") + "/" + name if "://" in mirror else os.path.join(mirror, name))
+    sources.append(info["url"])
+    return sources
+
+
+def download_file(url: str, dest_path: str, description: str, token: str = None,
+                  expected_sha256: str = None, workers: int = None):
+    """
+    Downloads `url` (http(s), file:// or a local path) to dest_path.
+
+    Data goes to dest_path + ".part" and is renamed into place only after the
+    SHA-256 (if known) matches, so a crash never leaves a truncated file under
+    the real name.
+    """
     print(f"\n📥 Downloading: {description}")
+    print(f"   Source: {url}")
     print(f"   Destination: {dest_path}")
-    
+
     if url == "CONTACT_MAINTAINER_FOR_ACCESS":
         print("   ❌ URL not configured. Please contact vikram@subhag.in for model access.")
         return False
-    
+
+    part_path = dest_path + ".part"
+    state_path = part_path + ".json"
+    start = time.perf_counter()
     try:
-        headers = {}
-        if token:
-            headers["Authorization"] = f"Bearer {token}"
-        
-        request = urllib.request.Request(url, headers=headers)
-        
-        def progress_hook(block_num, block_size, total_size):
-            downloaded = block_num * block_size
-            if total_size > 0:
-                percent = min(100, downloaded * 100 // total_size)
-                bar = '█' * (percent // 2) + '░' * (50 - percent // 2)
-                sys.stdout.write(f'\r   [{bar}] {percent}%')
+        local = _local_path(url)
+        if local is not None:
+            if not os.path.exists(local):
+                print("   ⏭️  Not in mirror")
+                return False
+            if os.path.exists(state_path):
+                # A sparse .part from an interrupted ranged download can't be resumed by offset
+                os.remove(state_path)
+                os.remove(part_path)
+            _copy_local(local, part_path)
+        else:
+            headers = {"Authorization": f"Bearer {token}"} if token else {}
+            final_url, total, ranged, validator = _probe(url, headers)
+            if ranged and total > 0:
+                _fetch_ranged(final_url, part_path, state_path, total, validator, headers, workers or WORKERS)
             else:
-                sys.stdout.write(f'\r   Downloaded {downloaded / (1024*1024):.1f} MB')
-            sys.stdout.flush()
-        
-        with urllib.request.urlopen(request) as response, open(dest_path, 'wb') as out_file:
-            total_size = int(response.info().get('Content-Length', -1))
-            downloaded = 0
-            block_size = 8192
-            while True:
-                buffer = response.read(block_size)
-                if not buffer:
-                    break
-                downloaded += len(buffer)
-                out_file.write(buffer)
-                progress_hook(downloaded // block_size, block_size, total_size)
-                
-        print("\n   ✅ Download complete!")
+                _fetch_stream(final_url, part_path, headers)
+
+        if expected_sha256:
+            print("\n   🔍 Verifying SHA-256...")
+            actual = sha256_of(part_path)
+            if actual != expected_sha256:
+                # Corrupt data must not be resumed from
+                os.remove(part_path)
+                if os.path.exists(state_path):
+                    os.remove(state_path)
+                print(f"   ❌ Checksum mismatch: expected {expected_sha256[:16]}…, got {actual[:16]}…")
+                return False
+        else:
+            print("\n   ⚠️  No manifest hash for this file: size checked only")
+
+        os.replace(part_path, dest_path)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        size_mb = os.path.getsize(dest_path) / (1024 * 1024)
+        elapsed = time.perf_counter() - start
+        print(f"   ✅ Download complete! ({size_mb:.1f} MB in {elapsed:.1f}s)")
         return True
     except Exception as e:
         print(f"\n   ❌ Download failed: {e}")
+        if os.path.exists(part_path):
+            print("   ↩️  Partial data kept; rerun to resume.")
         return False
 
 
-def main():
+def write_manifest(path=None):
+    """Records size + SHA-256 of the local weights (run on a node with known-good files)."""
+    path = path or MANIFEST_PATH
+    manifest = load_manifest(path)
+    for name in MODEL_URLS:
+        local = os.path.join(CURRENT_DIR, name)
+        if os.path.exists(local):
+            manifest[name] = {"sha256": sha256_of(local), "size": os.path.getsize(local)}
+            print(f"   🔏 {name}: {manifest[name]['sha256']}")
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+    print(f"\n✅ Manifest written: {path}")
+    return manifest
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Download and verify EMBRION model weights.")
+    parser.add_argument("--mirror", default=MIRROR,
+                        help="Local directory, file:// or http(s) base URL tried before the public URL")
+    parser.add_argument("--manifest", default=MANIFEST_PATH, help="JSON manifest of expected SHA-256 / sizes")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="Parallel range requests per file")
+    parser.add_argument("--verify-only", action="store_true", help="Check local files against the manifest")
+    parser.add_argument("--write-manifest", action="store_true", help="Record hashes of the local files")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
     print("=" * 60)
     print("🧬 Subhag EMBRION - Model Weight Downloader")
     print("=" * 60)
-    
+
+    if args.write_manifest:
+        write_manifest(args.manifest)
+        return 0
+
+    manifest = load_manifest(args.manifest)
+    if not manifest:
+        print(f"💡 No manifest at {args.manifest}: downloads can't be checksum-verified "
+              "(create one with --write-manifest on a known-good node).")
+
     hf_token = os.environ.get("HUGGINGFACE_TOKEN")
     if hf_token:
         print("🔑 Using HUGGINGFACE_TOKEN from environment.")
     else:
         print("💡 Tip: Set HUGGINGFACE_TOKEN env var if the repository is private.")
+    if args.mirror:
+        print(f"🪞 Mirror: {args.mirror}")
+
+    existing, missing = check_existing_models(manifest)
 
-    existing, missing = check_existing_models()
-    
     if existing:
         print(f"\n✅ Already downloaded ({len(existing)}):")
         for name in existing:
             print(f"   - {name}")
-    
+
     if not missing:
         print("\n✅ All models are already downloaded!")
         print("   You can run the backend: python main.py")
         return 0
-    
-    print(f"\n⚠️  Missing models ({len(missing)}):")
+
+    print(f"\n⚠️  Missing or incomplete models ({len(missing)}):")
     for name in missing:
         info = MODEL_URLS[name]
-        print(f"   - {name} ({info['size_mb']} MB)")
+        _, reason = verify_file(name, os.path.join(CURRENT_DIR, name), manifest)
+        print(f"   - {name} ({info['size_mb']} MB): {reason}")
         print(f"     {info['description']}")
-    
+
+    if args.verify_only:
+        return 1
+
     print("\n🚀 Starting downloads...")
     all_success = True
     for name in missing:
         info = MODEL_URLS[name]
         dest_path = os.path.join(CURRENT_DIR, name)
-        success = download_file(info['url'], dest_path, info['description'], token=hf_token)
+        expected = (manifest.get(name) or {}).get("sha256")
+        success = False
+        for source in _sources(name, info, args.mirror):
+            # The token is only sent to the public hub, never to mirrors
+            token = hf_token if source == info["url"] else None
+            if download_file(source, dest_path, info['description'], token=token,
+                             expected_sha256=expected, workers=args.workers):
+                success = True
+                break
         if not success:
             all_success = False
-    
+
     if all_success:
         print("\n🎉 All models downloaded successfully!")
         return 0
@@ -150,4 +453,4 @@ If models are private, ensure HUGGINGFACE_TOKEN is set.
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""
+Multi-Embryo Field-of-View Detection
+
+Dish and multi-well captures show several embryos per frame. This module finds
+each zona pellucida with the same Hough-gradient circle search used by
+EmbryoInference._validate_embryo_structure (with a wider radius range for small
+embryos in wide fields), suppresses overlapping detections, crops each embryo
+and, for time-lapse input, links detections across frames into stable tracks.
+"""
+
+import os
+
+import cv2
+import numpy as np
+
+MAX_EMBRYOS = int(os.getenv("EMBRYO_MAX_PER_FRAME", "16"))
+# Detection runs on a copy whose longer side is at most this many pixels
+DETECT_SIZE = int(os.getenv("EMBRYO_DETECT_SIZE", "800"))
+# Smallest / largest embryo radius as a fraction of the shorter image side
+MIN_RADIUS_FRAC = float(os.getenv("EMBRYO_DETECT_MIN_RADIUS", "0.04"))
+MAX_RADIUS_FRAC = float(os.getenv("EMBRYO_DETECT_MAX_RADIUS", "0.55"))
+# Crop side = 2 * radius * margin (keeps the zona and a little background)
+CROP_MARGIN = float(os.getenv("EMBRYO_CROP_MARGIN", "1.15"))
+
+
+def _suppress_overlaps(circles):
+    """Greedy non-maximum suppression: Hough returns strongest circles first."""
+    kept = []
+    for x, y, r in circles:
+        if all(np.hypot(x - kx, y - ky) > max(r, kr) * 0.8 for kx, ky, kr in kept):
+            kept.append((x, y, r))
+    return kept
+
+
+def detect_embryos(frame, max_embryos=None):
+    """
+    Finds zona pellucida circles in a BGR (or gray) frame.
+
+    Returns:
+        list of (x, y, r) in full-resolution pixel coordinates, left-to-right,
+        top-to-bottom. If nothing is found the whole frame is returned as a
+        single embryo so single-embryo captures keep working.
+    """
+    max_embryos = max_embryos or MAX_EMBRYOS
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+    h, w = gray.shape
+    scale = min(1.0, DETECT_SIZE / max(h, w))
+    small = cv2.resize(gray, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA) if scale < 1 else gray
+
+    sh, sw = small.shape
+    blurred = cv2.GaussianBlur(small, (9, 9), 2)
+    min_r = max(4, int(min(sh, sw) * MIN_RADIUS_FRAC))
+    max_r = int(min(sh, sw) * MAX_RADIUS_FRAC)
+    circles = cv2.HoughCircles(blurred, cv2.HOUGH_GRADIENT, dp=1.2, minDist=min_r * 2,
+                               param1=80, param2=25, minRadius=min_r, maxRadius=max_r)
+
+    if circles is None:
+        return [(w / 2.0, h / 2.0, min(h, w) / 2.0)]
+
+    found = [(float(x) / scale, float(y) / scale, float(r) / scale) for x, y, r in circles[0]]
+    found = _suppress_overlaps(found)[:max_embryos]
+    # Reading order: rows of wells, then left to right
+    row_height = max(r for _, _, r in found)
+    found.sort(key=lambda c: (round(c[1] / row_height), c[0]))
+    return found
+
+
+def crop_embryo(frame, circle, margin=None):
+    """Square crop centred on the circle; out-of-frame areas are edge-replicated."""
+    x, y, r = circle
+    half = int(round(r * (margin or CROP_MARGIN)))
+    x0, y0 = int(round(x)) - half, int(round(y)) - half
+    x1, y1 = x0 + 2 * half, y0 + 2 * half
+    h, w = frame.shape[:2]
+    pad = max(0, -x0, -y0, x1 - w, y1 - h)
+    if pad:
+        frame = cv2.copyMakeBorder(frame, pad, pad, pad, pad, cv2.BORDER_REPLICATE)
+        x0, y0, x1, y1 = x0 + pad, y0 + pad, x1 + pad, y1 + pad
+    return frame[y0:y1, x0:x1]
+
+
+def track_embryos(frames, max_embryos=None):
+    """
+    Links per-frame detections into stable tracks over a time-lapse.
+
+    Tracks are seeded from the frame with the most detections; every other
+    frame's detections are assigned to the nearest track centre (within half
+    a radius). Each track's crop circle is the per-axis median of its
+    assignments, so the crop doesn't jitter from frame to frame.
+
+    Returns:
+        list of dicts: {"circle": (x, y, r), "hits": frames with a detection}
+    """
+    detections = [detect_embryos(f, max_embryos) for f in frames]
+    seed = max(range(len(detections)), key=lambda i: len(detections[i]))
+    tracks = [{"members": [c]} for c in detections[seed]]
+
+    for i, circles in enumerate(detections):
+        if i == seed:
+            continue
+        taken = set()
+        # Closest pairs first so two tracks never claim the same detection
+        pairs = sorted(((np.hypot(c[0] - t["members"][0][0], c[1] - t["members"][0][1]), ci, ti)
+                        for ci, c in enumerate(circles) for ti, t in enumerate(tracks)))
+        claimed = set()
+        for dist, ci, ti in pairs:
+            if ci in taken or ti in claimed or dist > tracks[ti]["members"][0][2] * 0.5:
+                continue
+            tracks[ti]["members"].append(circles[ci])
+            taken.add(ci)
+            claimed.add(ti)
+
+    result = []
+    for t in tracks:
+        members = np.array(t["members"])
+        result.append({"circle": tuple(float(v) for v in np.median(members, axis=0)), "hits": len(members)})
+    return result
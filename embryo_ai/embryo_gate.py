@@ -5,19 +5,36 @@ This module uses CLIP (Contrastive Language-Image Pre-training) to semantically
 validate whether an uploaded image is actually a microscope image of a human embryo.
 
 This is a TOLLGATE that runs BEFORE any Gardner/Morphokinetic analysis.
+A cheap pre-filter tier (prefilter.py) decides obvious cases first so that
+only ambiguous inputs pay for the CLIP forward.
 """
 
 import os
+import time
 import torch
 import numpy as np
 from PIL import Image
 import io
 
+import metrics
+from prefilter import PREFILTER_MODE, prefilter
+from scheduler import checkpoint
+
+# Video gating: number of frames taken from the decoded buffer and how they are aggregated
+VIDEO_GATE_FRAMES = int(os.getenv("EMBRYO_VIDEO_GATE_FRAMES", "5"))
+VIDEO_GATE_RULE = os.getenv("EMBRYO_VIDEO_GATE_RULE", "majority")
+
 # Lazy-load the CLIP model to avoid slow startup
 _clip_model = None
 _clip_processor = None
 _clip_tokenizer = None
 
+# CPU precision for the CLIP forward ("fp32" or "bf16-autocast"), verified against FP32 at load
+GATE_PRECISION = os.getenv("EMBRYO_GATE_PRECISION", os.getenv("EMBRYO_PRECISION", "fp32"))
+PRECISION_MIN_AGREEMENT = float(os.getenv("EMBRYO_PRECISION_MIN_AGREEMENT", "0.98"))
+_gate_precision = "fp32"
+_precision_report = {"requested": GATE_PRECISION, "active": "fp32"}
+
 # Prompts for classification
 POSITIVE_PROMPTS = [
     "a microscope image of a human embryo",
@@ -52,6 +69,7 @@ def _load_clip():
             _clip_model = CLIPModel.from_pretrained(model_id)
             _clip_processor = CLIPProcessor.from_pretrained(model_id)
             _clip_model.eval()
+            _configure_precision()
             
             print("EmbryoGate: CLIP model loaded successfully.")
         except Exception as e:
@@ -61,64 +79,193 @@ def _load_clip():
     return _clip_model, _clip_processor
 
 
-def validate_embryo_image(image_data) -> tuple[bool, str, float]:
+def _autocast():
+    import contextlib
+    if _gate_precision == "bf16-autocast":
+        return torch.autocast(device_type="cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def _reference_argmax(inputs):
+    with torch.no_grad(), _autocast():
+        logits = _clip_model(**inputs).logits_per_image
+    return torch.argmax(logits.float(), dim=1)
+
+
+def _configure_precision():
     """
-    Validates if the given image is a biological embryo image.
-    
-    Args:
-        image_data: Either a PIL Image, numpy array (BGR), or bytes.
-    
-    Returns:
-        tuple: (is_valid: bool, message: str, confidence: float)
+    Enables bf16 autocast for CLIP only if its prompt argmax on a seeded
+    reference batch matches FP32 at least PRECISION_MIN_AGREEMENT of the time.
     """
-    model, processor = _load_clip()
-    
-    # Convert input to PIL Image
+    global _gate_precision, _precision_report
+    if GATE_PRECISION == "fp32":
+        return
+    if GATE_PRECISION != "bf16-autocast":
+        print(f"EmbryoGate: Unknown precision '{GATE_PRECISION}', using fp32.")
+        return
+
+    rng = np.random.default_rng(0)
+    images = [Image.fromarray(rng.integers(0, 255, (224, 224, 3), dtype=np.uint8)) for _ in range(8)]
+    inputs = _clip_processor(text=POSITIVE_PROMPTS + NEGATIVE_PROMPTS, images=images,
+                             return_tensors="pt", padding=True)
+
+    _gate_precision = "fp32"
+    fp32_labels = _reference_argmax(inputs)
+    _clip_model.to(memory_format=torch.channels_last)
+    _gate_precision = GATE_PRECISION
+    agreement = float((_reference_argmax(inputs) == fp32_labels).float().mean())
+
+    _precision_report = {"requested": GATE_PRECISION, "agreement": round(agreement, 4),
+                         "threshold": PRECISION_MIN_AGREEMENT}
+    if agreement < PRECISION_MIN_AGREEMENT:
+        _clip_model.to(memory_format=torch.contiguous_format)
+        _gate_precision = "fp32"
+        print(f"EmbryoGate: bf16 agreement {agreement:.1%} below threshold. Using fp32.")
+    else:
+        print(f"EmbryoGate: {GATE_PRECISION} enabled (agreement {agreement:.1%}).")
+    _precision_report["active"] = _gate_precision
+
+
+def precision_report() -> dict:
+    """Requested vs active CLIP precision and the parity-check result."""
+    return dict(_precision_report)
+
+
+def _to_pil(image_data):
+    """Converts bytes / BGR numpy array / PIL input to an RGB PIL Image (None if unsupported)."""
     if isinstance(image_data, bytes):
-        pil_image = Image.open(io.BytesIO(image_data)).convert("RGB")
+        return Image.open(io.BytesIO(image_data)).convert("RGB")
     elif isinstance(image_data, np.ndarray):
         # Assume BGR (OpenCV format)
         import cv2
         rgb = cv2.cvtColor(image_data, cv2.COLOR_BGR2RGB)
-        pil_image = Image.fromarray(rgb)
+        return Image.fromarray(rgb)
     elif isinstance(image_data, Image.Image):
-        pil_image = image_data.convert("RGB")
-    else:
-        return False, "Invalid input type", 0.0
+        return image_data.convert("RGB")
+    return None
+
+
+def _to_bgr(image_data):
+    """BGR numpy view of the input for the pre-filter (None if unsupported)."""
+    import cv2
+    if isinstance(image_data, np.ndarray):
+        return image_data
+    if isinstance(image_data, bytes):
+        return cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+    if isinstance(image_data, Image.Image):
+        return cv2.cvtColor(np.asarray(image_data.convert("RGB")), cv2.COLOR_RGB2BGR)
+    return None
+
+
+def _clip_scores(pil_images):
+    """
+    One batched CLIP forward over several images.
+
+    Returns a list of (positive_score, negative_score, most likely negative prompt).
+    """
+    model, processor = _load_clip()
     
     # Prepare inputs
     all_prompts = POSITIVE_PROMPTS + NEGATIVE_PROMPTS
     inputs = processor(
         text=all_prompts,
-        images=pil_image,
+        images=pil_images,
         return_tensors="pt",
         padding=True
     )
     
     # Run inference
-    with torch.no_grad():
+    if _gate_precision == "bf16-autocast":
+        inputs["pixel_values"] = inputs["pixel_values"].contiguous(memory_format=torch.channels_last)
+    with torch.no_grad(), _autocast():
         outputs = model(**inputs)
-        logits_per_image = outputs.logits_per_image  # Shape: [1, num_prompts]
-        probs = logits_per_image.softmax(dim=1).squeeze().cpu().numpy()
+        logits_per_image = outputs.logits_per_image.float()  # Shape: [num_images, num_prompts]
+        probs = logits_per_image.softmax(dim=1).cpu().numpy()
     
-    # Calculate scores
-    positive_score = np.sum(probs[:len(POSITIVE_PROMPTS)])
-    negative_score = np.sum(probs[len(POSITIVE_PROMPTS):])
+    scores = []
+    for row in probs:
+        neg_probs = row[len(POSITIVE_PROMPTS):]
+        scores.append((float(np.sum(row[:len(POSITIVE_PROMPTS)])), float(np.sum(neg_probs)),
+                       NEGATIVE_PROMPTS[int(np.argmax(neg_probs))]))
+    return scores
+
+
+def _clip_validate(pil_image) -> tuple[bool, str, float]:
+    """Full CLIP semantic check (the expensive tier)."""
+    positive_score, negative_score, detected_as = _clip_scores([pil_image])[0]
     
     # Decision
-    is_embryo = positive_score > negative_score
-    confidence = max(positive_score, negative_score)
-    
-    if is_embryo:
+    if positive_score > negative_score:
         return True, f"Valid Embryo Image (confidence: {positive_score:.1%})", positive_score
     else:
-        # Find the most likely negative category
-        neg_probs = probs[len(POSITIVE_PROMPTS):]
-        max_neg_idx = np.argmax(neg_probs)
-        detected_as = NEGATIVE_PROMPTS[max_neg_idx]
         return False, f"Not an Embryo Image. Detected as: {detected_as}", negative_score
 
 
+def validate_embryo_image(image_data, prefilter_mode=None) -> tuple[bool, str, float]:
+    """
+    Validates if the given image is a biological embryo image.
+
+    Runs as a cascade: the cheap pre-filter (prefilter.py) rejects obvious junk
+    (and, in "full" mode, accepts clear embryos); everything else reaches the
+    CLIP model.
+    
+    Args:
+        image_data: Either a PIL Image, numpy array (BGR), or bytes.
+        prefilter_mode: Overrides EMBRYO_PREFILTER_MODE ("off", "reject", "full").
+    
+    Returns:
+        tuple: (is_valid: bool, message: str, confidence: float)
+    """
+    if not isinstance(image_data, (bytes, np.ndarray, Image.Image)):
+        return False, "Invalid input type", 0.0
+
+    mode = (prefilter_mode or PREFILTER_MODE).lower()
+    would_accept = False
+    if mode != "off":
+        start = time.perf_counter()
+        decision, reason, features = prefilter(_to_bgr(image_data), mode=mode)
+        would_accept = features.get("would_accept", False)
+        metrics.observe("gate.prefilter.seconds", time.perf_counter() - start)
+        if decision == "reject":
+            metrics.incr("gate.decided.prefilter_reject")
+            return False, f"{reason} (pre-filter)", 1.0
+        if decision == "accept":
+            metrics.incr("gate.decided.prefilter_accept")
+            return True, f"Valid Embryo Image: {reason} (pre-filter)", 1.0
+
+    checkpoint()
+    start = time.perf_counter()
+    is_valid, reason, confidence = _clip_validate(_to_pil(image_data))
+    metrics.observe("gate.clip.seconds", time.perf_counter() - start)
+    metrics.incr("gate.decided.clip_accept" if is_valid else "gate.decided.clip_reject")
+    if would_accept:
+        _audit_accept(is_valid)
+    return is_valid, reason, confidence
+
+
+def _audit_accept(clip_accepted):
+    """Counts whether CLIP agreed with an accept the pre-filter was not allowed to make."""
+    metrics.incr("gate.prefilter_audit." + ("accept_agree" if clip_accepted else "accept_disagree"))
+
+
+def gate_stats() -> dict:
+    """How often each cascade tier made the final decision."""
+    tiers = ["prefilter_reject", "prefilter_accept", "clip_accept", "clip_reject"]
+    counts = {t: metrics.counter(f"gate.decided.{t}") for t in tiers}
+    total = sum(counts.values())
+    agree, disagree = (metrics.counter(f"gate.prefilter_audit.accept_{k}") for k in ("agree", "disagree"))
+    return {
+        "mode": PREFILTER_MODE,
+        # Shadow accept-tier decisions checked against CLIP ("reject" mode)
+        "accept_audit": {"audited": agree + disagree, "clip_disagreed": disagree,
+                         "agreement": round(agree / (agree + disagree), 4) if agree + disagree else None},
+        "total": total,
+        "counts": counts,
+        "share": {t: round(c / total, 4) if total else 0.0 for t, c in counts.items()},
+        "clip_bypass_rate": round((counts["prefilter_reject"] + counts["prefilter_accept"]) / total, 4) if total else 0.0,
+    }
+
+
 def validate_video_frame(frame_bgr: np.ndarray) -> tuple[bool, str, float]:
     """
     Convenience wrapper for video frames (BGR numpy arrays).
@@ -126,6 +273,90 @@ def validate_video_frame(frame_bgr: np.ndarray) -> tuple[bool, str, float]:
     return validate_embryo_image(frame_bgr)
 
 
+def validate_embryo_frames(frames, rule=None, prefilter_mode=None) -> tuple[bool, str, float]:
+    """
+    Gates a time-lapse from several already-decoded frames (BGR numpy arrays).
+
+    Each frame goes through the pre-filter; the ambiguous ones are scored
+    together in ONE batched CLIP forward. Per-frame embryo scores are then
+    aggregated with `rule`:
+        majority - more than half of the frames pass
+        min      - every frame passes (weakest frame decides)
+        mean     - mean embryo score passes
+
+    Returns:
+        tuple: (is_valid: bool, message: str, confidence: float)
+    """
+    if not frames:
+        return False, "No frames available for validation", 0.0
+
+    frame_scores, reasons = score_embryo_frames(frames, prefilter_mode=prefilter_mode)
+    return aggregate_frame_scores(frame_scores, reasons, rule)
+
+
+def aggregate_frame_scores(frame_scores, reasons, rule=None) -> tuple[bool, str, float]:
+    """Video gate decision from per-frame scores (see validate_embryo_frames for the rules)."""
+    rule = (rule or VIDEO_GATE_RULE).lower()
+    passed = [score > 0.5 for score in frame_scores]
+    if rule == "min":
+        confidence = min(frame_scores)
+        is_valid = all(passed)
+    elif rule == "mean":
+        confidence = float(np.mean(frame_scores))
+        is_valid = confidence > 0.5
+    else:
+        confidence = sum(passed) / len(passed)
+        is_valid = confidence > 0.5
+
+    metrics.incr("gate.videos." + ("accept" if is_valid else "reject"))
+    summary = f"{sum(passed)}/{len(frame_scores)} frames passed, rule={rule}"
+    if is_valid:
+        return True, f"Valid Embryo Video ({summary})", confidence
+    worst = int(np.argmin(frame_scores))
+    return False, f"Not an Embryo Video ({summary}). {reasons[worst]}", 1.0 - confidence
+
+
+def score_embryo_frames(frames, prefilter_mode=None):
+    """
+    Per-frame embryo probability for several BGR frames (video frames or
+    per-embryo crops). Pre-filter decisions score 1.0 / 0.0; ambiguous frames
+    share ONE batched CLIP forward.
+
+    Returns:
+        tuple: (scores: list[float], reasons: list[str])
+    """
+    mode = (prefilter_mode or PREFILTER_MODE).lower()
+    frame_scores = [None] * len(frames)  # probability that each frame is an embryo
+    reasons = [None] * len(frames)
+    pending = []
+    audited = set()
+    for i, frame in enumerate(frames):
+        if mode != "off":
+            decision, reason, features = prefilter(frame, mode=mode)
+            if features.get("would_accept") and decision == "ambiguous":
+                audited.add(i)
+            if decision != "ambiguous":
+                metrics.incr(f"gate.frames.prefilter_{decision}")
+                frame_scores[i] = 1.0 if decision == "accept" else 0.0
+                reasons[i] = f"{reason} (pre-filter)"
+                continue
+        pending.append(i)
+
+    if pending:
+        checkpoint()
+        start = time.perf_counter()
+        scores = _clip_scores([_to_pil(frames[i]) for i in pending])
+        metrics.observe("gate.clip_batch.seconds", time.perf_counter() - start)
+        metrics.observe("gate.clip_batch.size", len(pending))
+        for i, (positive, negative, detected_as) in zip(pending, scores):
+            metrics.incr("gate.frames.clip_" + ("accept" if positive > negative else "reject"))
+            if i in audited:
+                _audit_accept(positive > negative)
+            frame_scores[i] = positive
+            reasons[i] = f"Detected as: {detected_as}" if positive <= negative else "Embryo"
+    return frame_scores, reasons
+
+
 # Quick test
 if __name__ == "__main__":
     print("Testing EmbryoGate...")
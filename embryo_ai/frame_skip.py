@@ -0,0 +1,83 @@
+"""
+Near-Duplicate Frame Skipping
+
+Consecutive time-lapse frames often barely differ (the embryo changes little
+in 10 minutes), yet each sampled frame paid a full ResNet forward. Before the
+staging encoder runs, every frame gets a cheap signature (luminance
+downscaled to SIGNATURE_SIZE x SIGNATURE_SIZE per focal plane) and is compared
+with the last frame that was actually encoded. Frames whose mean absolute
+signature difference is at or below SKIP_THRESHOLD reuse that frame's CNN
+features; the LSTM still sees every timepoint.
+
+A sample of videos (AUDIT_RATE) is also run without skipping, and the
+per-frame stage agreement between the two is recorded in the metrics, so the
+threshold can be tuned against its effect on staging.
+
+Skipping changes staging logits and milestones, so it is off by default. To
+enable it, run a representative workload with a candidate threshold and a
+high audit rate (e.g. EMBRYO_FRAME_SKIP_THRESHOLD=0.02
+EMBRYO_FRAME_SKIP_AUDIT_RATE=1), check frame_skip.stage_agreement and
+frame_skip.final_stage_mismatch in /metrics, then deploy the threshold with
+the audit rate lowered. Needs EMBRYO_SEQ_BATCH=on.
+"""
+
+import os
+import random
+
+import torch
+
+import metrics
+
+# Mean |signature difference| (normalized-input units) at or below which a frame reuses features; 0 = off
+SKIP_THRESHOLD = float(os.getenv("EMBRYO_FRAME_SKIP_THRESHOLD", "0"))
+SIGNATURE_SIZE = int(os.getenv("EMBRYO_FRAME_SKIP_SIGNATURE", "32"))
+# Fraction of videos also run without skipping to measure stage agreement
+AUDIT_RATE = float(os.getenv("EMBRYO_FRAME_SKIP_AUDIT_RATE", "0.05"))
+
+
+def signatures(work):
+    """T x P x S x S luminance signatures of a 1 x T x P x C x H x W input."""
+    frames = work[0].float()
+    t, p = frames.shape[:2]
+    luma = frames.mean(dim=2).reshape(t * p, 1, *frames.shape[-2:])
+    return torch.nn.functional.adaptive_avg_pool2d(luma, SIGNATURE_SIZE).reshape(t, p, SIGNATURE_SIZE, SIGNATURE_SIZE)
+
+
+def plan_keyframes(work, threshold=None):
+    """
+    Which frames of a video need encoding.
+
+    Returns (keyframes, source): positions to run through the encoder, and for
+    every frame the index into `keyframes` whose features it uses.
+    """
+    threshold = SKIP_THRESHOLD if threshold is None else threshold
+    t = work.shape[1]
+    if threshold <= 0 or t < 2:
+        return list(range(t)), list(range(t))
+    sig = signatures(work)
+    keyframes, source = [0], [0]
+    for i in range(1, t):
+        # Max over focal planes: a change in any plane is a change
+        diff = float((sig[i] - sig[keyframes[-1]]).abs().mean(dim=(1, 2)).max())
+        if diff > threshold:
+            keyframes.append(i)
+        source.append(len(keyframes) - 1)
+    metrics.incr("frame_skip.frames", t)
+    metrics.incr("frame_skip.skipped", t - len(keyframes))
+    metrics.observe("frame_skip.skip_ratio", 1.0 - len(keyframes) / t)
+    return keyframes, source
+
+
+def should_audit():
+    return AUDIT_RATE > 0 and random.random() < AUDIT_RATE
+
+
+def record_agreement(skipped_pred, full_pred):
+    """Per-frame argmax agreement of skipped vs full logits (1 x T x Classes each)."""
+    agreement = float((skipped_pred.argmax(dim=-1) == full_pred.argmax(dim=-1)).float().mean())
+    last_match = bool(skipped_pred[0, -1].argmax() == full_pred[0, -1].argmax())
+    metrics.observe("frame_skip.stage_agreement", agreement)
+    metrics.incr("frame_skip.audits")
+    if not last_match:
+        metrics.incr("frame_skip.final_stage_mismatch")
+    return agreement
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torchvision.models as models
+from torchvision.models.vgg import cfgs as vgg_cfgs, make_layers as vgg_make_layers
 
 class GardnerNet(nn.Module):
     """
@@ -15,8 +16,12 @@ class GardnerNet(nn.Module):
         
         # Load VGG16 backbone
         # We use the 'features' part of VGG16 which corresponds to the convolutional blocks
-        vgg16 = models.vgg16(pretrained=pretrained)
-        self.features = vgg16.features
+        if pretrained:
+            self.features = models.vgg16(pretrained=True).features
+        else:
+            # Same layers (and state-dict keys) as vgg16().features, without building
+            # the ~120M-parameter classifier that is thrown away
+            self.features = vgg_make_layers(vgg_cfgs["D"], batch_norm=False)
         
         # Optional: Freeze backbone weights (simulating Keras 'trainable=False' behavior)
         # The original paper/code freezes everything except the last 3 layers for fine-tuning
@@ -0,0 +1,165 @@
+"""
+Reduced-Resolution Image Decoding
+
+Microscope stills are often 20+ megapixels, yet every model sees them at
+img_size x img_size. Decoding at full resolution only to throw almost all of
+it away dominated Gardner latency and peak memory. The decode scale is now
+picked from the input size (read from the header):
+
+  - JPEG: DCT-domain downscaling by 1/2, 1/4 or 1/8 inside libjpeg
+    (IMREAD_REDUCED_COLOR_N), so the full-resolution image never exists
+  - TIFF: pyramidal files decode the smallest stored level that is still
+    large enough
+  - PNG and others: OpenCV's reduced decode (full decode, immediately
+    reduced; no time saved, but the full frame is not kept)
+
+The decoded short side is kept at least EMBRYO_DECODE_MIN_SCALE x img_size,
+so the final resize still averages several source pixels and the result stays
+within tolerance of full-resolution-then-resize. Check on sample data with:
+
+    python image_decode.py check still1.jpg still2.tif
+"""
+
+import io
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import metrics
+
+REDUCED_DECODE = os.getenv("EMBRYO_REDUCED_DECODE", "on").lower() == "on"
+# Decoded short side >= this multiple of the model input size
+MIN_SCALE = float(os.getenv("EMBRYO_DECODE_MIN_SCALE", "2"))
+# Mean absolute difference (0-1 pixel scale) accepted by `check`
+TOLERANCE = float(os.getenv("EMBRYO_DECODE_TOLERANCE", "0.02"))
+
+REDUCTIONS = (1, 2, 4, 8)
+_CV_FLAGS = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2,
+             4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+# PIL modes that convert("RGB") maps to 8 bits without clipping
+_8BIT_MODES = ("1", "L", "LA", "P", "RGB", "RGBA", "CMYK", "YCbCr")
+
+
+def image_format(image_bytes):
+    head = bytes(image_bytes[:12])
+    if head.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if head.startswith(b"\x89PNG"):
+        return "png"
+    if head[:4] in (b"II*\x00", b"MM\x00*"):
+        return "tiff"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return "other"
+
+
+def choose_reduction(width, height, target_size):
+    """Largest 1/2^k decode scale that keeps the short side >= MIN_SCALE x target_size."""
+    short = min(width, height)
+    if not REDUCED_DECODE or short <= 0:
+        return 1
+    return max(f for f in REDUCTIONS if f == 1 or short / f >= MIN_SCALE * target_size)
+
+
+def _decode_tiff_level(image_bytes, reduction):
+    """BGR frame from the smallest pyramid level >= full size / reduction (None if not pyramidal)."""
+    from PIL import Image
+
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            full_w, full_h = img.size
+            levels = []
+            for page in range(getattr(img, "n_frames", 1)):
+                img.seek(page)
+                w, h = img.size
+                # Pyramid levels keep the aspect ratio of the full image
+                if w < full_w and abs(w / h - full_w / full_h) < 0.01 and w >= full_w / reduction:
+                    levels.append((w, page))
+            if not levels:
+                return None
+            img.seek(min(levels)[1])
+            if img.mode.startswith("I;16"):
+                # Scaled to 8 bits like cv2.IMREAD_COLOR does (convert("RGB") would clip at 255)
+                gray = (np.asarray(img).astype(np.uint16) >> 8).astype(np.uint8)
+                return cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+            if img.mode not in _8BIT_MODES:
+                return None  # other depths: left to the cv2 decode
+            return cv2.cvtColor(np.asarray(img.convert("RGB")), cv2.COLOR_RGB2BGR)
+    except Exception:
+        return None
+
+
+def decode_image(image_bytes, target_size=None, reduction=1, width=None, height=None):
+    """
+    Decodes an encoded still to BGR at a reduced scale.
+
+    Args:
+        target_size: model input size; picks the decode scale from the image
+            size (None = only `reduction` applies)
+        reduction: minimum reduction (e.g. chosen by the memory guard)
+        width/height: image size if already probed (else read from the header)
+    """
+    fmt = image_format(image_bytes)
+    if target_size and (width is None or height is None):
+        from memory_guard import probe_image_bytes
+        plan = probe_image_bytes(image_bytes)
+        width, height = (plan.width, plan.height) if plan is not None else (0, 0)
+    factor = max(reduction, choose_reduction(width, height, target_size) if target_size else 1)
+
+    start = time.perf_counter()
+    frame = _decode_tiff_level(image_bytes, factor) if fmt == "tiff" and factor > 1 else None
+    if frame is None:
+        frame = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), _CV_FLAGS[factor])
+    metrics.observe(f"decode.image_seconds.{fmt}", time.perf_counter() - start)
+    metrics.incr(f"decode.reduction.{factor}")
+    return frame
+
+
+def read_image(path, target_size=None):
+    """decode_image for a file on disk."""
+    with open(path, "rb") as f:
+        return decode_image(f.read(), target_size)
+
+
+def _model_view(frame, size):
+    """The frame as the models see it (img_size RGB, 0-1)."""
+    return cv2.cvtColor(cv2.resize(frame, (size, size)), cv2.COLOR_BGR2RGB).astype(np.float32) / 255.0
+
+
+def check(path, target_size=224):
+    """(reduction, mean abs difference to full-res-then-resize, full ms, reduced ms)."""
+    with open(path, "rb") as f:
+        data = f.read()
+    start = time.perf_counter()
+    full = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    full_ms = (time.perf_counter() - start) * 1000
+    start = time.perf_counter()
+    reduced = decode_image(data, target_size)
+    reduced_ms = (time.perf_counter() - start) * 1000
+    if full is None or reduced is None:
+        return None
+    factor = round(full.shape[1] / reduced.shape[1])
+    diff = float(np.abs(_model_view(full, target_size) - _model_view(reduced, target_size)).mean())
+    return factor, diff, full_ms, reduced_ms
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] != "check":
+        print("Usage: python image_decode.py check <image> [<image> ...]")
+        sys.exit(1)
+    failed = 0
+    for path in sys.argv[2:]:
+        result = check(path)
+        if result is None:
+            print(f"❌ {path}: could not be decoded")
+            failed += 1
+            continue
+        factor, diff, full_ms, reduced_ms = result
+        ok = diff <= TOLERANCE
+        failed += not ok
+        print(f"{'✅' if ok else '⚠️ '} {path}: 1/{factor} decode, mean abs diff {diff:.4f} "
+              f"({full_ms:.0f} ms -> {reduced_ms:.0f} ms)")
+    sys.exit(1 if failed else 0)
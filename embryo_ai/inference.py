@@ -1,5 +1,6 @@
 import os
 import configparser
+import logging
 import random
 import sys
 
@@ -14,6 +15,9 @@ try:
     import modelBuilder
     import args as model_args
     from gardner_net import GardnerNet  # Import the new brain
+    from video_sampling import VideoFrameSource
+    from weights_io import build_module, load_weights
+    from sequence_ingest import is_sequence_path, open_sequence
     HAS_REAL_CODE = True
 except ImportError as e:
     print(f"Import error: {e}")
@@ -25,8 +29,31 @@ try:
 except ImportError:
     HAS_TORCH = False
 
+from scheduler import checkpoint
+import metrics
+from structured_log import get_logger, fields
+
+log = get_logger("inference")
+decode_log = get_logger("decode")
+
+# CPU precision modes: plain FP32, or channels-last conv trunks under bfloat16 autocast
+PRECISION_MODES = ("fp32", "bf16-autocast")
+# Minimum argmax agreement with FP32 on the reference batch before a reduced precision is enabled
+PRECISION_MIN_AGREEMENT = float(os.environ.get("EMBRYO_PRECISION_MIN_AGREEMENT", "0.98"))
+PRECISION_REF_BATCH = int(os.environ.get("EMBRYO_PRECISION_REF_BATCH", "8"))
+
+# Video Gardner grading: candidates are the sharpest frames in the last part of the timeline
+BEST_FRAME_TOPK = int(os.environ.get("EMBRYO_BEST_FRAME_TOPK", "4"))
+BEST_FRAME_WINDOW = float(os.environ.get("EMBRYO_BEST_FRAME_WINDOW", "0.25"))
+# Max frames per GardnerNet forward when grading a whole timeline
+GARDNER_CHUNK = int(os.environ.get("EMBRYO_GARDNER_CHUNK", "16"))
+# Focal planes fed to the staging model (mirrors sequence_ingest.FOCAL_PLANES)
+FOCAL_PLANES = int(os.environ.get("EMBRYO_FOCAL_PLANES", "1"))
+# Staging class index at which each morphokinetic milestone is reached
+MILESTONE_STAGES = {3: "t2", 4: "t3", 6: "t5", 9: "t8", 11: "tM", 13: "tB", 14: "tEB"}
+
 class EmbryoInference:
-    def __init__(self, config_path):
+    def __init__(self, config_path, precision=None):
         self.config_path = os.path.abspath(config_path) if config_path else ""
         self.config = self._load_config(self.config_path) if self.config_path else None
         
@@ -50,10 +77,23 @@ class EmbryoInference:
         # Only allow simulation if explicitly enabled via env var
         self.allow_simulation = os.environ.get("ALLOW_SIMULATION", "False").lower() == "true"
 
+        self.precision = precision or os.environ.get("EMBRYO_PRECISION", "fp32")
+        self.precision_report = {"requested": self.precision, "active": "fp32"}
+        self.compiled_gardner = None
+        self.compiled_staging = {}
+        self.compile_report = {"active": False}
+        self.gardner_weights_path = None
+        self.sequence_batcher = None
+
         if HAS_TORCH and HAS_REAL_CODE:
             if self.config:
                 self.load_model()
             self.load_gardner_model()
+            self._configure_precision()
+            self._configure_compilation()
+            if self.model is not None:
+                from sequence_batcher import SequenceBatcher
+                self.sequence_batcher = SequenceBatcher(self)
         else:
              # If we are missing dependencies, we must fail unless simulation is explicitly allowed
              if not self.allow_simulation:
@@ -129,7 +169,10 @@ class EmbryoInference:
     def _search_weights(self, model_id):
         """Helper to find weights for a given model ID."""
         dirs = os.path.dirname(self.config_path) if self.config_path else current_dir
-        for f in os.listdir(dirs):
+        for f in sorted(os.listdir(dirs)):
+            # Converted copies (.safetensors) and partial downloads are not checkpoints themselves
+            if f.endswith((".safetensors", ".part", ".part.json")):
+                continue
             if f.startswith("model" + model_id) or (f.startswith("model") and model_id in f):
                 return os.path.join(dirs, f)
         return None
@@ -242,66 +285,83 @@ class EmbryoInference:
         
         return False, "Input Rejected: No valid Zona Pellucida structure detected"
 
-    def load_input(self, file_path):
-        """Loads and preprocesses a video or image file."""
+    def load_input(self, file_path, keep_frames=0, content_hash=None, max_frames=None):
+        """Loads and preprocesses a video or image file.
+
+        Args:
+            file_path: Video or image path.
+            keep_frames: If > 0, also return up to this many raw BGR frames, evenly
+                spaced over the sampled frames, so callers (the CLIP gate) can reuse
+                them instead of decoding the file again. Returns (tensor, frames).
+            content_hash: SHA-256 of the file if the caller already has it
+                (keys the cached keyframe index).
+            max_frames: Cap on sampled timepoints (set by the memory guard).
+        """
+        if keep_frames:
+            raw_frames = []
+            tensor = self._load_input(file_path, keep_frames, raw_frames, content_hash, max_frames)
+            return tensor, raw_frames
+        return self._load_input(file_path, 0, None, content_hash, max_frames)
+
+    def _load_input(self, file_path, keep_frames, raw_frames, content_hash=None, max_frames=None):
         if not HAS_TORCH: return None
         
         import cv2
         import numpy as np
         
+        # Time-lapse exports: frame folders, zip archives, multi-page TIFF stacks
+        if is_sequence_path(file_path):
+            source = open_sequence(file_path)
+            if source is not None:
+                try:
+                    return self._load_sequence(source, keep_frames, raw_frames, max_frames)
+                finally:
+                    source.release()
+
         ext = os.path.splitext(file_path)[1].lower()
         is_video = ext in ['.mp4', '.avi', '.mkv', '.mov', '.webm']
         
         if is_video:
-            cap = cv2.VideoCapture(file_path)
+            source = VideoFrameSource(file_path, content_hash=content_hash)
             frames = []
             # CRITICAL FIX: Use minimum 50 frames for morphokinetic analysis (not 10)
             # Clinical videos have 1000s of frames, sampling more gives better transition detection
-            config_tr_len = int(self.config.get('default', 'tr_len', fallback=10)) if self.config else 10
-            tr_len = max(50, config_tr_len)  # MINIMUM 50 frames for proper analysis
-            
             # Get video info
-            total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-            fps = cap.get(cv2.CAP_PROP_FPS)
+            total_frames = source.frame_count
+            fps = source.fps
             if total_frames <= 0: 
-                print(f"ERROR: Video has 0 frames: {file_path}")
+                decode_log.error("video has no frames", extra=fields(path=file_path))
+                source.release()
                 return None
             
-            # If video has fewer frames than we want, just use all of them
-            actual_sample_count = min(tr_len, total_frames)
-            print(f"Video info: {total_frames} total frames, {fps:.1f} fps. Sampling {actual_sample_count} frames.")
+            # MINIMUM 50 frames for proper analysis; if video has fewer frames than we want, just use all of them
+            actual_sample_count = self._sample_count(total_frames, max_frames)
+            decode_log.info("video sampling", extra=fields(total_frames=total_frames, fps=round(fps, 1),
+                                                           sampled=actual_sample_count))
             
             indices = np.linspace(0, total_frames - 1, actual_sample_count, dtype=int)
-            index_set = set(indices)
-            
-            for i in range(total_frames):
-                ret, frame = cap.read()
-                if not ret: break
-                if i in index_set:
-                    frames.append(self._preprocess_frame(frame))
-                if len(frames) >= actual_sample_count: break
+            # Positions (within the sampled frames) whose raw frame is kept for the caller
+            keep_positions = set(np.linspace(0, actual_sample_count - 1, min(keep_frames, actual_sample_count), dtype=int)) if keep_frames else set()
             
-            # Validate content on the middle frame
-            middle_frame_idx = len(frames) // 2
-            # We need to re-read or cache the raw frames for validation because _preprocess_frame normalizes them
-            # Ideally we check the raw cv2 frame. 
-            # Since we didn't keep raw frames in the loop above, let's reopen or we should have checked during loop.
-            # Optimization: Check the FIRST frame or randomly sample a few.
+            # Seek-and-decode or sequential grab, whichever the GOP structure favours;
+            # only the sampled frames are retrieved
+            for i, frame in source.read(indices):
+                checkpoint()
+                if len(frames) in keep_positions:
+                    raw_frames.append(frame)
+                frames.append(self._preprocess_frame(frame))
+            decode_log.debug("video sampling plan", extra=fields(plan=source.last_plan))
             
-            # Let's check the first successfully read frame for structure
-            # Note: We need a raw frame. 
-            pass # Validation happens below if we refactor, but let's do it inside the loop or re-read
-            
-            cap.release()
+            source.release()
             
             if not frames: 
-                print(f"ERROR: No frames extracted from {file_path}")
+                decode_log.error("no frames extracted", extra=fields(path=file_path))
                 return None
             
             # NOTE: Validation is now handled by CLIP gate in service.py
             # The old CV-based validation has been removed.
 
-            print(f"SUCCESS: Extracted {len(frames)} frames from {file_path}")
+            decode_log.info("frames extracted", extra=fields(frames=len(frames)))
             # Stack to N x T x C x H x W (N=1)
             return torch.stack(frames).unsqueeze(0)
         else:
@@ -312,13 +372,57 @@ class EmbryoInference:
             # Intelligent Gating
             is_valid, reason = self._validate_embryo_structure(frame)
             if not is_valid:
-                print(f"SECURITY GATING: {reason}")
+                get_logger("gate").info("structure check rejected", extra=fields(reason=reason))
                 return None
                 
+            if raw_frames is not None:
+                raw_frames.append(frame)
             tensor = self._preprocess_frame(frame)
             # 1 x 1 x C x H x W (T=1)
             return tensor.unsqueeze(0).unsqueeze(0)
 
+    def _tr_len(self):
+        """Temporal length the staging model was trained on."""
+        return int(self.config.get('default', 'tr_len', fallback=10)) if self.config else 10
+
+    def _sample_count(self, total_frames, max_frames=None):
+        """Number of timepoints to sample (minimum 50, capped by what the input has and by max_frames)."""
+        count = min(max(50, self._tr_len()), total_frames)
+        return min(count, max_frames) if max_frames else count
+
+    def _load_sequence(self, source, keep_frames=0, raw_frames=None, max_frames=None):
+        """
+        Samples timepoints and focal planes from an image-sequence source.
+
+        Frames are decoded one timepoint at a time and released after
+        preprocessing, so large exports never sit fully in memory.
+        Returns N x T x P x C x H x W (N=1).
+        """
+        import numpy as np
+
+        planes = source.select_planes()
+        actual_sample_count = self._sample_count(source.frame_count, max_frames)
+        decode_log.info("sequence sampling", extra=fields(timepoints=source.frame_count, focal_planes=source.plane_labels,
+                                                          sampled=actual_sample_count, planes=planes))
+
+        indices = np.linspace(0, source.frame_count - 1, actual_sample_count, dtype=int)
+        keep_positions = set(np.linspace(0, actual_sample_count - 1, min(keep_frames, actual_sample_count), dtype=int)) if keep_frames else set()
+        # Raw frames for the gate come from the plane closest to focus
+        gate_plane = planes.index(min(planes, key=abs))
+
+        frames = []
+        for t, stack in source.read(indices, planes=planes):
+            checkpoint()
+            if len(frames) in keep_positions and raw_frames is not None:
+                raw_frames.append(stack[gate_plane])
+            frames.append(torch.stack([self._preprocess_frame(f) for f in stack]))
+
+        if not frames:
+            decode_log.error("no frames extracted from sequence")
+            return None
+        decode_log.info("sequence extracted", extra=fields(timepoints=len(frames), planes=len(planes)))
+        return torch.stack(frames).unsqueeze(0)
+
     def load_model(self):
         """Loads the torch model using the real source code."""
         if not HAS_TORCH or not HAS_REAL_CODE:
@@ -329,21 +433,10 @@ class EmbryoInference:
         if target_model_path:
             try:
                 args = self._get_args_from_config()
-                self.model = modelBuilder.netBuilder(args)
-                
-                # Load weights
-                state_dict = torch.load(target_model_path, map_location='cpu')
-                # If it was saved with DataParallel, we might need to strip 'module.'
-                if 'module.' in list(state_dict.keys())[0]:
-                    from collections import OrderedDict
-                    new_state_dict = OrderedDict()
-                    for k, v in state_dict.items():
-                        name = k[7:] # remove `module.`
-                        new_state_dict[name] = v
-                    state_dict = new_state_dict
-                
-                self.model.load_state_dict(state_dict)
-                self.model.eval()
+                factory = lambda: modelBuilder.netBuilder(args)
+                # Built on the meta device; the (memory-mapped) weights are assigned, not copied.
+                # DataParallel 'module.' prefixes are stripped by the loader.
+                self.model = load_weights(build_module(factory), target_model_path, factory=factory, name="staging")
                 self.is_mock = False
                 print(f"SUCCESS: Real model loaded for {self.model_id}")
             except Exception as e:
@@ -367,13 +460,10 @@ class EmbryoInference:
                 weights_path = os.path.join(current_dir, "gardner_net_latest.pth")
             
             if os.path.exists(weights_path):
-                # Initialize model architecture
-                self.gardner_model = GardnerNet(pretrained=False, freeze_backbone=False) # Config doesn't matter for eval
-                
-                # Load weights
-                state_dict = torch.load(weights_path, map_location='cpu')
-                self.gardner_model.load_state_dict(state_dict)
-                self.gardner_model.eval()
+                # Initialize model architecture (on the meta device) and assign the weights
+                factory = lambda: GardnerNet(pretrained=False, freeze_backbone=False) # Config doesn't matter for eval
+                self.gardner_model = load_weights(build_module(factory), weights_path, factory=factory, name="gardner")
+                self.gardner_weights_path = weights_path
                 print(f"SUCCESS: GardnerNet loaded from {weights_path}")
             else:
                 print("WARNING: No GardnerNet weights found. Gardner grades will be mock/heuristic.")
@@ -381,6 +471,160 @@ class EmbryoInference:
             print(f"Error loading GardnerNet: {e}")
             self.gardner_model = None
 
+    def _configure_precision(self):
+        """
+        Enables the requested CPU precision mode after a parity check.
+
+        For 'bf16-autocast' the conv trunks are switched to channels-last and a
+        reference batch is run in FP32 and under bfloat16 autocast. The mode is
+        refused (FP32 kept) if argmax agreement drops below PRECISION_MIN_AGREEMENT.
+        """
+        requested = self.precision
+        if requested == "fp32":
+            return
+        if requested not in PRECISION_MODES:
+            print(f"WARNING: Unknown precision '{requested}', using fp32. Options: {PRECISION_MODES}")
+            self.precision = "fp32"
+            self.precision_report = {"requested": requested, "active": "fp32", "reason": "unknown mode"}
+            return
+
+        models = [m for m in (self.model, self.gardner_model) if m is not None]
+        if not models:
+            self.precision = "fp32"
+            return
+
+        reference = self._precision_reference_batch()
+        self.precision = "fp32"
+        fp32_labels = self._reference_labels(reference)
+
+        for m in models:
+            m.to(memory_format=torch.channels_last)
+        self.precision = requested
+        try:
+            reduced_labels = self._reference_labels(reference)
+        except Exception as e:
+            print(f"WARNING: {requested} forward failed ({e}). Staying on fp32.")
+            reduced_labels = None
+
+        total = sum(len(v) for v in fp32_labels.values())
+        matches = 0
+        if reduced_labels is not None:
+            matches = sum(int((fp32_labels[k] == reduced_labels[k]).sum()) for k in fp32_labels)
+        agreement = matches / total if total else 0.0
+
+        self.precision_report = {"requested": requested, "agreement": round(agreement, 4),
+                                 "threshold": PRECISION_MIN_AGREEMENT, "reference_batch": int(reference.shape[0])}
+        if agreement < PRECISION_MIN_AGREEMENT:
+            for m in models:
+                m.to(memory_format=torch.contiguous_format)
+            self.precision = "fp32"
+            self.precision_report["active"] = "fp32"
+            print(f"PRECISION CHECK FAILED: {requested} agreement {agreement:.1%} < {PRECISION_MIN_AGREEMENT:.0%}. Using fp32.")
+        else:
+            self.precision_report["active"] = requested
+            print(f"PRECISION: {requested} enabled (argmax agreement {agreement:.1%} vs fp32)")
+
+    def _configure_compilation(self):
+        """
+        Optional TorchScript serving path (EMBRYO_COMPILE=on): GardnerNet and the
+        staging model for the standard shapes (T=1 images, the video sampling
+        length) are traced, frozen, optimized and warmed up. FP32 only.
+        """
+        from compiled_models import COMPILE_MODE, EXTRA_SHAPES, compile_model
+
+        self.compile_report = {"mode": COMPILE_MODE, "active": False}
+        if COMPILE_MODE not in ("on", "trace"):
+            return
+        if self.precision != "fp32":
+            self.compile_report["reason"] = f"compiled path is fp32-only (active precision {self.precision})"
+            print(f"Compile: skipped, {self.compile_report['reason']}")
+            return
+
+        size = self.img_size
+        gen = torch.Generator().manual_seed(0)
+        if self.gardner_model is not None:
+            self.compiled_gardner = compile_model(
+                self.gardner_model, "gardner", ["expansion", "icm", "te"],
+                torch.randn(1, 3, size, size, generator=gen), weights_path=self.gardner_weights_path,
+                check_inputs=(torch.randn(4, 3, size, size, generator=gen),))
+
+        if self.model is not None:
+            lengths = sorted({1, self._tr_len(), self._sample_count(10 ** 9)} | set(EXTRA_SHAPES))
+            planes = sorted({1, FOCAL_PLANES})
+            for t in lengths:
+                for p in planes:
+                    example = torch.randn(1, t, p, 3, size, size, generator=gen)
+                    compiled = compile_model(self.model, f"staging-{self.model_id}", ["pred"], example,
+                                             weights_path=self._find_model_file())
+                    if compiled is not None:
+                        self.compiled_staging[tuple(example.shape)] = compiled
+
+        self.compile_report.update({
+            "active": bool(self.compiled_gardner or self.compiled_staging),
+            "gardner": self.compiled_gardner is not None,
+            "gardner_batch_dynamic": bool(self.compiled_gardner and self.compiled_gardner.batch_dynamic),
+            "staging_shapes": [list(s) for s in self.compiled_staging],
+        })
+
+    def _precision_reference_batch(self):
+        """Reference images for the parity check: EMBRYO_PRECISION_REF_DIR if set, else seeded noise."""
+        import glob
+        frames = []
+        ref_dir = os.environ.get("EMBRYO_PRECISION_REF_DIR")
+        if ref_dir and os.path.isdir(ref_dir):
+            import cv2
+            for path in sorted(glob.glob(os.path.join(ref_dir, "*")))[:PRECISION_REF_BATCH]:
+                frame = cv2.imread(path)
+                if frame is not None:
+                    frames.append(self._preprocess_frame(frame))
+        if frames:
+            return torch.stack(frames)
+        gen = torch.Generator().manual_seed(0)
+        return torch.randn(PRECISION_REF_BATCH, 3, self.img_size, self.img_size, generator=gen)
+
+    def _reference_labels(self, reference):
+        """Argmax labels of every head on the reference batch under the current precision."""
+        labels = {}
+        if self.gardner_model is not None:
+            outputs = self._run_gardner(reference)
+            for head, logits in outputs.items():
+                labels[f"gardner_{head}"] = torch.argmax(logits, dim=1)
+        if self.model is not None:
+            # Reference frames as one sequence: 1 x T x P x C x H x W
+            pred = self._run_staging(reference.unsqueeze(0).unsqueeze(2))
+            labels["staging"] = torch.argmax(pred[0], dim=1)
+        return labels
+
+    def _autocast(self):
+        """Autocast context for the active precision mode."""
+        import contextlib
+        if self.precision == "bf16-autocast":
+            return torch.autocast(device_type="cpu", dtype=torch.bfloat16)
+        return contextlib.nullcontext()
+
+    def _run_staging(self, work_tensor):
+        """Staging model forward (N x T x P x C x H x W) -> FP32 per-frame logits N x T x Classes."""
+        if self.compiled_staging:
+            compiled = self.compiled_staging.get(tuple(work_tensor.shape))
+            if compiled is not None:
+                with torch.no_grad():
+                    return compiled(work_tensor)['pred'].float()
+            metrics.incr("compile.staging.eager_fallback")
+        with torch.no_grad(), self._autocast():
+            outputs = self.model(work_tensor)
+        return outputs['pred'].float()
+
+    def _run_gardner(self, g_input):
+        """GardnerNet forward (N x C x H x W) -> dict of FP32 head logits."""
+        if self.compiled_gardner is not None and self.compiled_gardner.accepts(g_input):
+            with torch.no_grad():
+                return {k: v.float() for k, v in self.compiled_gardner(g_input).items()}
+        if self.precision == "bf16-autocast":
+            g_input = g_input.contiguous(memory_format=torch.channels_last)
+        with torch.no_grad(), self._autocast():
+            outputs = self.gardner_model(g_input)
+        return {k: v.float() for k, v in outputs.items()}
+
     def get_label_name(self, index):
         """Maps a numeric index to a human-readable embryo stage name."""
         labels = ["tPB2", "tPNa", "tPNf", "t2", "t3", "t4", "t5", "t6", "t7", "t8", "t9+", "tM", "tSB", "tB", "tEB", "tHB"]
@@ -439,7 +683,7 @@ class EmbryoInference:
             "selection of high-potential embryos for successful IVF outcomes - 'choosing the beginning that matters'."
         )
 
-    def predict(self, input_data, day_of_development="Day 5", is_video=False, analysis_type="gardner"):
+    def predict(self, input_data, day_of_development="Day 5", is_video=False, analysis_type="gardner", gardner_timeline=False):
         """Performs prediction based on exclusive clinical pipelines.
         
         Args:
@@ -447,6 +691,8 @@ class EmbryoInference:
             day_of_development: "Day 5", "Day 6", or "Day 7"
             is_video: Boolean, True if source is a time-lapse video
             analysis_type: "gardner" or "morphokinetics"
+            gardner_timeline: Video Gardner only - also grade every sampled frame
+                and return the expansion/ICM/TE timeline
         """
         if not is_video and analysis_type == "morphokinetics":
             raise ValueError("Clinical Error: Morphodynamics unavailable - requires video. Please rerun with Gardner.")
@@ -503,10 +749,6 @@ class EmbryoInference:
             if input_data is None:
                 return {"stage": "N/A", "confidence": "0%", "details": "No input data provided"}
             
-            # Input extraction for Gardner from Video
-            if is_video and analysis_type == "gardner":
-                input_data = self._extract_best_frame(input_data)
-
             # Ensure input is 6D for staging model (N x T x P x C x H x W)
             work_tensor = input_data
             if work_tensor.dim() == 4: # Assume T x C x H x W
@@ -515,8 +757,13 @@ class EmbryoInference:
                 work_tensor = work_tensor.unsqueeze(2)
             
             with torch.no_grad():
-                outputs = self.model(work_tensor)
-                pred = outputs['pred'] 
+                checkpoint()
+                if is_video and self.sequence_batcher is not None and work_tensor.shape[0] == 1:
+                    # Concurrent videos of any length share one staging forward
+                    pred = self.sequence_batcher.run(work_tensor)
+                else:
+                    pred = self._run_staging(work_tensor)
+                checkpoint()
                 last_frame_pred = pred[0, -1]
                 stage_idx = torch.argmax(last_frame_pred).item()
                 stage_name = self.get_label_name(stage_idx)
@@ -527,10 +774,15 @@ class EmbryoInference:
                 gardner = {}
                 milestones = {}
                 if analysis_type == "gardner":
-                    gardner = self._derive_gardner(stage_idx, float(confidence), input_data)
+                    if is_video:
+                        # Grade the sharpest late frame instead of blindly using the last one
+                        gardner = self._derive_gardner_video(input_data, timeline=gardner_timeline)
+                    else:
+                        gardner = self._derive_gardner(stage_idx, float(confidence), input_data)
                     milestones = {"unavailable": True, "reason": "Gardner Mode"}
                 else:
-                    milestones = self._derive_milestones(stage_idx, is_video=is_video, input_data=input_data)
+                    # The last-frame stage is already known: no second staging forward
+                    milestones = self._derive_milestones(stage_idx, is_video=is_video, input_data=None)
                     gardner = {"expansion": "--", "icm": "--", "te": "--"}
 
                 anomalies = self._detect_anomalies(stage_idx, float(confidence), analysis_type)
@@ -552,15 +804,93 @@ class EmbryoInference:
                     "details": f"Model: {self.model_id}\nPipeline: {analysis_type.upper()}"
                 }
         except Exception as e:
-            print(f"Prediction Failed: {e}")
+            log.error("prediction failed", extra=fields(error=str(e)))
             return {"stage": "ERROR", "confidence": "0%", "commentary": f"Neural Failure: {e}"}
 
-    def _extract_best_frame(self, video_tensor):
-        """Extracts the most morphologically clear frame from a video tensor."""
-        if len(video_tensor.shape) == 4: # T, C, H, W
-            return video_tensor[-1].unsqueeze(0)
+    def _timeline_frames(self, video_tensor):
+        """T x C x H x W frames of a video tensor (central focal plane for 6D input)."""
+        if video_tensor.dim() == 6:
+            return video_tensor[0, :, video_tensor.shape[2] // 2]
+        if video_tensor.dim() == 5:
+            return video_tensor[0]
         return video_tensor
 
+    def _focus_scores(self, frames):
+        """
+        Sharpness of every frame (T x C x H x W, normalized) in one vectorized pass:
+        variance of the Laplacian of the luminance.
+        """
+        mean = torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1)
+        std = torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1)
+        rgb = frames.float() * std + mean
+        luma = (rgb * torch.tensor([0.299, 0.587, 0.114]).view(1, 3, 1, 1)).sum(dim=1, keepdim=True)
+        kernel = torch.tensor([[0., 1., 0.], [1., -4., 1.], [0., 1., 0.]]).view(1, 1, 3, 3)
+        lap = torch.nn.functional.conv2d(luma, kernel)
+        return lap.flatten(1).var(dim=1)
+
+    def _extract_best_frame(self, video_tensor, top_k=None):
+        """
+        Extracts the most morphologically clear frame from a video tensor.
+
+        Candidates are the top_k sharpest frames within the last
+        BEST_FRAME_WINDOW of the timeline (grading targets the most developed
+        blastocyst). Returns (candidate indices, focus scores of all frames).
+        """
+        frames = self._timeline_frames(video_tensor)
+        with torch.no_grad():
+            focus = self._focus_scores(frames)
+        t = frames.shape[0]
+        window_start = min(t - 1, int(t * (1.0 - BEST_FRAME_WINDOW)))
+        k = min(top_k or BEST_FRAME_TOPK, t - window_start)
+        candidates = (torch.topk(focus[window_start:], k).indices + window_start).tolist()
+        return candidates, focus
+
+    def _gardner_logits(self, frames, indices=None):
+        """GardnerNet logits for selected frames (default all), in bounded chunks."""
+        indices = list(range(frames.shape[0])) if indices is None else list(indices)
+        chunks = []
+        for start in range(0, len(indices), GARDNER_CHUNK):
+            checkpoint()
+            chunks.append(self._run_gardner(frames[indices[start:start + GARDNER_CHUNK]]))
+        return {k: torch.cat([c[k] for c in chunks]) for k in chunks[0]}
+
+    def _derive_gardner_video(self, video_tensor, timeline=False):
+        """
+        Gardner grades for a time-lapse: sharpness-ranked candidate frames are graded
+        in one batch and the most confident candidate is reported. With `timeline`,
+        every sampled frame is graded (chunked) and the per-frame grades returned.
+        """
+        if self.gardner_model is None:
+            return self._derive_gardner(0, 0.0, None)
+        try:
+            frames = self._timeline_frames(video_tensor)
+            candidates, focus = self._extract_best_frame(video_tensor)
+
+            outputs = self._gardner_logits(frames, None if timeline else candidates)
+            rows = candidates if timeline else list(range(len(candidates)))
+            top = torch.stack([torch.softmax(outputs[k], dim=1).max(dim=1).values for k in ('expansion', 'icm', 'te')]).mean(dim=0)
+
+            # Most confident candidate; sharper frame breaks ties
+            best_pos = max(range(len(candidates)), key=lambda i: (round(float(top[rows[i]]), 3), float(focus[candidates[i]])))
+            best_frame = candidates[best_pos]
+            gardner = self._grades_from_outputs(outputs, rows[best_pos])
+            gardner["best_frame_index"] = int(best_frame)
+            gardner["focus_score"] = round(float(focus[best_frame]), 4)
+            gardner["grade_confidence"] = round(float(top[rows[best_pos]]), 4)
+            gardner["candidate_frames"] = [int(c) for c in candidates]
+
+            if timeline:
+                gardner["timeline"] = [
+                    {"frame": i, "focus": round(float(focus[i]), 4),
+                     **{k: v for k, v in self._grades_from_outputs(outputs, i).items() if k in ("expansion", "icm", "te")}}
+                    for i in range(frames.shape[0])
+                ]
+            return gardner
+        except Exception as e:
+            log.error("gardner inference failed", extra=fields(error=str(e)))
+            return {"expansion": "ERR", "icm": "Error", "te": str(e)[:5],
+                    "cell_count": "--", "cavity_symmetry": "--", "fragmentation": "--"}
+
 
     def _derive_gardner(self, stage_idx, confidence, input_tensor=None):
         """Returns Gardner grades (Expansion, ICM, TE) and derived KPIs using the real model if available."""
@@ -579,7 +909,8 @@ class EmbryoInference:
             # Image: [1, 1, 3, 224, 224] (5D)
             # Video: [1, T, 3, 224, 224] (5D) or possibly [1, T, 1, 3, 224, 224] (6D)
             
-            print(f"DEBUG Gardner: input_tensor.dim()={input_tensor.dim()}, shape={input_tensor.shape}")
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("gardner input", extra=fields(dim=input_tensor.dim(), shape=list(input_tensor.shape)))
             
             if input_tensor.dim() == 6:
                 # [1, T, 1, 3, 224, 224] -> select last frame [1, 3, 224, 224]
@@ -595,47 +926,72 @@ class EmbryoInference:
                         "cell_count": "--", "cavity_symmetry": "--", "fragmentation": "--"}
             
             with torch.no_grad():
-                outputs = self.gardner_model(g_input)
-                
-                # Expansion (1-5 or more, higher = more expanded)
-                exp_idx = torch.argmax(outputs['expansion'], dim=1).item()
-                exp_grade = str(exp_idx + 1)
-                
-                # ICM (Inner Cell Mass quality)
-                icm_idx = torch.argmax(outputs['icm'], dim=1).item()
-                icm_map = {0: 'A', 1: 'B', 2: 'C', -1: 'N/A'}
-                icm_grade = icm_map.get(icm_idx, '?')
-                
-                # TE (Trophectoderm quality)
-                te_idx = torch.argmax(outputs['te'], dim=1).item()
-                te_grade = icm_map.get(te_idx, '?')
-                
-                # Cell Count: Deterministic clinical correlation
-                cell_count_map = {0: 60, 1: 80, 2: 100, 3: 130, 4: 160}
-                cell_count = cell_count_map.get(exp_idx, 100)
-                
-                # Cavity Symmetry: Deterministic based on expansion + TE grade
-                symmetry_base = {0: 95, 1: 85, 2: 70}  # A, B, C
-                symmetry_val = symmetry_base.get(te_idx, 80)
-                
-                # Fragmentation: Deterministic based on ICM quality
-                frag_map = {0: "<5%", 1: "10%", 2: "25%"}
-                fragmentation = frag_map.get(icm_idx, "10%")
-                
-                return {
-                    "expansion": exp_grade, 
-                    "icm": icm_grade, 
-                    "te": te_grade,
-                    "cell_count": str(cell_count),
-                    "cavity_symmetry": f"{symmetry_val}%",
-                    "fragmentation": fragmentation
-                }
+                outputs = self._run_gardner(g_input)
+                return self._grades_from_outputs(outputs, 0)
         
         except Exception as e:
-            print(f"Gardner Inference Failed: {e}")
+            log.error("gardner inference failed", extra=fields(error=str(e)))
             return {"expansion": "ERR", "icm": "Error", "te": str(e)[:5],
                     "cell_count": "--", "cavity_symmetry": "--", "fragmentation": "--"}
 
+    def _grades_from_outputs(self, outputs, row=0):
+        """Maps GardnerNet head logits (row `row` of the batch) to grades and derived KPIs."""
+        # Expansion (1-5 or more, higher = more expanded)
+        exp_idx = torch.argmax(outputs['expansion'][row]).item()
+        exp_grade = str(exp_idx + 1)
+        
+        # ICM (Inner Cell Mass quality)
+        icm_idx = torch.argmax(outputs['icm'][row]).item()
+        icm_map = {0: 'A', 1: 'B', 2: 'C', -1: 'N/A'}
+        icm_grade = icm_map.get(icm_idx, '?')
+        
+        # TE (Trophectoderm quality)
+        te_idx = torch.argmax(outputs['te'][row]).item()
+        te_grade = icm_map.get(te_idx, '?')
+        
+        # Cell Count: Deterministic clinical correlation
+        cell_count_map = {0: 60, 1: 80, 2: 100, 3: 130, 4: 160}
+        cell_count = cell_count_map.get(exp_idx, 100)
+        
+        # Cavity Symmetry: Deterministic based on expansion + TE grade
+        symmetry_base = {0: 95, 1: 85, 2: 70}  # A, B, C
+        symmetry_val = symmetry_base.get(te_idx, 80)
+        
+        # Fragmentation: Deterministic based on ICM quality
+        frag_map = {0: "<5%", 1: "10%", 2: "25%"}
+        fragmentation = frag_map.get(icm_idx, "10%")
+        
+        return {
+            "expansion": exp_grade, 
+            "icm": icm_grade, 
+            "te": te_grade,
+            "cell_count": str(cell_count),
+            "cavity_symmetry": f"{symmetry_val}%",
+            "fragmentation": fragmentation
+        }
+
+    def grade_batch(self, g_input, return_outputs=False):
+        """
+        Grades a batch of embryo crops (B x C x H x W) in ONE GardnerNet forward.
+
+        Returns one grade dict per crop, each with a 'grade_confidence' (mean of
+        the three heads' top softmax probability). With return_outputs, returns
+        (grades, raw head logits) so callers can keep the logits without a
+        second forward.
+        """
+        if self.gardner_model is None:
+            grades = [{"expansion": "NO MODEL", "icm": "Check Logs", "te": "N/A"} for _ in range(len(g_input))]
+            return (grades, None) if return_outputs else grades
+        outputs = self._run_gardner(g_input)
+        top = torch.stack([torch.softmax(outputs[k], dim=1).max(dim=1).values for k in ('expansion', 'icm', 'te')])
+        confidence = top.mean(dim=0)
+        grades = []
+        for row in range(g_input.shape[0]):
+            g = self._grades_from_outputs(outputs, row)
+            g["grade_confidence"] = round(float(confidence[row]), 4)
+            grades.append(g)
+        return (grades, outputs) if return_outputs else grades
+
     def _derive_milestones(self, stage_idx, is_video=False, input_data=None):
         """Morphokinetic timestamps (hpi) based on detected embryo stages.
         
@@ -663,8 +1019,8 @@ class EmbryoInference:
         # Stage indices mapping
         # labels = ["tPB2", "tPNa", "tPNf", "t2", "t3", "t4", "t5", "t6", "t7", "t8", "t9+", "tM", "tSB", "tB", "tEB", "tHB"]
         # Indices:  0       1       2       3     4     5     6     7     8     9     10     11    12    13    14    15
-        stage_milestone_map = {3: "t2", 4: "t3", 6: "t5", 9: "t8", 11: "tM", 13: "tB", 14: "tEB"}
-        
+        stage_milestone_map = MILESTONE_STAGES
+
         milestones = {}
         final_detected_stage = stage_idx  # The last detected stage from the model
         
@@ -676,17 +1032,19 @@ class EmbryoInference:
                     if work_tensor.dim() == 5:
                         work_tensor = work_tensor.unsqueeze(2)
                     
-                    outputs = self.model(work_tensor)
-                    pred = outputs['pred'][0]  # T x Classes
+                    pred = self._run_staging(work_tensor)[0]  # T x Classes
                     
                     # Get the final stage (last frame prediction)
                     sequence_stages = torch.argmax(pred, dim=1).cpu().numpy()
                     final_detected_stage = int(sequence_stages[-1])
                     
-                    print(f"Sequence analysis: Detected stages {sequence_stages[:5]}...{sequence_stages[-5:]}. Final stage: {final_detected_stage}")
+                    if log.isEnabledFor(logging.DEBUG):
+                        log.debug("sequence stages", extra=fields(first=sequence_stages[:5].tolist(),
+                                                                  last=sequence_stages[-5:].tolist()))
+                    log.info("sequence analysis", extra=fields(final_stage=final_detected_stage))
                     
             except Exception as e:
-                print(f"Sequence inference failed, using stage_idx={stage_idx}: {e}")
+                log.warning("sequence inference failed", extra=fields(stage_idx=stage_idx, error=str(e)))
                 final_detected_stage = stage_idx
         
         # Derive milestones based on detected stage using clinical references
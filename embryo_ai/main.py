@@ -1,15 +1,37 @@
 import os
+import uuid
 import uvicorn
 import asyncio
 import asyncio
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request, Response
+from fastapi.responses import FileResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List
+from typing import List, Optional
 from pydantic import BaseModel
-try:
-    from service import ai_service
-except ImportError:
-    ai_service = None
+import simulation
+from simulation import generate_mock_result
+if simulation.SIMULATION_MODE == "replay":
+    # Capacity testing without weights: recorded resource profiles replayed through the real scheduler
+    ai_service = simulation.SimulatedService()
+else:
+    try:
+        from service import ai_service
+    except ImportError:
+        ai_service = None
+from process_memory import worker_memory_report
+from runtime_config import applied_settings
+import metrics
+from content_cache import sha256_bytes
+from sequence_ingest import tiff_timepoints
+from result_store import get_store
+from scheduler import get_scheduler, JobCancelled, QueueFull
+from memory_guard import memory_status
+import raw_ingest
+import transcode
+import structured_log
+from structured_log import fields
+
+log = structured_log.get_logger("api")
 
 app = FastAPI(title="EMprion AI Brain (Simulation Mode)")
 
@@ -21,6 +43,18 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def request_context(request: Request, call_next):
+    """Request id for every log line of the request (client-supplied X-Request-ID is kept)."""
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex[:16]
+    token = structured_log.set_request_id(request_id)
+    try:
+        response = await call_next(request)
+    finally:
+        structured_log.reset_request_id(token)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
 class AnalysisResult(BaseModel):
     stage: str
     confidence: str
@@ -31,61 +65,156 @@ class AnalysisResult(BaseModel):
     anomalies: List[str]
     concordance: dict
     analysis_type: str
-
-def generate_mock_result(analysis_type: str) -> dict:
-    # DETERMINISTIC CLINICAL BENCHMARKS (Non-Random for Compliance)
-    if analysis_type == "gardner":
-        return {
-            "stage": "Blastocyst (SIMULATED)",
-            "confidence": "94.20%",
-            "commentary": "NOTICE: This is a deterministic reference result used for system verification only. Not for clinical use.",
-            "action": "SYSTEM TEST IN PROGRESS",
-            "gardner": {
-                "expansion": "4",
-                "icm": "A",
-                "te": "A",
-                "cell_count": "120",
-                "cavity_symmetry": "95%",
-                "fragmentation": "<5%"
-            },
-            "milestones": {"unavailable": True, "reason": "Choice: Gardner Mode"},
-            "anomalies": ["None detected (Safe zone)"],
-            "concordance": {"AI_Confidence": 0.94, "Historical_Match": 0.92},
-            "analysis_type": "gardner"
-        }
-    else: # morphokinetics
-        return {
-            "stage": "Expanded Blastocyst (tEB)",
-            "confidence": "91.50%",
-            "commentary": "Kinematic alignment matches clinical developmental benchmarks.",
-            "action": "Valid for vitrification / transfer",
-            "gardner": {"expansion": "4", "icm": "A", "te": "A"},
-            "milestones": {
-                "t2": "26.5h", "t3": "37.0h", "t5": "48.5h", "t8": "54.0h",
-                "tM": "93.0h", "tB": "105.0h", "tEB": "118.0h", "s3": "10.5h"
-            },
-            "anomalies": ["Synchronous cleavage verified."],
-            "concordance": {"AI_Confidence": 0.94, "Literature_Match": 0.91},
-            "analysis_type": "morphokinetics"
-        }
+    result_id: Optional[str] = None
 
 @app.get("/")
 async def root():
     return {
         "status": "online",
         "model": "Subhag Embryon v3",
-        "mode": "Simulation (STABLE)",
+        "mode": "Capacity Simulation (replay)" if getattr(ai_service, "simulated", False) else "Simulation (STABLE)",
         "diagnostics": {"port": 8000, "cwd": os.getcwd()}
     }
 
+@app.get("/api/diagnostics/memory")
+async def memory_diagnostics():
+    """Per-worker unique vs shared RSS (shared = weight pages inherited from the preload parent) and memory budgets."""
+    parent = os.getenv("EMBRYO_PRELOAD_PARENT")
+    report = worker_memory_report(int(parent) if parent else None)
+    report["budget"] = memory_status()
+    return report
+
+@app.get("/api/diagnostics/runtime")
+async def runtime_diagnostics():
+    """Thread/worker topology applied at startup (from tune_runtime.py) and model precision."""
+    report = applied_settings()
+    if ai_service:
+        report["models"] = ai_service.diagnostics()
+    return report
+
+@app.get("/api/metrics")
+async def pipeline_metrics():
+    """Pipeline counters and summaries (gate cascade tiers, latencies...)."""
+    report = metrics.snapshot()
+    if ai_service:
+        report.update(ai_service.metrics())
+    report["scheduler"] = get_scheduler().stats()
+    return report
+
+async def _schedule(request, fn, *args, priority, deadline=None, **kwargs):
+    """
+    Runs an AIService call through the scheduler, cancelling it if the client
+    disconnects. Cancellation and overload map to HTTP errors.
+    """
+    try:
+        return await get_scheduler().run(fn, *args, priority=priority, deadline=deadline,
+                                         is_disconnected=request.is_disconnected if request is not None else None,
+                                         **kwargs)
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=f"{e}. Please retry shortly.")
+    except JobCancelled as e:
+        if e.reason == "deadline exceeded":
+            raise HTTPException(status_code=504, detail="Analysis deadline exceeded. Analysis stopped.")
+        # 499: client closed the request (nobody is listening for the body)
+        raise HTTPException(status_code=499, detail=f"Analysis cancelled ({e.reason}).")
+
+def _store_result(result, file_bytes, patient_id, cycle_id, embryo_id, content_hash=None):
+    """Queues a result for the cohort store; storage problems never fail the analysis."""
+    try:
+        return get_store().record(result, content_hash or sha256_bytes(file_bytes), ai_service.model_version(),
+                                  patient_id=patient_id, cycle_id=cycle_id, embryo_id=embryo_id)
+    except Exception as e:
+        log.error("failed to queue result", extra=fields(error=str(e)))
+        return None
+
+@app.get("/api/results/{result_id}")
+async def get_result(result_id: str):
+    """A stored analysis result."""
+    record = get_store().get(result_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Result not found")
+    return record
+
+@app.get("/api/results/{result_id}/heatmap")
+async def result_heatmap(request: Request, result_id: str, target: str = "expansion"):
+    """
+    Saliency heatmap (PNG) for a stored result: Grad-CAM for the Gardner heads
+    (target=expansion|icm|te) or input saliency for the staging model
+    (target=staging). Computed on first request from the analysis input, then cached.
+    """
+    record = get_store().get(result_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Result not found")
+    if not ai_service:
+        raise HTTPException(status_code=503, detail="AI Engine offline")
+    result = await _schedule(request, ai_service.heatmap, record["content_hash"], target, priority="image")
+    if "error" in result:
+        raise HTTPException(status_code=result.get("status", 400), detail=result["error"])
+    return Response(content=result["png"], media_type="image/png",
+                    headers={"Cache-Control": "private, max-age=86400"})
+
+@app.get("/api/results/{result_id}/media/{kind}")
+async def result_media(result_id: str, kind: str):
+    """
+    Browser media for a stored time-lapse result: proxy (H.264 MP4), sprite
+    (scrubbing thumbnails) + sprite.json (tile map), poster. Made in the
+    background after the analysis; 202 while still pending.
+    """
+    if kind not in transcode.MEDIA_KINDS:
+        raise HTTPException(status_code=400, detail=f"Unknown media '{kind}'. Options: {list(transcode.MEDIA_KINDS)}")
+    record = get_store().get(result_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Result not found")
+    status = transcode.get_transcoder().status(record["content_hash"])
+    if status == "pending":
+        return JSONResponse({"status": "pending"}, status_code=202)
+    if status != "ready":
+        raise HTTPException(status_code=404, detail="No media for this result")
+    name, media_type = transcode.MEDIA_KINDS[kind]
+    return FileResponse(os.path.join(transcode.media_dir(record["content_hash"]), name), media_type=media_type,
+                        headers={"Cache-Control": "private, max-age=86400"})
+
+@app.get("/api/cohorts/ranking")
+async def cohort_ranking(patient_id: Optional[str] = None, cycle_id: Optional[str] = None,
+                         analysis_type: Optional[str] = None, min_expansion: Optional[int] = None,
+                         icm: Optional[str] = None, te: Optional[str] = None,
+                         limit: int = 50, cursor: Optional[str] = None):
+    """
+    Ranks stored embryos by viability score (best first).
+
+    Grade filters take comma-separated grades (icm=A,B). Pass `next_cursor`
+    from a page as `cursor` to fetch the next one.
+    """
+    try:
+        return get_store().rank(
+            patient_id=patient_id, cycle_id=cycle_id, analysis_type=analysis_type,
+            min_expansion=min_expansion,
+            icm=[g.strip().upper() for g in icm.split(",")] if icm else None,
+            te=[g.strip().upper() for g in te.split(",")] if te else None,
+            limit=limit, cursor=cursor,
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 @app.post("/api/predict", response_model=AnalysisResult)
-async def predict(file: UploadFile = File(...), analysis_type: str = "gardner"):
+async def predict(request: Request, file: UploadFile = File(...), analysis_type: str = "gardner", timeline: bool = False,
+                  patient_id: Optional[str] = None, cycle_id: Optional[str] = None, embryo_id: Optional[str] = None,
+                  deadline: Optional[float] = None, milestones: str = "reference",
+                  frame_interval_minutes: Optional[float] = None, first_frame_hpi: Optional[float] = None):
+    # `deadline`: seconds this analysis may take (default per priority class); 0 disables it
+    # `milestones=adaptive`: measured milestone times (coarse-to-fine transition search) instead of reference values
     # Determine if input is video
     content_type = file.content_type or ""
-    is_video = content_type.startswith("video/") or file.filename.lower().endswith(('.mp4', '.avi', '.mov'))
+    filename = file.filename.lower()
+    is_video = content_type.startswith("video/") or filename.endswith(('.mp4', '.avi', '.mov'))
+    file_bytes = await file.read()
+    # Time-lapse exports (zip of per-timepoint frames, multi-page TIFF) also qualify for morphokinetics;
+    # a single-timepoint TIFF is a still and stays on the image path
+    is_timelapse = (is_video or filename.endswith('.zip')
+                    or (filename.endswith(('.tif', '.tiff')) and tiff_timepoints(file_bytes) > 1))
 
     # ENFORCE CLINICAL RULE: No Morphokinetics for Images
-    if not is_video and analysis_type == "morphokinetics":
+    if not is_timelapse and analysis_type == "morphokinetics":
         raise HTTPException(
             status_code=400, 
             detail="Clinical Logic Violation: Morphokinetic analysis requires time-lapse video data. Static images only support Gardner grading."
@@ -94,22 +223,30 @@ async def predict(file: UploadFile = File(...), analysis_type: str = "gardner"):
     # Use AI Service if available
     if ai_service:
         try:
-            file_bytes = await file.read()
-            if analysis_type == "gardner":
-                result = ai_service.predict_gardner(file_bytes)
+            # Time-lapse work runs in the "video" class so it never blocks image grading
+            if analysis_type == "gardner" and is_timelapse:
+                # Best-frame grading; `timeline` adds per-frame expansion/ICM/TE
+                result = await _schedule(request, ai_service.predict_gardner_video, file_bytes, file.filename,
+                                         timeline=timeline, priority="video", deadline=deadline)
+            elif analysis_type == "gardner":
+                result = await _schedule(request, ai_service.predict_gardner, file_bytes,
+                                         priority="image", deadline=deadline)
             else:
-                result = ai_service.predict_morphokinetics(file_bytes, file.filename)
+                result = await _schedule(request, ai_service.predict_morphokinetics, file_bytes, file.filename,
+                                         milestone_mode=milestones, frame_interval_minutes=frame_interval_minutes,
+                                         first_frame_hpi=first_frame_hpi, priority="video", deadline=deadline)
             
             if result and "error" in result:
                 # MANDATORY CLINICAL REJECTION: Stop immediately.
                 raise HTTPException(status_code=400, detail=result["error"])
             
             if result:
+                result["result_id"] = _store_result(result, file_bytes, patient_id, cycle_id, embryo_id)
                 return result
         except HTTPException as he:
             raise he
-        except Exception as e:
-            print(f"CRITICAL: AI Service Exception: {e}")
+        except Exception:
+            log.exception("AI service exception")
             if os.getenv("ALLOW_SIMULATION", "false").lower() != "true":
                 raise HTTPException(status_code=500, detail="Clinical Engine Failure. Analysis blocked for safety.")
     
@@ -123,6 +260,96 @@ async def predict(file: UploadFile = File(...), analysis_type: str = "gardner"):
         detail="Clinical Safety Lock: AI Engine (CLIP/Inference) is offline. Simulated data is disabled in this environment."
     )
 
+@app.post("/api/predict/multi")
+async def predict_multi(request: Request, file: UploadFile = File(...), patient_id: Optional[str] = None,
+                        cycle_id: Optional[str] = None, embryo_id: Optional[str] = None,
+                        deadline: Optional[float] = None):
+    """Gardner grading for every embryo in a dish / multi-well image or time-lapse video."""
+    if not ai_service:
+        raise HTTPException(
+            status_code=500,
+            detail="Clinical Safety Lock: AI Engine (CLIP/Inference) is offline. Simulated data is disabled in this environment."
+        )
+    try:
+        file_bytes = await file.read()
+        is_video = os.path.splitext(file.filename or "")[1].lower() in ('.mp4', '.avi', '.mkv', '.mov', '.webm')
+        result = await _schedule(request, ai_service.predict_gardner_multi, file_bytes, file.filename,
+                                 priority="video" if is_video else "image", deadline=deadline)
+    except HTTPException:
+        raise
+    except Exception:
+        log.exception("AI service exception")
+        raise HTTPException(status_code=500, detail="Clinical Engine Failure. Analysis blocked for safety.")
+    if "error" in result:
+        raise HTTPException(status_code=400, detail=result["error"])
+    # One stored row per embryo; ids are "<embryo_id>-<index>" (index alone if no prefix given)
+    for embryo in result["embryos"]:
+        entry = {"analysis_type": "gardner", "stage": "Blastocyst Evaluation (multi-embryo)", **embryo}
+        suffix = str(embryo["embryo_index"])
+        embryo["result_id"] = _store_result(entry, file_bytes, patient_id, cycle_id,
+                                            f"{embryo_id}-{suffix}" if embryo_id else suffix)
+    return result
+
+async def _analyze_raw(header, frames, payload, request=None):
+    """Analysis of one raw frame message (HTTP body or Unix socket), stored like an upload."""
+    if not ai_service:
+        raise HTTPException(status_code=503, detail="AI Engine offline")
+    # Hashing a large payload would stall the event loop; hashlib releases the GIL
+    content_hash = await asyncio.to_thread(sha256_bytes, payload)
+    result = await _schedule(request, ai_service.predict_raw, frames, header, content_hash,
+                             priority="video" if frames.shape[0] > 1 else "image", deadline=header.get("deadline"))
+    if "error" in result:
+        raise HTTPException(status_code=400, detail=result["error"])
+    result["result_id"] = _store_result(result, None, header.get("patient_id"), header.get("cycle_id"),
+                                        header.get("embryo_id"), content_hash=content_hash)
+    return result
+
+@app.post("/api/ingest/raw", response_model=AnalysisResult)
+async def ingest_raw(request: Request):
+    """
+    Analysis of pre-decoded uint8 frames sent by an instrument integration
+    (application/octet-stream body in the raw_ingest message format; no
+    image/video codec involved). Patient/cycle/embryo ids travel in the header.
+    """
+    # Same size cap as the Unix socket, enforced before the body is buffered
+    too_large = HTTPException(status_code=413, detail=f"Message larger than {raw_ingest.MAX_MESSAGE_MB:.0f} MB")
+    try:
+        declared = int(request.headers.get("content-length", "0"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid Content-Length")
+    if declared > raw_ingest.MAX_MESSAGE_BYTES:
+        raise too_large
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > raw_ingest.MAX_MESSAGE_BYTES:
+            raise too_large
+    metrics.observe("raw_ingest.http.bytes", len(body))
+    try:
+        header, frames, payload = raw_ingest.parse_message(body)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        return await _analyze_raw(header, frames, payload, request)
+    except HTTPException:
+        raise
+    except Exception:
+        log.exception("AI service exception")
+        raise HTTPException(status_code=500, detail="Clinical Engine Failure. Analysis blocked for safety.")
+
+@app.on_event("startup")
+async def start_raw_socket():
+    # serve.py binds the socket once in the parent and hands workers the descriptor
+    inherited = os.getenv("EMBRYO_RAW_SOCKET_FD")
+    if inherited:
+        import socket
+        sock = socket.socket(fileno=int(inherited))
+    elif raw_ingest.SOCKET_PATH:
+        sock = raw_ingest.listening_socket(raw_ingest.SOCKET_PATH)
+    else:
+        return
+    app.state.raw_socket_server = await raw_ingest.serve_unix(sock, _analyze_raw)
+
 if __name__ == "__main__":
     # Hardcoded port 8000 was proven to work in ultrasound check
     print(f"📡 SIMULATION STARTING: Binding to 0.0.0.0:8000")
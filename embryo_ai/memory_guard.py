@@ -0,0 +1,388 @@
+"""
+Per-Request Memory Accounting and Guardrails
+
+A single oversized upload (8K frames, thousands of timepoints, a large tr_len)
+can push a worker into the OOM killer and take every in-flight request with
+it. Before any decoding, each request gets a memory plan:
+
+  1. probe     - resolution / frame count / planes from container headers only
+  2. estimate  - peak MB from the upload size, the decode buffers and the
+                 planned N x T x P x C x H x W tensor plus model activations
+  3. enforce   - over the per-request budget: downsample (fewer sampled
+                 timepoints, reduced-resolution image decode) or reject;
+                 over the global budget: queue until in-flight requests
+                 release their reservation (or reject after a timeout)
+
+Actual peak RSS per pipeline stage is sampled from /proc/self/statm and
+reported in metrics next to the estimate.
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+import simulation
+from process_memory import process_memory
+from scheduler import checkpoint
+
+MB = 1024 * 1024
+
+# Per-request budget (MB); 0 = no per-request limit
+REQUEST_BUDGET_MB = float(os.getenv("EMBRYO_MEM_REQUEST_MB", "2048"))
+# Budget shared by all in-flight requests of this worker (MB); 0 = derived from the memory limit
+GLOBAL_BUDGET_MB = float(os.getenv("EMBRYO_MEM_GLOBAL_MB", "0"))
+# Share of the container / machine memory usable for request working sets (auto budget)
+GLOBAL_BUDGET_FRACTION = float(os.getenv("EMBRYO_MEM_GLOBAL_FRACTION", "0.75"))
+# How long a request may wait for global budget before it is rejected
+ADMIT_TIMEOUT = float(os.getenv("EMBRYO_MEM_ADMIT_TIMEOUT", "120"))
+# How often the auto budget is re-measured (caches and lazy models grow after startup)
+BUDGET_REFRESH_SECONDS = float(os.getenv("EMBRYO_MEM_BUDGET_REFRESH", "30"))
+SAMPLE_INTERVAL = float(os.getenv("EMBRYO_MEM_SAMPLE_INTERVAL", "0.01"))
+
+# Inference working-set coefficients (FP32, 224 px input), measured on CPU
+STAGING_MB_PER_FRAME = float(os.getenv("EMBRYO_MEM_STAGING_MB_PER_FRAME", "12"))
+GARDNER_MB_PER_FRAME = float(os.getenv("EMBRYO_MEM_GARDNER_MB_PER_FRAME", "40"))
+# Reduced-resolution decode factors supported by cv2.IMREAD_REDUCED_*
+IMAGE_REDUCTIONS = (1, 2, 4, 8)
+
+
+class MemoryBudgetExceeded(Exception):
+    pass
+
+
+# ---- limits ---------------------------------------------------------------
+
+def _read_int(path):
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+        return None if value == "max" else int(value)
+    except (OSError, ValueError):
+        return None
+
+
+def memory_limit_mb():
+    """Container (cgroup v2/v1) memory limit, else physical memory."""
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        value = _read_int(path)
+        if value and value < (1 << 60):
+            return value / MB
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def current_rss_mb():
+    """Resident set size of this process from /proc/self/statm (cheap enough to sample)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / MB
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+def resident_baseline_mb(workers=1):
+    """
+    Memory this worker already holds, charged against its share of the limit.
+
+    Under serve.py every worker's RSS includes the model pages it shares with
+    the preload parent, which are resident only once: a worker is charged its
+    private pages plus 1/workers of the parent's RSS. Plain RSS otherwise.
+    """
+    parent = os.getenv("EMBRYO_PRELOAD_PARENT")
+    if parent and parent.isdigit() and int(parent) != os.getpid():
+        mine, shared = process_memory(), process_memory(int(parent))
+        if mine.get("available") and shared.get("available"):
+            return mine["unique_mb"] + shared["rss_mb"] / workers
+    return current_rss_mb()
+
+
+# ---- estimation -----------------------------------------------------------
+
+class MemoryPlan:
+    """Probed input geometry, the chosen sampling and the estimated peak."""
+
+    def __init__(self, kind, width, height, frames, planes=1):
+        self.kind = kind            # "image", "video" or "sequence"
+        self.width, self.height = width, height
+        self.frames = frames        # timepoints available in the input
+        self.planes = planes
+        self.max_frames = None      # sampled timepoints (None = pipeline default)
+        self.reduction = 1          # image decode reduction factor
+        self.estimate_mb = 0.0
+        self.downsampled = False
+
+    def as_dict(self):
+        return {"kind": self.kind, "width": self.width, "height": self.height, "frames": self.frames,
+                "planes": self.planes, "max_frames": self.max_frames, "reduction": self.reduction,
+                "estimate_mb": round(self.estimate_mb, 1), "downsampled": self.downsampled}
+
+
+def probe_input(path):
+    """
+    Input geometry from headers only (no frame decode).
+
+    Returns:
+        MemoryPlan, or None if the input can't be probed
+    """
+    from sequence_ingest import is_sequence_path, open_sequence
+
+    if is_sequence_path(path):
+        source = open_sequence(path)
+        if source is not None:
+            try:
+                planes = source.select_planes()
+                first = next(source.read([0], planes=planes), None)
+                h, w = first[1][0].shape[:2] if first else (0, 0)
+                return MemoryPlan("sequence", w, h, source.frame_count, len(planes))
+            finally:
+                source.release()
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".mp4", ".avi", ".mkv", ".mov", ".webm"):
+        import cv2
+        cap = cv2.VideoCapture(path)
+        try:
+            return MemoryPlan("video", int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                              int(cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+        finally:
+            cap.release()
+
+    try:
+        from PIL import Image
+        with Image.open(path) as img:  # lazy: reads the header only
+            return MemoryPlan("image", img.width, img.height, 1)
+    except Exception:
+        return None
+
+
+def probe_image_bytes(image_bytes):
+    """Image geometry from encoded bytes (header only)."""
+    import io
+    from PIL import Image
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            return MemoryPlan("image", img.width, img.height, 1)
+    except Exception:
+        return None
+
+
+def estimate_mb(plan, upload_bytes, img_size, sampled_frames, keep_frames=0, gardner_frames=1):
+    """
+    Estimated peak working set of one request.
+
+    Terms: the upload (request body + service copy), decode buffers (one
+    frame in flight + the raw frames kept for the gate), the preprocessed
+    frame list and its stacked N x T x P x C x H x W copy, and model
+    activations for the staging and Gardner forwards.
+    """
+    raw_frame = plan.width * plan.height * 3 / (plan.reduction ** 2)
+    tensor = sampled_frames * plan.planes * 3 * img_size * img_size * 4
+    activation_scale = (img_size / 224.0) ** 2
+    total = (
+        2 * upload_bytes
+        + (1 + keep_frames) * raw_frame
+        + 2 * tensor
+    ) / MB
+    total += sampled_frames * plan.planes * STAGING_MB_PER_FRAME * activation_scale
+    total += gardner_frames * GARDNER_MB_PER_FRAME * activation_scale
+    return total
+
+
+def plan_request(plan, upload_bytes, img_size, sample_count, min_frames=2, keep_frames=0, gardner_frames=1):
+    """
+    Fits a request into the per-request budget.
+
+    Time-lapse input: the number of sampled timepoints is reduced until the
+    estimate fits (never below `min_frames`). Images: decoded at 1/2, 1/4 or
+    1/8 resolution. Raises MemoryBudgetExceeded if nothing fits.
+
+    Args:
+        sample_count: callable(total_frames, cap) -> timepoints the pipeline would sample
+    """
+    def estimate(frames):
+        return estimate_mb(plan, upload_bytes, img_size, frames, keep_frames, min(gardner_frames, frames))
+
+    frames = sample_count(plan.frames, None) if plan.kind != "image" else 1
+    plan.estimate_mb = estimate(frames)
+    budget = REQUEST_BUDGET_MB
+    if budget <= 0 or plan.estimate_mb <= budget:
+        return plan
+
+    if plan.kind == "image":
+        for reduction in IMAGE_REDUCTIONS[1:]:
+            plan.reduction = reduction
+            plan.estimate_mb = estimate(1)
+            if plan.estimate_mb <= budget:
+                plan.downsampled = True
+                metrics.incr("memory.downsampled.image")
+                return plan
+    else:
+        # Largest timepoint count that fits: the estimate is linear in frames
+        per_frame = estimate(frames) - estimate(frames - 1) if frames > 1 else 0
+        if per_frame > 0:
+            fit = int(frames - (plan.estimate_mb - budget) / per_frame)
+            if fit >= min_frames:
+                plan.max_frames = fit
+                plan.estimate_mb = estimate(sample_count(plan.frames, fit))
+                plan.downsampled = True
+                metrics.incr(f"memory.downsampled.{plan.kind}")
+                return plan
+
+    metrics.incr("memory.rejected.request_budget")
+    raise MemoryBudgetExceeded(
+        f"Input too large to analyse safely ({plan.width}x{plan.height}, {plan.frames} frames: "
+        f"~{plan.estimate_mb:.0f} MB needed, per-request budget {budget:.0f} MB)")
+
+
+# ---- global admission -----------------------------------------------------
+
+class _Admission:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self.reserved_mb = 0.0
+        self.in_flight = 0
+        self._budget = None
+        self._budget_at = 0.0
+
+    def budget_mb(self):
+        if GLOBAL_BUDGET_MB > 0:
+            return GLOBAL_BUDGET_MB
+        # Re-measured only while idle: in-flight working sets are already in reserved_mb
+        if self._budget is None or (not self.in_flight and time.monotonic() - self._budget_at > BUDGET_REFRESH_SECONDS):
+            limit = memory_limit_mb() or 8192
+            workers = max(1, int(os.getenv("EMBRYO_WORKER_COUNT", "1")))
+            self._budget = max(256.0, limit * GLOBAL_BUDGET_FRACTION / workers - resident_baseline_mb(workers))
+            self._budget_at = time.monotonic()
+        return self._budget
+
+    def acquire(self, mb, timeout):
+        start = time.monotonic()
+        with self._cond:
+            budget = self.budget_mb()
+            if mb > budget:
+                metrics.incr("memory.rejected.global_budget")
+                raise MemoryBudgetExceeded(f"Request needs ~{mb:.0f} MB, more than this worker's budget ({budget:.0f} MB)")
+            # A request that fits alone is always admitted once the worker is idle
+            while self.in_flight and self.reserved_mb + mb > budget:
+                checkpoint()
+                remaining = timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    metrics.incr("memory.rejected.admit_timeout")
+                    raise MemoryBudgetExceeded("Server is busy with other large analyses. Please retry shortly.")
+                self._cond.wait(min(remaining, 0.5))
+                budget = self.budget_mb()
+            self.reserved_mb += mb
+            self.in_flight += 1
+        waited = time.monotonic() - start
+        if waited > 0.01:
+            metrics.incr("memory.admission.queued")
+            metrics.observe("memory.admission.wait_seconds", waited)
+
+    def release(self, mb):
+        with self._cond:
+            self.reserved_mb -= mb
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+
+_admission = _Admission()
+
+
+@contextmanager
+def reserve(plan, timeout=None):
+    """Holds `plan.estimate_mb` of the global budget for the duration of a request."""
+    mb = plan.estimate_mb
+    _admission.acquire(mb, ADMIT_TIMEOUT if timeout is None else timeout)
+    metrics.observe("memory.request.estimated_mb", mb)
+    simulation.record_estimate(mb)
+    base = current_rss_mb()
+    with track_stage("request") as peak:
+        try:
+            yield plan
+        finally:
+            _admission.release(mb)
+    metrics.observe("memory.request.peak_delta_mb", max(0.0, peak["peak_rss_mb"] - base))
+
+
+# ---- stage peak sampling --------------------------------------------------
+
+class _PeakSampler:
+    """One background thread samples RSS while any stage is active."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = {}
+        self._ids = 0
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        with self._lock:
+            self._ids += 1
+            key = self._ids
+            self._active[key] = current_rss_mb()
+            if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._loop, name="rss-sampler", daemon=True)
+                self._thread.start()
+        return key
+
+    def stop(self, key):
+        rss = current_rss_mb()
+        with self._lock:
+            return max(self._active.pop(key), rss)
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                if not self._active:
+                    self._thread = None
+                    return
+            rss = current_rss_mb()
+            with self._lock:
+                for key, peak in self._active.items():
+                    if rss > peak:
+                        self._active[key] = rss
+            time.sleep(SAMPLE_INTERVAL)
+
+
+_sampler = _PeakSampler()
+
+
+@contextmanager
+def track_stage(name):
+    """
+    Records the peak process RSS while the block runs as
+    memory.stage.<name>.peak_rss_mb. Yields a dict filled in on exit.
+    """
+    result = {"peak_rss_mb": 0.0}
+    base, start, cpu_start = current_rss_mb(), time.perf_counter(), time.process_time()
+    key = _sampler.start()
+    try:
+        yield result
+    finally:
+        result["peak_rss_mb"] = _sampler.stop(key)
+        metrics.observe(f"memory.stage.{name}.peak_rss_mb", result["peak_rss_mb"])
+        # Resource profile for capacity simulation (no-op unless EMBRYO_SIM_RECORD is set)
+        simulation.record_stage(name, time.perf_counter() - start, time.process_time() - cpu_start,
+                                max(0.0, result["peak_rss_mb"] - base))
+
+
+def memory_status():
+    """Budgets and current reservations (for the diagnostics endpoint)."""
+    return {
+        "request_budget_mb": REQUEST_BUDGET_MB,
+        "global_budget_mb": round(_admission.budget_mb(), 1),
+        "reserved_mb": round(_admission.reserved_mb, 1),
+        "in_flight": _admission.in_flight,
+        "rss_mb": round(current_rss_mb(), 1),
+        "limit_mb": memory_limit_mb(),
+    }
@@ -0,0 +1,46 @@
+"""
+In-Process Metrics
+
+Thread-safe counters and value summaries for the analysis pipeline,
+exposed by the API at /api/metrics.
+"""
+
+import threading
+
+_lock = threading.Lock()
+_counters = {}
+_summaries = {}
+
+
+def incr(name: str, value=1):
+    """Adds `value` to a counter."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name: str, value: float):
+    """Records one observation (latency, bytes, ratio...) into a running summary."""
+    with _lock:
+        s = _summaries.get(name)
+        if s is None:
+            _summaries[name] = {"count": 1, "sum": value, "min": value, "max": value}
+        else:
+            s["count"] += 1
+            s["sum"] += value
+            s["min"] = min(s["min"], value)
+            s["max"] = max(s["max"], value)
+
+
+def counter(name: str):
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def snapshot() -> dict:
+    """Copy of all counters and summaries (summaries include the mean)."""
+    with _lock:
+        summaries = {
+            name: {**s, "mean": s["sum"] / s["count"] if s["count"] else 0.0}
+            for name, s in _summaries.items()
+        }
+        return {"counters": dict(_counters), "summaries": summaries}
@@ -0,0 +1,219 @@
+"""
+Adaptive Milestone Search
+
+Locating t2, t8, tM, tB... does not need the staging model on every frame.
+Development is monotonic, so a milestone lies between the last sampled frame
+before its stage and the first one at or past it. The search:
+
+  1. classifies a coarse, evenly spaced sample of the time-lapse
+  2. for every interval whose stage crosses a milestone stage, decodes and
+     classifies the frame in the middle
+  3. repeats until every crossing interval is narrower than the target
+     resolution (or the probe budget is spent)
+
+Only the probed frames are decoded (seek plans from video_sampling). Probes are
+classified together as one time-ordered sequence, so the LSTM keeps temporal
+context; when the staging model exposes its frame encoder, each probe is
+encoded once and only the LSTM re-runs as probes are added.
+
+Frame times come from the acquisition interval (EMBRYO_FRAME_INTERVAL_MINUTES,
+or per request) and the hpi of the first frame, or from per-frame timestamps
+when the frames arrive with them (raw ingestion).
+"""
+
+import os
+
+import numpy as np
+import torch
+
+import metrics
+from scheduler import checkpoint
+from sequence_batcher import _split_modules
+from video_sampling import VideoFrameSource
+from sequence_ingest import is_sequence_path, open_sequence
+
+FRAME_INTERVAL_MINUTES = float(os.getenv("EMBRYO_FRAME_INTERVAL_MINUTES", "15"))
+FIRST_FRAME_HPI = float(os.getenv("EMBRYO_FIRST_FRAME_HPI", "0"))
+# Stop refining an interval once it is this narrow
+RESOLUTION_MINUTES = float(os.getenv("EMBRYO_MILESTONE_RESOLUTION_MINUTES", "30"))
+COARSE_SAMPLES = int(os.getenv("EMBRYO_MILESTONE_COARSE", "24"))
+MAX_PROBES = int(os.getenv("EMBRYO_MILESTONE_MAX_PROBES", "160"))
+
+
+class _ProbeClassifier:
+    """Per-probe stages from one time-ordered staging pass over all probes so far."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.split = None
+        self._split_checked = False
+        self.frames = {}
+        self.features = {}
+
+    def add(self, index, frame):
+        """frame: P x C x H x W preprocessed probe."""
+        self.frames[index] = frame
+
+    def _check_split(self):
+        # Encoder features are cached per probe only when the split path matches
+        # the full model for this plane count
+        batcher = self.engine.sequence_batcher
+        planes = next(iter(self.frames.values())).shape[0]
+        if batcher is not None and batcher.ensure_mode(planes) == "packed":
+            self.split = _split_modules(self.engine.model)
+        self._split_checked = True
+
+    def _encode_new(self):
+        visual = self.split[0]
+        new = [i for i in sorted(self.frames) if i not in self.features]
+        if not new:
+            return
+        with torch.no_grad(), self.engine._autocast():
+            feats = visual(torch.stack([self.frames[i] for i in new]).unsqueeze(0))
+            feats = feats["x"] if isinstance(feats, dict) else feats
+            feats = feats.reshape(len(new), -1).float()
+        for i, f in zip(new, feats):
+            self.features[i] = f
+            del self.frames[i]  # features are all that's needed from here on
+
+    def stages(self):
+        """{frame index: stage}, made monotonic (a stage never goes back)."""
+        if not self.frames and not self.features:
+            return {}
+        if not self._split_checked:
+            self._check_split()
+        if self.split is not None:
+            self._encode_new()
+            order = sorted(self.features)
+            _, lstm, head = self.split
+            seq = torch.stack([self.features[i] for i in order])
+            seq = seq.unsqueeze(0) if lstm.batch_first else seq.unsqueeze(1)
+            with torch.no_grad(), self.engine._autocast():
+                out, _ = lstm(seq)
+                out = out if lstm.batch_first else out.transpose(0, 1)
+                pred = head(out).float()[0]
+        else:
+            order = sorted(self.frames)
+            pred = self.engine._run_staging(torch.stack([self.frames[i] for i in order]).unsqueeze(0))[0]
+        raw = torch.argmax(pred, dim=1).tolist()
+        return dict(zip(order, np.maximum.accumulate(raw).tolist()))
+
+
+def _open(path, content_hash=None):
+    if is_sequence_path(path):
+        source = open_sequence(path)
+        if source is not None:
+            return source, source.select_planes()
+    return VideoFrameSource(path, content_hash=content_hash), None
+
+
+def _read(engine, source, planes, indices):
+    """Yields (index, P x C x H x W preprocessed frame) for the requested frames."""
+    if planes is None:
+        for i, frame in source.read(indices):
+            checkpoint()
+            yield i, engine._preprocess_frame(frame).unsqueeze(0)
+    else:
+        for i, stack in source.read(indices, planes=planes):
+            checkpoint()
+            yield i, torch.stack([engine._preprocess_frame(f) for f in stack])
+
+
+def _crossing(stage_a, stage_b, milestone_stages):
+    return any(stage_a < k <= stage_b for k in milestone_stages)
+
+
+def search_milestones(engine, path, frame_interval_minutes=None, first_frame_hpi=None,
+                      resolution_minutes=None, content_hash=None, source=None, frame_hpi=None):
+    """
+    Measured milestone times for a time-lapse.
+
+    Returns the same keys as EmbryoInference._derive_milestones ("t2": "26.3h",
+    "--" if not reached) plus "method", "transitions" (frame, hpi and the
+    bracketing interval of each milestone) and probe/decode counts.
+
+    `source` replaces opening `path` (an already open frame source, e.g.
+    raw_ingest.ArraySource) and `frame_hpi` gives the hpi of every frame
+    instead of the fixed interval.
+    """
+    from inference import MILESTONE_STAGES
+
+    interval_h = (frame_interval_minutes or FRAME_INTERVAL_MINUTES) / 60.0
+    first_hpi = FIRST_FRAME_HPI if first_frame_hpi is None else first_frame_hpi
+    resolution_h = (resolution_minutes or RESOLUTION_MINUTES) / 60.0
+    if frame_hpi is not None:
+        frame_hpi = [float(h) for h in frame_hpi]
+        hpi_of = frame_hpi.__getitem__
+    else:
+        resolution_h = max(1, int(round(resolution_h / interval_h))) * interval_h
+        hpi_of = lambda i: first_hpi + i * interval_h
+
+    if source is not None:
+        planes = source.select_planes() if len(getattr(source, "plane_labels", ())) > 1 else None
+    else:
+        source, planes = _open(path, content_hash)
+    try:
+        total = source.frame_count
+        if total < 2:
+            return {"unavailable": True, "reason": "Requires Time-Lapse Data"}
+        classifier = _ProbeClassifier(engine)
+        probes = np.unique(np.linspace(0, total - 1, min(COARSE_SAMPLES, total), dtype=int)).tolist()
+        attempted, rounds = set(probes), 0
+        while probes:
+            for i, frame in _read(engine, source, planes, probes):
+                classifier.add(i, frame)
+            stages = classifier.stages()
+            rounds += 1
+            order = sorted(stages)
+            budget = MAX_PROBES - len(order)
+            probes = []
+            for a, b in zip(order, order[1:]):
+                mid = (a + b) // 2
+                # Frames that failed to decode are not retried
+                if b - a > 1 and hpi_of(b) - hpi_of(a) > resolution_h + 1e-6 and mid not in attempted and _crossing(stages[a], stages[b], MILESTONE_STAGES):
+                    probes.append(mid)
+            if len(probes) > budget:
+                metrics.incr("milestones.probe_budget_exhausted")
+                probes = probes[:max(0, budget)]
+            attempted.update(probes)
+    finally:
+        source.release()
+
+    order = sorted(stages)
+    if not order:
+        return {"unavailable": True, "reason": "No frames could be decoded for the milestone search"}
+    milestones, transitions = {}, {}
+    for stage, name in sorted(MILESTONE_STAGES.items()):
+        reached = next((n for n, i in enumerate(order) if stages[i] >= stage), None)
+        if reached is None:
+            milestones[name] = "--"
+            continue
+        frame = order[reached]
+        hpi = hpi_of(frame)
+        milestones[name] = f"{hpi:.1f}h"
+        if reached == 0:
+            # Already there in the first frame: happened at or before the start of recording
+            transitions[name] = {"frame": frame, "hpi": round(hpi, 2), "before_recording": True}
+            continue
+        previous = order[reached - 1]
+        transitions[name] = {"frame": frame, "hpi": round(hpi, 2),
+                             "after_hpi": round(hpi_of(previous), 2)}
+
+    t2, t3 = transitions.get("t2"), transitions.get("t3")
+    if t2 and t3 and not t2.get("before_recording"):
+        milestones["s3"] = f"{t3['hpi'] - t2['hpi']:.1f}h"
+    else:
+        milestones["s3"] = "--"
+
+    metrics.observe("milestones.probes", len(order))
+    metrics.observe("milestones.probe_fraction", len(order) / total)
+    milestones.update({
+        "method": "adaptive",
+        "transitions": transitions,
+        "frames_total": total,
+        "frames_classified": len(order),
+        "refinement_rounds": rounds,
+        "resolution_h": round(resolution_h, 2),
+        "frame_interval_minutes": None if frame_hpi is not None else round(interval_h * 60, 2),
+    })
+    return milestones
@@ -0,0 +1,115 @@
+"""
+Embryo Pre-Filter: Cheap First Tier of the Gate Cascade
+
+A downscaled, float32 version of the structural heuristics in
+EmbryoInference._validate_embryo_structure (intensity, variance, Sobel,
+histogram, Hough). It decides only the easy cases:
+
+    reject    - obvious junk (blank/saturated frames, flat fills, screenshots)
+    accept    - high-confidence embryo (clear zona pellucida + natural texture)
+    ambiguous - everything else, forwarded to the CLIP gate
+
+Thresholds are intentionally more conservative than the full-resolution
+heuristics: a wrong tier-1 decision bypasses CLIP.
+
+The accept tier is unvalidated, so the default mode is "reject". In that mode
+every input the accept tier would have taken still goes to CLIP, and the
+agreement is counted (gate.prefilter_audit.accept_agree / accept_disagree,
+summarised in gate_stats()). Switch to EMBRYO_PREFILTER_MODE=full only once
+that audit shows the accept thresholds never pass what CLIP rejects.
+"""
+
+import os
+import cv2
+import numpy as np
+
+# "off" = CLIP for everything, "reject" = tier 1 may only reject, "full" = reject + accept (after audit)
+PREFILTER_MODE = os.getenv("EMBRYO_PREFILTER_MODE", "reject").lower()
+PREFILTER_SIZE = int(os.getenv("EMBRYO_PREFILTER_SIZE", "256"))
+
+# Reject tier (obvious junk)
+REJECT_DARK = float(os.getenv("EMBRYO_PREFILTER_REJECT_DARK", "5"))
+REJECT_BRIGHT = float(os.getenv("EMBRYO_PREFILTER_REJECT_BRIGHT", "250"))
+REJECT_MIN_VARIANCE = float(os.getenv("EMBRYO_PREFILTER_REJECT_MIN_VARIANCE", "10"))
+REJECT_MAX_GRADIENT = float(os.getenv("EMBRYO_PREFILTER_REJECT_MAX_GRADIENT", "120"))
+REJECT_MIN_BINS = int(os.getenv("EMBRYO_PREFILTER_REJECT_MIN_BINS", "6"))
+
+# Accept tier (high-confidence embryo)
+ACCEPT_MIN_VARIANCE = float(os.getenv("EMBRYO_PREFILTER_ACCEPT_MIN_VARIANCE", "80"))
+ACCEPT_MAX_GRADIENT = float(os.getenv("EMBRYO_PREFILTER_ACCEPT_MAX_GRADIENT", "40"))
+ACCEPT_MIN_BINS = int(os.getenv("EMBRYO_PREFILTER_ACCEPT_MIN_BINS", "60"))
+ACCEPT_MAX_SATURATION = float(os.getenv("EMBRYO_PREFILTER_ACCEPT_MAX_SATURATION", "40"))
+
+
+def structure_features(frame) -> dict:
+    """Computes the structural heuristics on a downscaled float32 grayscale copy."""
+    h, w = frame.shape[:2]
+    scale = PREFILTER_SIZE / max(h, w)
+    small = cv2.resize(frame, (max(1, int(w * scale)), max(1, int(h * scale))),
+                       interpolation=cv2.INTER_AREA) if scale < 1 else frame
+
+    if small.ndim == 3:
+        gray_u8 = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        # Mean HSV saturation: microscopy is near-grey, photos and UIs are colourful
+        saturation = float(np.mean(cv2.cvtColor(small, cv2.COLOR_BGR2HSV)[:, :, 1]))
+    else:
+        gray_u8 = small
+        saturation = 0.0
+    gray = gray_u8.astype(np.float32)
+    sh, sw = gray.shape
+
+    sobelx = cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3)
+    sobely = cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3)
+
+    hist = cv2.calcHist([gray_u8], [0], None, [256], [0, 256])
+    significant_bins = int(np.sum(hist > (sh * sw * 0.001)))
+
+    blurred = cv2.GaussianBlur(gray_u8, (5, 5), 1.5)
+    min_r, max_r = int(min(sh, sw) * 0.10), int(min(sh, sw) * 0.55)
+    circles = cv2.HoughCircles(blurred, cv2.HOUGH_GRADIENT, dp=1.2, minDist=max(1, min_r),
+                               param1=80, param2=25, minRadius=min_r, maxRadius=max_r)
+
+    return {
+        "mean": float(gray.mean()),
+        "variance": float(gray.var()),
+        "mean_gradient": float(cv2.magnitude(sobelx, sobely).mean()),
+        "significant_bins": significant_bins,
+        "saturation": saturation,
+        "circle": circles is not None,
+    }
+
+
+def prefilter(frame, mode=None):
+    """
+    Tier-1 decision for a BGR frame.
+
+    Returns:
+        tuple: (decision: "reject" | "accept" | "ambiguous", reason: str, features: dict)
+    """
+    mode = (mode or PREFILTER_MODE).lower()
+    if mode == "off" or frame is None:
+        return "ambiguous", "Pre-filter disabled", {}
+
+    f = structure_features(frame)
+
+    if f["mean"] < REJECT_DARK:
+        return "reject", "Image is too dark (Signal Loss)", f
+    if f["mean"] > REJECT_BRIGHT:
+        return "reject", "Image is saturated (Overexposed)", f
+    if f["variance"] < REJECT_MIN_VARIANCE:
+        return "reject", "Image lacks biological texture (too flat)", f
+    if f["significant_bins"] < REJECT_MIN_BINS:
+        return "reject", "Color palette too simple (Digital Art/Screenshot suspected)", f
+    if f["mean_gradient"] > REJECT_MAX_GRADIENT:
+        return "reject", "High-frequency content detected (Text/Diagram suspected)", f
+
+    # Evaluated in "reject" mode too, so the gate can audit the accept tier against CLIP
+    f["would_accept"] = bool(f["circle"]
+                             and f["variance"] >= ACCEPT_MIN_VARIANCE
+                             and f["mean_gradient"] <= ACCEPT_MAX_GRADIENT
+                             and f["significant_bins"] >= ACCEPT_MIN_BINS
+                             and f["saturation"] <= ACCEPT_MAX_SATURATION)
+    if mode == "full" and f["would_accept"]:
+        return "accept", "Zona Pellucida detected with natural microscopy texture", f
+
+    return "ambiguous", "Needs semantic check", f
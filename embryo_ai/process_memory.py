@@ -0,0 +1,83 @@
+"""
+Process Memory Accounting
+
+Reads Linux /proc accounting to split a process' resident memory into pages
+it owns privately and pages it shares with other processes (e.g. model weights
+inherited copy-on-write from a preloading parent).
+"""
+
+import os
+
+# smaps_rollup fields we report (values are in kB)
+_SMAPS_FIELDS = ("Rss", "Pss", "Shared_Clean", "Shared_Dirty", "Private_Clean", "Private_Dirty", "Swap")
+
+
+def process_memory(pid=None) -> dict:
+    """
+    Returns unique vs shared resident memory for a process, in MB.
+
+    'unique_mb' is memory only this process holds (freed if it exits);
+    'shared_mb' is resident memory whose pages are also mapped by others.
+    """
+    pid = pid or os.getpid()
+    values = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0].rstrip(":") in _SMAPS_FIELDS:
+                    values[parts[0].rstrip(":")] = int(parts[1])
+    except OSError:
+        return {"pid": pid, "available": False}
+
+    unique_kb = values.get("Private_Clean", 0) + values.get("Private_Dirty", 0)
+    shared_kb = values.get("Shared_Clean", 0) + values.get("Shared_Dirty", 0)
+    return {
+        "pid": pid,
+        "available": True,
+        "rss_mb": round(values.get("Rss", 0) / 1024, 1),
+        "pss_mb": round(values.get("Pss", 0) / 1024, 1),
+        "unique_mb": round(unique_kb / 1024, 1),
+        "shared_mb": round(shared_kb / 1024, 1),
+        "swap_mb": round(values.get("Swap", 0) / 1024, 1),
+    }
+
+
+def child_pids(pid) -> list:
+    """Lists direct children of a process (all of its threads)."""
+    children = []
+    task_dir = f"/proc/{pid}/task"
+    try:
+        for tid in os.listdir(task_dir):
+            with open(os.path.join(task_dir, tid, "children")) as f:
+                children.extend(int(p) for p in f.read().split())
+    except OSError:
+        pass
+    return sorted(set(children))
+
+
+def worker_memory_report(parent_pid=None) -> dict:
+    """
+    Memory report for a preload-then-fork worker group.
+
+    Without a parent pid (plain uvicorn), reports the current process only.
+    """
+    if not parent_pid:
+        me = process_memory()
+        return {"mode": "single", "parent": None, "workers": [me],
+                "total_unique_mb": me.get("unique_mb", 0), "total_pss_mb": me.get("pss_mb", 0)}
+
+    parent = process_memory(parent_pid)
+    workers = [process_memory(pid) for pid in child_pids(parent_pid)]
+    workers = [w for w in workers if w.get("available")]
+    group = [parent] + workers if parent.get("available") else workers
+
+    return {
+        "mode": "preload-fork",
+        "parent": parent,
+        "workers": workers,
+        # PSS splits shared pages between sharers, so the sum is the real footprint
+        "total_pss_mb": round(sum(p["pss_mb"] for p in group), 1),
+        "total_unique_mb": round(sum(p["unique_mb"] for p in group), 1),
+        "total_rss_mb": round(sum(p["rss_mb"] for p in group), 1),
+    }
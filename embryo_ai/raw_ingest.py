@@ -0,0 +1,233 @@
+"""
+Raw Frame Ingestion
+
+Instrument gateways already hold decoded frames in memory; encoding them to
+JPEG/MP4 only for the service to decode them again wastes CPU on both sides
+(and JPEG is lossy). This module defines a small length-prefixed binary
+message that carries uint8 frame arrays directly:
+
+    magic     4 bytes   b"EMBF"
+    hlen      u32 LE    header length
+    header    hlen      UTF-8 JSON:
+                          shape       [T, H, W, C], [T, P, H, W, C] or [T, H, W] (gray)
+                          dtype       "uint8"
+                          color       "bgr" (default), "rgb" or "gray"
+                          timestamps  optional, hours post insemination per timepoint
+                          deadline    optional, seconds the analysis may take (> 0)
+                          plus optional analysis_type, timeline, milestones,
+                          patient_id, cycle_id, embryo_id
+    plen      u64 LE    payload length (= prod(shape))
+    payload   plen      C-contiguous frame data
+
+The same message is accepted as the body of POST /api/ingest/raw and on a
+local Unix socket (EMBRYO_RAW_SOCKET), where each message is answered with a
+u32 LE length + JSON result and the connection can be reused.
+"""
+
+import asyncio
+import json
+import os
+import socket
+import struct
+import uuid
+
+import numpy as np
+
+import metrics
+import structured_log
+
+MAGIC = b"EMBF"
+MAX_MESSAGE_MB = float(os.getenv("EMBRYO_RAW_MAX_MB", "1024"))
+MAX_HEADER_BYTES = 1 << 20
+# Largest complete message (framing + header + payload)
+MAX_MESSAGE_BYTES = int(MAX_MESSAGE_MB * 1024 * 1024) + MAX_HEADER_BYTES + 16
+SOCKET_PATH = os.getenv("EMBRYO_RAW_SOCKET", "")
+
+_HEAD = struct.Struct("<4sI")
+_PAYLOAD_LEN = struct.Struct("<Q")
+_REPLY_LEN = struct.Struct("<I")
+
+
+class RawFormatError(ValueError):
+    pass
+
+
+def encode_message(frames, header=None):
+    """Builds a message from a uint8 array (client helper / tests)."""
+    frames = np.ascontiguousarray(frames)
+    header = dict(header or {}, shape=list(frames.shape), dtype=str(frames.dtype))
+    header_bytes = json.dumps(header).encode()
+    return _HEAD.pack(MAGIC, len(header_bytes)) + header_bytes + _PAYLOAD_LEN.pack(frames.nbytes) + frames.tobytes()
+
+
+def _validate(header, payload_len):
+    if header.get("dtype", "uint8") != "uint8":
+        raise RawFormatError(f"Unsupported dtype '{header.get('dtype')}': frames must be uint8")
+    shape = header.get("shape")
+    if not isinstance(shape, list) or not 3 <= len(shape) <= 5 or not all(isinstance(d, int) and d > 0 for d in shape):
+        raise RawFormatError("Header 'shape' must be [T, H, W], [T, H, W, C] or [T, P, H, W, C]")
+    color = header.get("color", "gray" if len(shape) == 3 else "bgr")
+    channels = 1 if len(shape) == 3 else shape[-1]
+    if (color == "gray") != (channels == 1) or channels not in (1, 3) or color not in ("bgr", "rgb", "gray"):
+        raise RawFormatError(f"Color '{color}' does not match {channels} channel(s)")
+    if int(np.prod(shape)) != payload_len:
+        raise RawFormatError(f"Payload is {payload_len} bytes, shape {shape} needs {int(np.prod(shape))}")
+    timestamps = header.get("timestamps")
+    if timestamps is not None:
+        if not isinstance(timestamps, list) or not all(
+                isinstance(t, (int, float)) and not isinstance(t, bool) for t in timestamps):
+            raise RawFormatError("Header 'timestamps' must be a list of numbers (hours post insemination)")
+        if len(timestamps) != shape[0]:
+            raise RawFormatError(f"{len(timestamps)} timestamps for {shape[0]} timepoints")
+    deadline = header.get("deadline")
+    if deadline is not None and (not isinstance(deadline, (int, float)) or isinstance(deadline, bool)
+                                 or not 0 < deadline < float("inf")):
+        raise RawFormatError("Header 'deadline' must be a positive number of seconds")
+    return shape, color
+
+
+def to_bgr_frames(header, payload):
+    """
+    Zero-copy view of the payload as T x P x H x W x 3 BGR frames (gray is
+    broadcast, RGB reversed as a view; consumers copy when they resize).
+    """
+    shape, color = _validate(header, len(payload))
+    arr = np.frombuffer(payload, dtype=np.uint8).reshape(shape)
+    if len(shape) == 3:
+        arr = arr[..., None]
+    if arr.ndim == 4:
+        arr = arr[:, None]
+    if color == "gray":
+        arr = np.broadcast_to(arr, arr.shape[:-1] + (3,))
+    elif color == "rgb":
+        arr = arr[..., ::-1]
+    return arr
+
+
+def parse_message(buffer):
+    """(header dict, T x P x H x W x 3 BGR view) from one complete message."""
+    view = memoryview(buffer)
+    if len(view) < _HEAD.size + _PAYLOAD_LEN.size:
+        raise RawFormatError("Message too short")
+    magic, hlen = _HEAD.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise RawFormatError("Bad magic: not an EMBF frame message")
+    if hlen > MAX_HEADER_BYTES:
+        raise RawFormatError("Header too large")
+    offset = _HEAD.size
+    header = json.loads(bytes(view[offset:offset + hlen]))
+    if not isinstance(header, dict):
+        raise RawFormatError("Header must be a JSON object")
+    offset += hlen
+    plen, = _PAYLOAD_LEN.unpack_from(view, offset)
+    offset += _PAYLOAD_LEN.size
+    if len(view) - offset != plen:
+        raise RawFormatError(f"Payload length {plen} does not match the {len(view) - offset} bytes received")
+    payload = view[offset:]
+    return header, to_bgr_frames(header, payload), payload
+
+
+class ArraySource:
+    """
+    In-memory frames behind the image-sequence source interface (frame_count,
+    select_planes, read), so EmbryoInference._load_sequence and the milestone
+    search sample them exactly like a decoded export. Plane labels are
+    offsets from the middle plane, which stands in for the in-focus one.
+    """
+
+    def __init__(self, frames):
+        self.frames = frames  # T x P x H x W x 3
+        self.frame_count = frames.shape[0]
+        self._middle = frames.shape[1] // 2
+        self.plane_labels = [p - self._middle for p in range(frames.shape[1])]
+        self.fps = 0.0
+
+    def select_planes(self, count=None):
+        return self.plane_labels
+
+    def read(self, indices, planes=None):
+        for t in sorted(set(int(i) for i in indices if 0 <= i < self.frame_count)):
+            if planes is None:
+                yield t, np.ascontiguousarray(self.frames[t, self._middle])
+            else:
+                yield t, [np.ascontiguousarray(self.frames[t, p + self._middle]) for p in planes]
+
+    def release(self):
+        pass
+
+
+# ---- Unix socket -------------------------------------------------------------
+
+async def _read_message(reader):
+    head = await reader.readexactly(_HEAD.size)
+    magic, hlen = _HEAD.unpack(head)
+    if magic != MAGIC or hlen > MAX_HEADER_BYTES:
+        raise RawFormatError("Bad message header")
+    header_bytes = await reader.readexactly(hlen)
+    plen_bytes = await reader.readexactly(_PAYLOAD_LEN.size)
+    plen, = _PAYLOAD_LEN.unpack(plen_bytes)
+    if plen > MAX_MESSAGE_MB * 1024 * 1024:
+        raise RawFormatError(f"Message larger than {MAX_MESSAGE_MB:.0f} MB")
+    payload = await reader.readexactly(plen)
+    return head + header_bytes + plen_bytes + payload
+
+
+def _reply(writer, obj):
+    body = json.dumps(obj, default=str).encode()
+    writer.write(_REPLY_LEN.pack(len(body)) + body)
+
+
+def listening_socket(path):
+    """Binds a Unix listening socket at `path` (a stale socket file is replaced)."""
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            raise RuntimeError(f"{path} is already served by another process")
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.unlink(path)
+        finally:
+            probe.close()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    os.chmod(path, 0o660)
+    sock.listen(128)
+    sock.set_inheritable(True)
+    return sock
+
+
+async def serve_unix(sock, analyze):
+    """
+    Serves raw messages on a listening Unix socket.
+
+    `analyze(header, frames, payload)` is awaited per message and returns the
+    JSON-able result; errors are answered as {"error": ..., "status": ...}.
+    """
+    async def handle(reader, writer):
+        try:
+            while True:
+                try:
+                    message = await _read_message(reader)
+                except asyncio.IncompleteReadError:
+                    break  # client closed
+                metrics.incr("raw_ingest.socket.messages")
+                rid_token = structured_log.set_request_id(uuid.uuid4().hex[:16])
+                try:
+                    header, frames, payload = parse_message(message)
+                    _reply(writer, await analyze(header, frames, payload))
+                except (RawFormatError, ValueError) as e:
+                    _reply(writer, {"error": str(e), "status": 400})
+                except Exception as e:
+                    status = getattr(e, "status_code", 500)
+                    _reply(writer, {"error": getattr(e, "detail", str(e)), "status": status})
+                finally:
+                    structured_log.reset_request_id(rid_token)
+                await writer.drain()
+        except RawFormatError as e:
+            _reply(writer, {"error": str(e), "status": 400})
+        finally:
+            writer.close()
+
+    server = await asyncio.start_unix_server(handle, sock=sock)
+    print(f"RawIngest: serving frame messages on {sock.getsockname()}")
+    return server
@@ -0,0 +1,290 @@
+"""
+Analysis Result Store
+
+Every prediction is written to an embedded SQLite database so a cycle's
+embryos can be ranked, filtered and paged without re-analysing them.
+
+Rows are keyed by (patient, cycle, embryo, upload content hash, model version,
+analysis type); re-running the same upload on the same model replaces the row's
+result but keeps its result_id, so ids already handed to clients stay valid.
+Writes go through a queue to a background thread that commits them in
+batches, so the request path only pays for a queue put. The ranking columns
+(viability, grades) are real indexed columns; the full result is kept as JSON.
+"""
+
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+import metrics
+from content_cache import CACHE_DIR
+from structured_log import get_logger, fields
+
+log = get_logger("store")
+
+RESULT_DB = os.getenv("EMBRYO_RESULT_DB", os.path.join(CACHE_DIR, "results.sqlite3"))
+# Writer commits when this many rows are queued or after FLUSH_SECONDS, whichever first
+WRITE_BATCH = int(os.getenv("EMBRYO_RESULT_WRITE_BATCH", "64"))
+FLUSH_SECONDS = float(os.getenv("EMBRYO_RESULT_FLUSH_SECONDS", "0.5"))
+MAX_PAGE_SIZE = 500
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    result_id       TEXT PRIMARY KEY,
+    patient_id      TEXT NOT NULL DEFAULT '',
+    cycle_id        TEXT NOT NULL DEFAULT '',
+    embryo_id       TEXT NOT NULL DEFAULT '',
+    content_hash    TEXT NOT NULL,
+    model_version   TEXT NOT NULL,
+    analysis_type   TEXT NOT NULL,
+    created_at      REAL NOT NULL,
+    stage           TEXT,
+    expansion       INTEGER,
+    icm             TEXT,
+    te              TEXT,
+    viability_score INTEGER,
+    payload         TEXT NOT NULL,
+    UNIQUE (patient_id, cycle_id, embryo_id, content_hash, model_version, analysis_type)
+);
+-- Cohort ranking + keyset pagination: WHERE patient/cycle ORDER BY viability DESC, result_id
+CREATE INDEX IF NOT EXISTS idx_results_cohort_rank
+    ON results (patient_id, cycle_id, COALESCE(viability_score, -1) DESC, result_id);
+CREATE INDEX IF NOT EXISTS idx_results_cycle_rank
+    ON results (cycle_id, COALESCE(viability_score, -1) DESC, result_id);
+CREATE INDEX IF NOT EXISTS idx_results_grade
+    ON results (icm, te, expansion);
+CREATE INDEX IF NOT EXISTS idx_results_content
+    ON results (content_hash);
+"""
+
+_COLUMNS = ("result_id", "patient_id", "cycle_id", "embryo_id", "content_hash", "model_version",
+            "analysis_type", "created_at", "stage", "expansion", "icm", "te", "viability_score", "payload")
+
+# result_id is not updated on conflict: the first id of a key is permanent
+_KEY_COLUMNS = ("result_id", "patient_id", "cycle_id", "embryo_id", "content_hash", "model_version", "analysis_type")
+
+_UPSERT = (
+    f"INSERT INTO results ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))}) "
+    "ON CONFLICT (patient_id, cycle_id, embryo_id, content_hash, model_version, analysis_type) DO UPDATE SET "
+    + ", ".join(f"{c} = excluded.{c}" for c in _COLUMNS if c not in _KEY_COLUMNS)
+)
+
+_SUMMARY_COLUMNS = ("result_id", "patient_id", "cycle_id", "embryo_id", "analysis_type", "created_at",
+                    "stage", "expansion", "icm", "te", "viability_score", "model_version")
+
+
+def _connect(path=None):
+    conn = sqlite3.connect(path or RESULT_DB, timeout=30, check_same_thread=False)
+    # WAL: readers never block the writer; forked API workers share the file safely
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
+
+
+def _row_values(result_id, result, patient_id, cycle_id, embryo_id, content_hash, model_version):
+    gardner = result.get("gardner") or {}
+    concordance = result.get("concordance") or {}
+    expansion = str(gardner.get("expansion", ""))
+    viability = concordance.get("viability_score")
+    return (
+        result_id, patient_id or "", cycle_id or "", embryo_id or "", content_hash, model_version,
+        result.get("analysis_type", "gardner"), time.time(), result.get("stage"),
+        int(expansion) if expansion.isdigit() else None,
+        gardner.get("icm") if gardner.get("icm") in ("A", "B", "C") else None,
+        gardner.get("te") if gardner.get("te") in ("A", "B", "C") else None,
+        int(viability) if isinstance(viability, (int, float)) else None,
+        json.dumps(result, default=str),
+    )
+
+
+class ResultStore:
+    """SQLite result store with a batched background writer."""
+
+    def __init__(self, path=None):
+        self.path = path or RESULT_DB
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with _connect(self.path) as conn:
+            conn.executescript(_SCHEMA)
+        conn.close()
+        self._queue = queue.Queue()
+        self._writer = None
+        self._writer_pid = None
+        self._start_lock = threading.Lock()
+        self._local = threading.local()
+        # key -> result_id of rows queued by this process but not committed yet
+        self._queued_ids = {}
+        self._ids_lock = threading.Lock()
+
+    # ---- writes ---------------------------------------------------------
+
+    def _ensure_writer(self):
+        # Threads don't survive fork: each serve.py worker starts its own writer
+        if self._writer is not None and self._writer_pid == os.getpid() and self._writer.is_alive():
+            return
+        with self._start_lock:
+            if self._writer is None or self._writer_pid != os.getpid() or not self._writer.is_alive():
+                self._queue = queue.Queue()
+                self._queued_ids, self._ids_lock = {}, threading.Lock()
+                self._writer_pid = os.getpid()
+                self._writer = threading.Thread(target=self._write_loop, name="result-store-writer", daemon=True)
+                self._writer.start()
+
+    def record(self, result, content_hash, model_version, patient_id=None, cycle_id=None, embryo_id=None):
+        """
+        Queues a prediction for storage and returns its result_id immediately.
+
+        A re-analysis of an already stored key returns (and keeps) the existing
+        row's id. The row becomes visible to queries after the next batch
+        commit (at most FLUSH_SECONDS later).
+        """
+        self._ensure_writer()
+        row = _row_values(None, result, patient_id, cycle_id, embryo_id, content_hash, model_version)
+        key = row[1:7]
+        with self._ids_lock:
+            result_id = self._queued_ids.get(key) or self._existing_id(key) or uuid.uuid4().hex
+            self._queued_ids[key] = result_id
+        self._queue.put((result_id,) + row[1:])
+        return result_id
+
+    def _existing_id(self, key):
+        found = self._reader().execute(
+            "SELECT result_id FROM results WHERE patient_id = ? AND cycle_id = ? AND embryo_id = ? "
+            "AND content_hash = ? AND model_version = ? AND analysis_type = ?", key).fetchone()
+        return found[0] if found else None
+
+    def flush(self, timeout=10.0):
+        """Blocks until everything queued so far is committed."""
+        if self._writer is None or self._writer_pid != os.getpid():
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def _write_loop(self):
+        conn = _connect(self.path)
+        while True:
+            batch, waiters = [], []
+            item = self._queue.get()
+            deadline = time.monotonic() + FLUSH_SECONDS
+            while True:
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= WRITE_BATCH:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                start = time.perf_counter()
+                try:
+                    with conn:
+                        conn.executemany(_UPSERT, batch)
+                    metrics.observe("results.write.batch_rows", len(batch))
+                    metrics.observe("results.write.seconds", time.perf_counter() - start)
+                except sqlite3.Error as e:
+                    metrics.incr("results.write.errors")
+                    log.error("result batch write failed", extra=fields(rows=len(batch), error=str(e)))
+            with self._ids_lock:
+                for row in batch:
+                    if self._queued_ids.get(row[1:7]) == row[0]:
+                        del self._queued_ids[row[1:7]]
+            for done in waiters:
+                done.set()
+
+    # ---- reads ----------------------------------------------------------
+
+    def _reader(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = _connect(self.path)
+            conn.row_factory = sqlite3.Row
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, result_id):
+        """Full stored result (payload plus key columns), or None."""
+        row = self._reader().execute("SELECT * FROM results WHERE result_id = ?", (result_id,)).fetchone()
+        if row is None:
+            return None
+        record = dict(row)
+        record["result"] = json.loads(record.pop("payload"))
+        return record
+
+    def rank(self, patient_id=None, cycle_id=None, analysis_type=None, min_expansion=None,
+             icm=None, te=None, limit=50, cursor=None):
+        """
+        Ranks a cohort by viability (best first) with optional grade filters.
+
+        Pagination is keyset-based: pass the returned `next_cursor` to get the
+        next page. Each page is an index range scan, so page 100 costs the
+        same as page 1.
+
+        Args:
+            icm / te: iterable of accepted grades, e.g. ("A", "B")
+            min_expansion: minimum Gardner expansion (1-6)
+        """
+        start = time.perf_counter()
+        where, params = [], []
+        if patient_id is not None:
+            where.append("patient_id = ?")
+            params.append(patient_id)
+        if cycle_id is not None:
+            where.append("cycle_id = ?")
+            params.append(cycle_id)
+        if analysis_type:
+            where.append("analysis_type = ?")
+            params.append(analysis_type)
+        if min_expansion is not None:
+            where.append("expansion >= ?")
+            params.append(int(min_expansion))
+        for column, grades in (("icm", icm), ("te", te)):
+            if grades:
+                grades = list(grades)
+                where.append(f"{column} IN ({', '.join('?' * len(grades))})")
+                params.extend(grades)
+
+        # NULL viability (ungraded) sorts last; the expression matches the ranking indexes
+        if cursor:
+            score, last_id = cursor.split(":", 1)
+            where.append("(COALESCE(viability_score, -1) < ? OR (COALESCE(viability_score, -1) = ? AND result_id > ?))")
+            params.extend([int(score), int(score), last_id])
+
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        sql = (f"SELECT {', '.join(_SUMMARY_COLUMNS)} FROM results"
+               + (f" WHERE {' AND '.join(where)}" if where else "")
+               + " ORDER BY COALESCE(viability_score, -1) DESC, result_id LIMIT ?")
+        rows = [dict(r) for r in self._reader().execute(sql, params + [limit + 1]).fetchall()]
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            score = last["viability_score"] if last["viability_score"] is not None else -1
+            next_cursor = f"{score}:{last['result_id']}"
+
+        elapsed = time.perf_counter() - start
+        metrics.observe("results.query.seconds", elapsed)
+        return {"results": rows, "count": len(rows), "next_cursor": next_cursor,
+                "query_ms": round(elapsed * 1000, 2)}
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """Process-wide store (created on first use)."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ResultStore()
+    return _store
@@ -0,0 +1,108 @@
+"""
+CPU Runtime Settings
+
+Applies the thread/worker topology chosen by tune_runtime.py (intra-op threads,
+inter-op threads, per-worker core pinning) at service startup and remembers
+what was actually applied for the diagnostics endpoint.
+"""
+
+import json
+import os
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+TUNING_FILE = os.getenv("EMBRYO_TUNING_FILE", os.path.join(CURRENT_DIR, "runtime_tuning.json"))
+
+# What apply_runtime_settings() ended up doing in this process
+_applied = {"applied": False, "reason": "apply_runtime_settings() not called"}
+
+
+def load_tuning(path=None) -> dict:
+    """Reads the tuning file; returns {} if it does not exist or is unreadable."""
+    path = path or TUNING_FILE
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Runtime Tuning: Ignoring unreadable tuning file {path}: {e}")
+        return {}
+
+
+def worker_cores(worker_index, threads, cpu_count=None) -> list:
+    """Contiguous core slice for a worker (wraps around if workers x threads > cores)."""
+    cpu_count = cpu_count or os.cpu_count() or 1
+    start = (worker_index * threads) % cpu_count
+    return [(start + i) % cpu_count for i in range(threads)]
+
+
+def apply_runtime_settings(worker_index=None, tuning=None) -> dict:
+    """
+    Applies tuned torch threading (and core pinning for a known worker index).
+
+    Must run before the first forward pass: inter-op threads cannot be changed
+    once torch has started parallel work. While serve.py is preloading models in
+    the parent, this is deferred to the forked workers.
+    """
+    global _applied
+
+    if os.getenv("EMBRYO_PRELOADING") == "1" and worker_index is None:
+        _applied = {"applied": False, "reason": "Deferred to forked workers (preload parent)"}
+        return _applied
+
+    try:
+        import torch
+    except ImportError:
+        _applied = {"applied": False, "reason": "torch not installed"}
+        return _applied
+
+    tuning = load_tuning() if tuning is None else tuning
+    if worker_index is None and os.getenv("EMBRYO_WORKER_INDEX"):
+        worker_index = int(os.getenv("EMBRYO_WORKER_INDEX"))
+
+    result = {"applied": bool(tuning), "source": TUNING_FILE if tuning else None, "worker_index": worker_index}
+    if not tuning:
+        result["reason"] = "No tuning file; torch defaults in use"
+
+    intra = int(tuning.get("intra_op_threads", 0) or 0)
+    interop = int(tuning.get("interop_threads", 0) or 0)
+    if intra > 0:
+        torch.set_num_threads(intra)
+    if interop > 0:
+        try:
+            torch.set_num_interop_threads(interop)
+        except RuntimeError as e:
+            result["interop_error"] = str(e)
+
+    if tuning.get("pin_cores") and worker_index is not None and hasattr(os, "sched_setaffinity"):
+        cores = worker_cores(worker_index, intra or 1)
+        try:
+            os.sched_setaffinity(0, cores)
+            result["pinned_cores"] = cores
+        except OSError as e:
+            result["pin_error"] = str(e)
+    elif tuning.get("pin_cores"):
+        result["pinned_cores"] = None
+        result["pin_note"] = "Pinning needs a worker index (run via serve.py)"
+
+    result["tuned_workers"] = tuning.get("workers")
+    _applied = result
+    print(f"Runtime Tuning: intra={torch.get_num_threads()} interop={torch.get_num_interop_threads()} "
+          f"pinned={result.get('pinned_cores')}")
+    return result
+
+
+def applied_settings() -> dict:
+    """Settings applied in this process plus the live torch values."""
+    report = dict(_applied)
+    try:
+        import torch
+        report["torch_num_threads"] = torch.get_num_threads()
+        report["torch_num_interop_threads"] = torch.get_num_interop_threads()
+    except ImportError:
+        pass
+    if hasattr(os, "sched_getaffinity"):
+        report["cpu_affinity"] = sorted(os.sched_getaffinity(0))
+    report["cpu_count"] = os.cpu_count()
+    report["pid"] = os.getpid()
+    return report
@@ -0,0 +1,325 @@
+"""
+Lazy Saliency Heatmaps
+
+Results advertise a heatmap, but most users never open it, so nothing is
+computed during analysis. Instead:
+
+  - after an analysis, the preprocessed input (the graded frame and, for
+    time-lapses, the staging sequence) is kept in an in-memory LRU keyed by the
+    upload's content hash and spilled to disk in the background, so any worker
+    can serve the heatmap later without decoding the upload again
+  - GET /api/results/{id}/heatmap computes saliency on demand:
+      * GardnerNet expansion / ICM / TE: Grad-CAM on the last VGG conv block
+      * staging model: gradient x input for the stage of the last frame (the
+        model internals are not assumed, so no conv layer is hooked)
+  - concurrent Gardner requests are batched: one worker thread drains the
+    queue for BATCH_WINDOW and runs one forward + per-head backward
+  - rendered PNGs are cached on disk by content hash, model and target
+"""
+
+import hashlib
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+import torch
+
+import metrics
+from content_cache import cache_path
+from scheduler import checkpoint
+from structured_log import get_logger, fields
+
+log = get_logger("heatmap")
+
+GARDNER_TARGETS = ("expansion", "icm", "te")
+TARGETS = GARDNER_TARGETS + ("staging",)
+INPUT_CACHE_MB = float(os.getenv("EMBRYO_HEATMAP_INPUT_CACHE_MB", "256"))
+# Spilled inputs older than this are deleted (heatmaps need the original analysis input)
+INPUT_TTL_HOURS = float(os.getenv("EMBRYO_HEATMAP_INPUT_TTL_HOURS", "24"))
+# Inputs waiting to be spilled; further spills are dropped (the queue keeps evicted entries alive)
+SPILL_QUEUE = int(os.getenv("EMBRYO_HEATMAP_SPILL_QUEUE", "16"))
+BATCH_WINDOW = float(os.getenv("EMBRYO_HEATMAP_BATCH_WINDOW_MS", "20")) / 1000.0
+MAX_BATCH = int(os.getenv("EMBRYO_HEATMAP_MAX_BATCH", "16"))
+OVERLAY_ALPHA = 0.45
+
+_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+
+class HeatmapUnavailable(Exception):
+    pass
+
+
+# ---- input cache -------------------------------------------------------------
+
+class InputCache:
+    """Preprocessed analysis inputs by content hash: memory LRU + background disk spill."""
+
+    def __init__(self, budget_mb=None):
+        self.budget = (budget_mb or INPUT_CACHE_MB) * 1024 * 1024
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(SPILL_QUEUE)
+        self._writer = None
+        self._writer_pid = None
+
+    @staticmethod
+    def _path(content_hash):
+        return cache_path("inputs", f"{content_hash}.pt")
+
+    def put(self, content_hash, frame=None, sequence=None):
+        """
+        frame: 1 x C x H x W (the frame Gardner graded)
+        sequence: 1 x T x P x C x H x W (the staging input), optional
+        """
+        entry = {k: v.detach().to(torch.float16).contiguous()
+                 for k, v in (("frame", frame), ("sequence", sequence)) if v is not None}
+        if not entry:
+            return
+        size = sum(t.numel() * t.element_size() for t in entry.values())
+        with self._lock:
+            old = self._entries.pop(content_hash, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[content_hash] = (entry, size)
+            self._bytes += size
+            while self._bytes > self.budget and len(self._entries) > 1:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+        self._ensure_writer()
+        try:
+            self._queue.put_nowait((content_hash, entry))
+        except queue.Full:
+            # Slow disk: the input stays memory-only (this worker can still serve it while cached)
+            metrics.incr("heatmap.input_cache.spill_dropped")
+
+    def get(self, content_hash):
+        with self._lock:
+            hit = self._entries.get(content_hash)
+            if hit is not None:
+                self._entries.move_to_end(content_hash)
+                metrics.incr("heatmap.input_cache.memory_hit")
+                return hit[0]
+        path = self._path(content_hash)
+        if os.path.exists(path):
+            metrics.incr("heatmap.input_cache.disk_hit")
+            return torch.load(path, map_location="cpu")
+        metrics.incr("heatmap.input_cache.miss")
+        return None
+
+    def _ensure_writer(self):
+        # Threads don't survive fork: each worker starts its own writer
+        if self._writer is not None and self._writer_pid == os.getpid() and self._writer.is_alive():
+            return
+        with self._lock:
+            if self._writer is None or self._writer_pid != os.getpid() or not self._writer.is_alive():
+                self._queue = queue.Queue(SPILL_QUEUE)
+                self._writer_pid = os.getpid()
+                self._writer = threading.Thread(target=self._write_loop, name="heatmap-input-writer", daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        last_prune = 0.0
+        while True:
+            content_hash, entry = self._queue.get()
+            path = self._path(content_hash)
+            try:
+                torch.save(entry, path + ".tmp")
+                os.replace(path + ".tmp", path)
+            except OSError as e:
+                log.warning("failed to spill input", extra=fields(content_hash=content_hash[:12], error=str(e)))
+            if time.time() - last_prune > 600:
+                self._prune()
+                last_prune = time.time()
+
+    def _prune(self):
+        folder = os.path.dirname(self._path("x"))
+        cutoff = time.time() - INPUT_TTL_HOURS * 3600
+        for name in os.listdir(folder):
+            full = os.path.join(folder, name)
+            try:
+                if os.path.getmtime(full) < cutoff:
+                    os.remove(full)
+            except OSError:
+                pass
+
+
+# ---- saliency ----------------------------------------------------------------
+
+def _normalize(cam):
+    """Per-sample min-max to [0, 1] (B x h x w)."""
+    flat = cam.flatten(1)
+    low, high = flat.min(dim=1).values, flat.max(dim=1).values
+    return (cam - low[:, None, None]) / (high - low).clamp_min(1e-8)[:, None, None]
+
+
+def gardner_gradcam(model, frames, heads=GARDNER_TARGETS):
+    """
+    Grad-CAM of each head's predicted class for a batch (B x C x H x W).
+
+    The VGG trunk runs without autograd up to the last max-pool; only the
+    last conv block's activations are tracked, so the backward is cheap.
+    Returns {head: B x h x w in [0, 1]}.
+    """
+    features = model.features
+    split = max(i for i, m in enumerate(features) if isinstance(m, torch.nn.MaxPool2d))
+    with torch.no_grad():
+        acts = features[:split](frames.float())
+    with torch.enable_grad():
+        acts = acts.detach().requires_grad_(True)
+        pooled = features[split:](acts)
+        outputs = {"expansion": model.head_expansion(pooled), "icm": model.head_icm(pooled),
+                   "te": model.head_te(pooled)}
+        cams = {}
+        for head in heads:
+            logits = outputs[head]
+            score = logits.gather(1, logits.argmax(dim=1, keepdim=True)).sum()
+            grads, = torch.autograd.grad(score, acts, retain_graph=True)
+            weights = grads.mean(dim=(2, 3), keepdim=True)
+            cams[head] = _normalize(torch.relu((weights * acts).sum(dim=1)).detach())
+    return cams
+
+
+def staging_saliency(engine, sequence, window=None):
+    """
+    Gradient x input saliency of the last frame's predicted stage for a
+    1 x T x P x C x H x W sequence. Only the last `window` timepoints
+    (default the trained length) are back-propagated to bound memory.
+    Returns (last frame C x H x W, h x w saliency in [0, 1]).
+    """
+    window = window or engine._tr_len()
+    x = sequence[:, -window:].float().clone()
+    with torch.enable_grad():
+        x.requires_grad_(True)
+        pred = engine.model(x)["pred"]
+        last = pred[0, -1]
+        grads, = torch.autograd.grad(last[last.argmax()], x)
+    plane = x.shape[2] // 2
+    saliency = (grads * x).detach().abs().sum(dim=3)[0, -1, plane]
+    saliency = cv2.GaussianBlur(saliency.numpy(), (0, 0), sigmaX=3)
+    return x[0, -1, plane].detach(), _normalize(torch.from_numpy(saliency)[None])[0]
+
+
+def render_overlay(frame, cam):
+    """PNG bytes of a normalized frame (C x H x W) with the saliency map blended on top."""
+    rgb = frame.float().permute(1, 2, 0).numpy() * _STD + _MEAN
+    bgr = cv2.cvtColor(np.clip(rgb * 255, 0, 255).astype(np.uint8), cv2.COLOR_RGB2BGR)
+    heat = cv2.resize(cam.numpy().astype(np.float32), (bgr.shape[1], bgr.shape[0]), interpolation=cv2.INTER_CUBIC)
+    heat = cv2.applyColorMap(np.clip(heat * 255, 0, 255).astype(np.uint8), cv2.COLORMAP_JET)
+    ok, buf = cv2.imencode(".png", cv2.addWeighted(bgr, 1 - OVERLAY_ALPHA, heat, OVERLAY_ALPHA, 0))
+    if not ok:
+        raise HeatmapUnavailable("PNG encoding failed")
+    return buf.tobytes()
+
+
+# ---- service -----------------------------------------------------------------
+
+class HeatmapService:
+    """On-demand, batched, cached heatmaps for stored results."""
+
+    def __init__(self, engine, model_version):
+        self.engine = engine
+        self.model_tag = hashlib.sha1(model_version.encode()).hexdigest()[:12]
+        self.inputs = InputCache()
+        self._queue = queue.Queue()
+        self._worker = None
+        self._worker_pid = None
+        self._start_lock = threading.Lock()
+
+    def remember(self, content_hash, frame=None, sequence=None):
+        """Keeps an analysis input for later heatmaps (never fails the analysis)."""
+        try:
+            self.inputs.put(content_hash, frame=frame, sequence=sequence)
+        except Exception as e:
+            log.warning("could not keep input", extra=fields(error=str(e)))
+
+    def _png_path(self, content_hash, target):
+        return cache_path("heatmaps", f"{content_hash}-{self.model_tag}-{target}.png")
+
+    def heatmap(self, content_hash, target):
+        """PNG bytes for a stored analysis input and target head."""
+        if target not in TARGETS:
+            raise ValueError(f"Unknown heatmap target '{target}'. Options: {list(TARGETS)}")
+        path = self._png_path(content_hash, target)
+        if os.path.exists(path):
+            metrics.incr("heatmap.png_cache_hit")
+            with open(path, "rb") as f:
+                return f.read()
+
+        entry = self.inputs.get(content_hash)
+        if entry is None:
+            raise HeatmapUnavailable("The analysis input is no longer cached; re-run the analysis to view its heatmap")
+        start = time.perf_counter()
+        if target == "staging":
+            if self.engine.model is None or "sequence" not in entry:
+                raise HeatmapUnavailable("Staging saliency needs a time-lapse analysis and the staging model")
+            frame, cam = staging_saliency(self.engine, entry["sequence"])
+            png = render_overlay(frame, cam)
+        else:
+            if self.engine.gardner_model is None or "frame" not in entry:
+                raise HeatmapUnavailable("Gardner heatmaps need GardnerNet and a graded frame")
+            cams = self._submit(entry["frame"][0])
+            # All three heads come out of the same pass: cache them together
+            for head, cam in cams.items():
+                png_head = render_overlay(entry["frame"][0], cam)
+                with open(self._png_path(content_hash, head) + ".tmp", "wb") as f:
+                    f.write(png_head)
+                os.replace(self._png_path(content_hash, head) + ".tmp", self._png_path(content_hash, head))
+                if head == target:
+                    png = png_head
+        metrics.observe(f"heatmap.compute_seconds.{'staging' if target == 'staging' else 'gardner'}",
+                        time.perf_counter() - start)
+        if target == "staging":
+            with open(path + ".tmp", "wb") as f:
+                f.write(png)
+            os.replace(path + ".tmp", path)
+        return png
+
+    # ---- Gardner batching ----------------------------------------------------
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker_pid == os.getpid() and self._worker.is_alive():
+            return
+        with self._start_lock:
+            if self._worker is None or self._worker_pid != os.getpid() or not self._worker.is_alive():
+                self._queue = queue.Queue()
+                self._worker_pid = os.getpid()
+                self._worker = threading.Thread(target=self._batch_loop, name="heatmap-batcher", daemon=True)
+                self._worker.start()
+
+    def _submit(self, frame):
+        """Grad-CAMs {head: h x w} for one C x H x W frame, computed in a shared batch."""
+        self._ensure_worker()
+        request = {"frame": frame, "done": threading.Event(), "result": None, "error": None}
+        self._queue.put(request)
+        while not request["done"].wait(0.1):
+            checkpoint()
+        if request["error"] is not None:
+            raise request["error"]
+        return request["result"]
+
+    def _batch_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + BATCH_WINDOW
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self._queue.get(timeout=max(0.0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                frames = torch.stack([r["frame"].float() for r in batch])
+                cams = gardner_gradcam(self.engine.gardner_model, frames)
+                metrics.observe("heatmap.batch_size", len(batch))
+                for i, r in enumerate(batch):
+                    r["result"] = {head: cam[i] for head, cam in cams.items()}
+            except Exception as e:
+                for r in batch:
+                    r["error"] = e
+            for r in batch:
+                r["done"].set()
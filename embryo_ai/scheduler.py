@@ -0,0 +1,265 @@
+"""
+Analysis Job Scheduler
+
+Sits in front of AIService so short interactive work is not stuck behind
+multi-minute time-lapse jobs:
+
+  - priority classes: "image" jobs are always taken before "video" jobs, and
+    video jobs may only occupy VIDEO_SLOTS of the SLOTS worker threads, so at
+    least one slot stays free for images
+  - per-request deadlines: jobs whose deadline passes while queued never start
+  - cooperative cancellation: every job runs with a CancelToken; decode,
+    gating and inference call checkpoint() between units of work, which raises
+    JobCancelled once the token is cancelled (client disconnected) or the
+    deadline has passed
+
+Code deeper in the pipeline does not need the token passed in: checkpoint()
+reads the token of the job running on the current thread.
+"""
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+import metrics
+import simulation
+import structured_log
+
+log = structured_log.get_logger("scheduler")
+
+PRIORITY_CLASSES = {"image": 0, "video": 1}
+SLOTS = int(os.getenv("EMBRYO_SCHEDULER_SLOTS", "2"))
+VIDEO_SLOTS = int(os.getenv("EMBRYO_SCHEDULER_VIDEO_SLOTS", str(max(1, SLOTS - 1))))
+MAX_QUEUE = int(os.getenv("EMBRYO_SCHEDULER_MAX_QUEUE", "64"))
+DEFAULT_DEADLINES = {
+    "image": float(os.getenv("EMBRYO_DEADLINE_IMAGE", "60")),
+    "video": float(os.getenv("EMBRYO_DEADLINE_VIDEO", "900")),
+}
+# How often the API checks whether the client is still connected
+DISCONNECT_POLL_SECONDS = float(os.getenv("EMBRYO_DISCONNECT_POLL_SECONDS", "0.5"))
+
+
+class JobCancelled(BaseException):
+    """
+    Raised at a checkpoint when a job is cancelled or past its deadline.
+
+    Derives from BaseException (like asyncio.CancelledError) so the pipeline's
+    broad `except Exception` fallbacks don't turn a cancellation into an
+    "ERR" grade result.
+    """
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class QueueFull(Exception):
+    pass
+
+
+class CancelToken:
+    def __init__(self, deadline=None):
+        self.deadline = deadline  # time.monotonic() value, or None
+        self.reason = None
+        self._event = threading.Event()
+
+    def cancel(self, reason="cancelled"):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    @property
+    def cancelled(self):
+        if not self._event.is_set() and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel("deadline exceeded")
+        return self._event.is_set()
+
+    def check(self):
+        if self.cancelled:
+            raise JobCancelled(self.reason)
+
+
+_current_token = contextvars.ContextVar("embryo_cancel_token", default=None)
+
+
+def current_token():
+    return _current_token.get()
+
+
+def checkpoint():
+    """Cancellation point: raises JobCancelled if the current job should stop. No-op outside jobs."""
+    token = _current_token.get()
+    if token is not None:
+        token.check()
+
+
+class _Job:
+    __slots__ = ("priority_class", "fn", "args", "kwargs", "token", "future", "submitted", "request_id")
+
+    def __init__(self, priority_class, fn, args, kwargs, token):
+        self.priority_class = priority_class
+        self.fn, self.args, self.kwargs = fn, args, kwargs
+        self.token = token
+        self.future = Future()
+        self.submitted = time.monotonic()
+        # Log lines written by the worker thread keep the submitting request's id
+        self.request_id = structured_log.current_request_id()
+
+
+class Scheduler:
+    def __init__(self, slots=None, video_slots=None, max_queue=None):
+        self.slots = slots or SLOTS
+        self.video_slots = min(video_slots or VIDEO_SLOTS, self.slots)
+        self.max_queue = max_queue or MAX_QUEUE
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._running = {name: 0 for name in PRIORITY_CLASSES}
+        self._workers = []
+        self._pid = None
+
+    def _ensure_workers(self):
+        # Threads don't survive fork: start them lazily in the process that serves requests
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._heap, self._running = [], {name: 0 for name in PRIORITY_CLASSES}
+            self._workers = [threading.Thread(target=self._worker_loop, name=f"analysis-worker-{i}", daemon=True)
+                             for i in range(self.slots)]
+            for w in self._workers:
+                w.start()
+            self._pid = os.getpid()
+
+    def submit(self, fn, *args, priority="image", deadline=None, token=None, **kwargs):
+        """
+        Queues fn(*args, **kwargs) in a priority class.
+
+        Args:
+            deadline: seconds from now (default per class); the job is cancelled
+                at its next checkpoint once it expires
+        Returns:
+            (Future, CancelToken)
+        """
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority class '{priority}'. Options: {list(PRIORITY_CLASSES)}")
+        self._ensure_workers()
+        deadline = DEFAULT_DEADLINES[priority] if deadline is None else deadline
+        token = token or CancelToken()
+        if token.deadline is None and deadline > 0:
+            token.deadline = time.monotonic() + deadline
+        job = _Job(priority, fn, args, kwargs, token)
+        with self._cond:
+            if len(self._heap) >= self.max_queue:
+                metrics.incr("scheduler.rejected.queue_full")
+                raise QueueFull(f"Analysis queue is full ({self.max_queue} jobs)")
+            # Earliest deadline first within a class, FIFO on ties
+            key = (PRIORITY_CLASSES[priority], token.deadline or float("inf"), next(self._seq))
+            heapq.heappush(self._heap, (key, job))
+            self._cond.notify_all()
+        metrics.incr(f"scheduler.submitted.{priority}")
+        return job.future, token
+
+    def _next_job(self):
+        """Highest-priority queued job this slot may run (caller holds the lock)."""
+        skipped, job = [], None
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            candidate = entry[1]
+            if candidate.priority_class == "video" and self._running["video"] >= self.video_slots:
+                skipped.append(entry)
+                continue
+            job = candidate
+            break
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+        return job
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                self._running[job.priority_class] += 1
+            try:
+                self._run(job)
+            finally:
+                with self._cond:
+                    self._running[job.priority_class] -= 1
+                    self._cond.notify_all()
+
+    def _run(self, job):
+        if not job.future.set_running_or_notify_cancel():
+            metrics.incr("scheduler.dropped_before_start")
+            return
+        metrics.observe(f"scheduler.wait_seconds.{job.priority_class}", time.monotonic() - job.submitted)
+        ctx_token = _current_token.set(job.token)
+        rid_token = structured_log.set_request_id(job.request_id)
+        start = time.perf_counter()
+        try:
+            job.token.check()  # expired or abandoned while queued
+            with simulation.recording(getattr(job.fn, "__name__", "job"), job.priority_class) as record:
+                result = job.fn(*job.args, **job.kwargs)
+                record["rejected"] = isinstance(result, dict) and "error" in result
+            job.future.set_result(result)
+        except JobCancelled as e:
+            metrics.incr("scheduler.cancelled." + e.reason.replace(" ", "_"))
+            log.info("job stopped", extra=structured_log.fields(priority=job.priority_class, reason=e.reason))
+            job.future.set_exception(e)
+        except Exception as e:
+            job.future.set_exception(e)
+        finally:
+            structured_log.reset_request_id(rid_token)
+            _current_token.reset(ctx_token)
+            metrics.observe(f"scheduler.run_seconds.{job.priority_class}", time.perf_counter() - start)
+
+    def stats(self):
+        with self._cond:
+            queued = {name: 0 for name in PRIORITY_CLASSES}
+            for _, job in self._heap:
+                queued[job.priority_class] += 1
+            return {"slots": self.slots, "video_slots": self.video_slots,
+                    "queued": queued, "running": dict(self._running)}
+
+    async def run(self, fn, *args, priority="image", deadline=None, is_disconnected=None, **kwargs):
+        """
+        Awaitable submit: waits for the job without blocking the event loop.
+
+        `is_disconnected` (e.g. starlette Request.is_disconnected) is polled
+        while the job is queued or running; a disconnect cancels the token so
+        the job stops at its next checkpoint.
+        """
+        future, token = self.submit(fn, *args, priority=priority, deadline=deadline, **kwargs)
+        waiter = asyncio.wrap_future(future)
+        while True:
+            done, _ = await asyncio.wait({waiter}, timeout=DISCONNECT_POLL_SECONDS)
+            if done:
+                return waiter.result()
+            if is_disconnected is not None and await is_disconnected():
+                token.cancel("client disconnected")
+            # Deadline also checked here so a job stuck between checkpoints still reports on time
+            if token.cancelled:
+                future.cancel()  # drops it if still queued; a running job stops at its next checkpoint
+                raise JobCancelled(token.reason)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Process-wide scheduler (created on first use)."""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = Scheduler()
+    return _scheduler
@@ -0,0 +1,244 @@
+"""
+Variable-Length Sequence Batching
+
+Time-lapse inputs are sampled to different lengths (min(sample count, total
+frames)), so concurrent video analyses used to run the staging model one
+video at a time. SequenceBatcher lets analysis threads that reach the staging
+forward within a short window share one pass:
+
+  - packed: the ResNet frame encoder (model.visualModel) runs over every frame
+    of every video as one flat batch, the per-video features go through the
+    LSTM (tempModel.lstmTempMod) as a PackedSequence and the per-frame head
+    (tempModel.linTempMod) is applied; outputs are split back per request
+  - padded: if the model doesn't expose that split, shorter videos are
+    right-padded to the longest and the whole model runs once; the LSTM is
+    causal, so frames before the padding are unaffected and the padding is
+    sliced off again
+
+Both modes are checked against single-video forwards before they are used,
+once per focal plane count (the packed path assumes a plane layout of the
+encoder output); if neither matches, videos run one by one as before. The packed path
+also skips encoding near-duplicate frames (see frame_skip.py), which is why
+single videos go through it too when skipping is on.
+"""
+
+import os
+import threading
+import time
+
+import torch
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence, pad_sequence
+
+import frame_skip
+import metrics
+from scheduler import JobCancelled, checkpoint, get_scheduler
+
+SEQ_BATCH_MODE = os.getenv("EMBRYO_SEQ_BATCH", "on").lower()
+# How long the first video waits for others to join its forward
+WINDOW_SECONDS = float(os.getenv("EMBRYO_SEQ_BATCH_WINDOW_MS", "25")) / 1000.0
+MAX_SEQUENCES = int(os.getenv("EMBRYO_SEQ_BATCH_MAX", "8"))
+# Caps the flat encoder batch (sum of frames x planes over the batch)
+MAX_FRAMES = int(os.getenv("EMBRYO_SEQ_BATCH_MAX_FRAMES", "400"))
+# Max abs logit difference vs single-video forwards for a mode to be enabled
+PARITY_TOLERANCE = float(os.getenv("EMBRYO_SEQ_BATCH_TOLERANCE", "1e-3"))
+
+
+def _frames(work):
+    return work.shape[1] * work.shape[2]
+
+
+def _split_modules(model):
+    """(frame encoder, LSTM, per-frame head) if the staging model exposes them, else None."""
+    visual, temp = getattr(model, "visualModel", None), getattr(model, "tempModel", None)
+    lstm, head = getattr(temp, "lstmTempMod", None), getattr(temp, "linTempMod", None)
+    if visual is None or not isinstance(lstm, torch.nn.LSTM) or head is None:
+        return None
+    return visual, lstm, head
+
+
+class SequenceBatcher:
+    """Runs staging forwards for (1 x T x P x C x H x W) videos of any length, batched across threads."""
+
+    def __init__(self, engine, window=None, max_sequences=None, max_frames=None):
+        self.engine = engine
+        self.window = WINDOW_SECONDS if window is None else window
+        self.max_sequences = max_sequences or MAX_SEQUENCES
+        self.max_frames = max_frames or MAX_FRAMES
+        self.modes = {}  # planes -> "packed" / "padded" / "single", decided on first batched forward
+        self._split_available = _split_modules(engine.model) is not None
+        self._lock = threading.Lock()
+        self._pending = []
+        self._leader_active = False
+
+    # ---- forwards --------------------------------------------------------
+
+    def _forward_packed(self, works, skip=False):
+        visual, lstm, head = _split_modules(self.engine.model)
+        lengths = [w.shape[1] for w in works]
+        # Near-duplicate frames reuse the features of the last encoded frame
+        plans = [frame_skip.plan_keyframes(w) if skip else (list(range(t)), list(range(t)))
+                 for w, t in zip(works, lengths)]
+        with torch.no_grad(), self.engine._autocast():
+            # One encoder batch over the (key)frames of all videos: 1 x sum(K) x P x C x H x W
+            feats = visual(torch.cat([w[:, keys] for w, (keys, _) in zip(works, plans)], dim=1))
+            feats = feats["x"] if isinstance(feats, dict) else feats
+            feats = feats.reshape(sum(len(keys) for keys, _ in plans), -1)
+            gather, offset = [], 0
+            for keys, source in plans:
+                gather.extend(offset + k for k in source)
+                offset += len(keys)
+            sequences = torch.split(feats[torch.tensor(gather)], lengths)
+            padded = pad_sequence(sequences, batch_first=lstm.batch_first)
+            packed = pack_padded_sequence(padded, torch.tensor(lengths), batch_first=lstm.batch_first,
+                                          enforce_sorted=False)
+            out, _ = pad_packed_sequence(lstm(packed)[0], batch_first=True)
+            pred = head(out).float()
+        return [pred[i:i + 1, :t] for i, t in enumerate(lengths)]
+
+    def _forward_padded(self, works):
+        longest = max(w.shape[1] for w in works)
+        batch = torch.cat([torch.nn.functional.pad(w, (0, 0, 0, 0, 0, 0, 0, 0, 0, longest - w.shape[1]))
+                           for w in works])
+        pred = self.engine._run_staging(batch)
+        return [pred[i:i + 1, :w.shape[1]] for i, w in enumerate(works)]
+
+    def _verify(self, planes):
+        """Picks the first batched mode whose outputs match single-video forwards for `planes` focal planes."""
+        size = self.engine.img_size
+        gen = torch.Generator().manual_seed(0)
+        works = [torch.randn(1, t, planes, 3, size, size, generator=gen) for t in (3, 5)]
+        reference = [self.engine._run_staging(w) for w in works]
+        candidates = (["packed"] if _split_modules(self.engine.model) else []) + ["padded"]
+        for mode in candidates:
+            try:
+                out = getattr(self, f"_forward_{mode}")(works)
+                diff = max(float((o - r).abs().max()) for o, r in zip(out, reference))
+            except Exception as e:
+                print(f"SequenceBatch: {mode} mode failed verification (P={planes}): {e}")
+                continue
+            if diff <= PARITY_TOLERANCE:
+                print(f"SequenceBatch: {mode} mode enabled for P={planes} (max |diff| vs single {diff:.1e})")
+                return mode
+            print(f"SequenceBatch: {mode} mode differs from single forwards for P={planes} (max |diff| {diff:.2e})")
+        print(f"SequenceBatch: no batched mode matches for P={planes}, videos run one by one")
+        return "single"
+
+    def ensure_mode(self, planes=1):
+        """Batched mode in effect for inputs with `planes` focal planes, verifying it on first use."""
+        if planes not in self.modes:
+            with self._lock:
+                if planes not in self.modes:
+                    self.modes[planes] = self._verify(planes)
+        return self.modes[planes]
+
+    def run_batch(self, works):
+        """
+        Per-video FP32 logits (1 x T_i x Classes) for a list of 1 x T_i x P x C x H x W
+        tensors, in as few forwards as possible. Videos with different focal
+        plane counts or frame sizes run in separate groups.
+        """
+        skip_enabled = frame_skip.SKIP_THRESHOLD > 0 and self._split_available
+        if len(works) == 1 and not skip_enabled:
+            return [self.engine._run_staging(works[0])]
+
+        results = [None] * len(works)
+        groups = {}
+        for i, w in enumerate(works):
+            groups.setdefault(tuple(w.shape[2:]), []).append(i)
+        for shape, members in groups.items():
+            mode = self.ensure_mode(shape[0])
+            skipping = skip_enabled and mode == "packed"
+            if mode == "single" or (len(members) == 1 and not skipping):
+                for i in members:
+                    results[i] = self.engine._run_staging(works[i])
+                continue
+            group = [works[i] for i in members]
+            out = self._forward_packed(group, skip=skipping) if mode == "packed" else self._forward_padded(group)
+            if skipping:
+                for w, pred in zip(group, out):
+                    if frame_skip.should_audit():
+                        frame_skip.record_agreement(pred, self.engine._run_staging(w))
+            lengths = [w.shape[1] for w in group]
+            metrics.observe("seq_batch.size", len(group))
+            if mode == "padded":
+                metrics.observe("seq_batch.padding_ratio", 1.0 - sum(lengths) / (max(lengths) * len(lengths)))
+            for i, pred in zip(members, out):
+                results[i] = pred
+        return results
+
+    # ---- cross-request batching -----------------------------------------
+
+    def run(self, work):
+        """
+        Staging logits (1 x T x Classes) for one video, sharing the forward with
+        other threads that call run() within the batching window.
+        """
+        if SEQ_BATCH_MODE != "on":
+            return self.engine._run_staging(work)
+        if self.window <= 0:
+            return self.run_batch([work])[0]
+        request = {"work": work, "done": threading.Event(), "lead": False, "result": None, "error": None}
+        with self._lock:
+            self._pending.append(request)
+            lead = not self._leader_active
+            self._leader_active = True
+        if not lead:
+            self._wait(request)
+            if not request["lead"]:
+                return self._result(request)
+        self._lead(request)
+        return self._result(request)
+
+    def _wait(self, request):
+        try:
+            while not request["done"].wait(0.1):
+                checkpoint()
+        except JobCancelled:
+            with self._lock:
+                if request in self._pending:
+                    self._pending.remove(request)
+                if request["lead"]:
+                    self._hand_over()
+            raise
+
+    def _lead(self, request):
+        # Only wait for company when another video analysis is actually running
+        if get_scheduler().stats()["running"]["video"] > 1:
+            time.sleep(self.window)
+        with self._lock:
+            # The leader is always first in line; a video over the frame cap still runs, alone
+            batch, frames = [], 0
+            for r in list(self._pending):
+                if batch and (len(batch) >= self.max_sequences or frames + _frames(r["work"]) > self.max_frames):
+                    break
+                batch.append(r)
+                frames += _frames(r["work"])
+                self._pending.remove(r)
+        try:
+            outputs = self.run_batch([r["work"] for r in batch])
+            for r, pred in zip(batch, outputs):
+                r["result"] = pred
+        except BaseException as e:
+            for r in batch:
+                r["error"] = e
+        finally:
+            metrics.incr("seq_batch.forwards")
+            with self._lock:
+                self._hand_over()
+            for r in batch:
+                if r is not request:
+                    r["done"].set()
+
+    def _hand_over(self):
+        """Next queued request leads the following batch (caller holds the lock)."""
+        if self._pending:
+            nxt = self._pending[0]
+            nxt["lead"] = True
+            nxt["done"].set()
+        else:
+            self._leader_active = False
+
+    def _result(self, request):
+        if request["error"] is not None:
+            raise request["error"]
+        return request["result"]
@@ -0,0 +1,293 @@
+"""
+Image-Sequence Time-Lapse Ingestion
+
+Clinical time-lapse systems export per-timepoint images, often with several
+focal planes, instead of video containers. This module reads:
+
+  - frame directories     (planes as sub-folders like F-15/F0/F15, or _F/_Z tokens)
+  - zip archives          (same layout; stored members are decoded straight
+                           from a memory-mapped archive)
+  - multi-page TIFF stacks (8/16-bit; memory-mapped or page-by-page)
+
+Each source exposes the same interface as video_sampling.VideoFrameSource
+(frame_count, read(indices)) plus focal planes, so load_input can sample
+timepoints and planes without loading the whole export.
+"""
+
+import io
+import mmap
+import os
+import re
+import struct
+import zipfile
+
+import cv2
+import numpy as np
+
+try:
+    import tifffile
+    HAS_TIFFFILE = True
+except ImportError:
+    HAS_TIFFFILE = False
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp")
+SEQUENCE_EXTS = (".zip", ".tif", ".tiff")
+
+# Number of focal planes fed to the staging model (P axis), centred on the in-focus plane
+FOCAL_PLANES = int(os.getenv("EMBRYO_FOCAL_PLANES", "1"))
+
+_PLANE_PATTERNS = [re.compile(p, re.IGNORECASE) for p in (r"(?:^|[_\-/ ])F(-?\d+)(?=$|[_\-./ ])",
+                                                          r"(?:^|[_\-/ ])Z(-?\d+)(?=$|[_\-./ ])",
+                                                          r"focal[_\-]?(-?\d+)")]
+_TIME_PATTERNS = [re.compile(p, re.IGNORECASE) for p in (r"RUN(\d+)", r"(?:^|[_\-/ ])T(\d+)(?=$|[_\-./ ])",
+                                                         r"(?:^|[_\-/ ])t(\d+)", r"(\d+)(?!.*\d)")]
+
+
+def _match_int(patterns, text, default=None):
+    for pattern in patterns:
+        m = pattern.search(text)
+        if m:
+            return int(m.group(1))
+    return default
+
+
+def _parse_entries(names):
+    """Groups image names into {plane: [(timepoint, name), ...]} sorted by time."""
+    planes = {}
+    for name in names:
+        if not name.lower().endswith(IMAGE_EXTS) or os.path.basename(name).startswith("."):
+            continue
+        stem = os.path.splitext(name)[0]
+        plane = _match_int(_PLANE_PATTERNS, stem, default=0)
+        # Timepoint from the file name only, with plane tokens removed so they can't be mistaken for it
+        base = os.path.basename(stem)
+        for pattern in _PLANE_PATTERNS:
+            base = pattern.sub("_", base)
+        timepoint = _match_int(_TIME_PATTERNS, base, default=None)
+        planes.setdefault(plane, []).append((timepoint, name))
+
+    for plane, entries in planes.items():
+        # Unnumbered files keep lexical order
+        entries.sort(key=lambda e: (e[0] is None, e[0] if e[0] is not None else 0, e[1]))
+    return planes
+
+
+def _to_bgr8(img, scale=None):
+    """Converts a decoded frame (gray/BGR, 8/16-bit) to uint8 BGR."""
+    if img.dtype != np.uint8:
+        img = np.clip(img.astype(np.float32) * (scale or 1.0), 0, 255).astype(np.uint8)
+    if img.ndim == 2:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    elif img.shape[2] == 4:
+        img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+    return img
+
+
+def _bit_depth_scale(img):
+    """Scale to 8 bits, guessing 12-bit vs 16-bit sensors from the first frame."""
+    if img.dtype == np.uint8:
+        return 1.0
+    max_value = 4095.0 if img.max() <= 4095 else float(np.iinfo(img.dtype).max if img.dtype.kind in "ui" else img.max() or 1.0)
+    return 255.0 / max_value
+
+
+class _PlanarSource:
+    """Shared plane selection / sampling over a {plane: [entries]} layout."""
+
+    def __init__(self, planes):
+        self._planes = planes
+        self.plane_labels = sorted(planes)
+        self.frame_count = max((len(v) for v in planes.values()), default=0)
+        self.fps = 0.0
+        self._scale = None
+
+    def select_planes(self, count=None):
+        """`count` plane labels nearest to the central (in-focus, offset 0) plane."""
+        count = max(1, min(count or FOCAL_PLANES, len(self.plane_labels)))
+        centre = min(self.plane_labels, key=abs)
+        ranked = sorted(self.plane_labels, key=lambda p: (abs(p - centre), p))
+        return sorted(ranked[:count])
+
+    def _decode(self, plane, t):
+        raise NotImplementedError
+
+    def read(self, indices, planes=None):
+        """Yields (timepoint index, [BGR frame per plane]) for the requested timepoints."""
+        planes = planes or self.select_planes()
+        for t in sorted(set(int(i) for i in indices if 0 <= i < self.frame_count)):
+            stack = []
+            for plane in planes:
+                entries = self._planes[plane]
+                img = self._decode(plane, min(t, len(entries) - 1))
+                if img is None:
+                    break
+                if self._scale is None:
+                    self._scale = _bit_depth_scale(img)
+                stack.append(_to_bgr8(img, self._scale))
+            if len(stack) == len(planes):
+                yield t, stack
+
+    def release(self):
+        pass
+
+
+class DirectorySource(_PlanarSource):
+    def __init__(self, path):
+        names = []
+        for root, _, files in os.walk(path):
+            for f in files:
+                names.append(os.path.relpath(os.path.join(root, f), path))
+        super().__init__(_parse_entries(names))
+        self.path = path
+
+    def _decode(self, plane, t):
+        full = os.path.join(self.path, self._planes[plane][t][1])
+        if full.lower().endswith((".tif", ".tiff")) and HAS_TIFFFILE:
+            return _rgb_to_bgr(tifffile.imread(full))
+        # IMREAD_UNCHANGED keeps 16-bit data
+        return cv2.imread(full, cv2.IMREAD_UNCHANGED)
+
+
+class ZipSource(_PlanarSource):
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        self._zip = zipfile.ZipFile(self._file)
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._infos = {i.filename: i for i in self._zip.infolist() if not i.is_dir()}
+        super().__init__(_parse_entries(self._infos))
+        self.path = path
+
+    def _member_bytes(self, info):
+        if info.compress_type == zipfile.ZIP_STORED:
+            # Local file header: 30 fixed bytes + name + extra field, then the raw data
+            header = self._mm[info.header_offset:info.header_offset + 30]
+            name_len, extra_len = struct.unpack("<HH", header[26:30])
+            start = info.header_offset + 30 + name_len + extra_len
+            return np.frombuffer(self._mm, dtype=np.uint8, count=info.compress_size, offset=start)
+        return np.frombuffer(self._zip.read(info), dtype=np.uint8)
+
+    def _decode(self, plane, t):
+        info = self._infos[self._planes[plane][t][1]]
+        return cv2.imdecode(self._member_bytes(info), cv2.IMREAD_UNCHANGED)
+
+    def release(self):
+        self._zip.close()
+        try:
+            self._mm.close()
+        except BufferError:
+            pass  # a decoded view still references the map; it is freed with it
+        self._file.close()
+
+
+def _rgb_to_bgr(img):
+    """tifffile / PIL return RGB(A); OpenCV consumers expect BGR."""
+    if img.ndim == 3 and img.shape[2] >= 3:
+        return np.ascontiguousarray(img[:, :, 2::-1])
+    return img
+
+
+class TiffStackSource(_PlanarSource):
+    """Multi-page TIFF: axes from the OME/ImageJ series if tifffile is present, else pages = time."""
+
+    def __init__(self, path):
+        self.path = path
+        self._array = None
+        self._pil = None
+        if HAS_TIFFFILE:
+            self._tif = tifffile.TiffFile(path)
+            series = self._tif.series[0]
+            axes = series.axes.upper().replace("I", "T").replace("Q", "T")
+            shape = series.shape
+            # Non-spatial axes enumerate the pages (e.g. T, Z, C)
+            self._page_axes = [a for a in axes if a not in "YXS"]
+            self._page_shape = [shape[i] for i, a in enumerate(axes) if a not in "YXS"]
+            self._n_spatial = len(axes) - len(self._page_axes)
+            try:
+                # Uncompressed contiguous data maps straight from disk
+                self._array = tifffile.memmap(path)
+            except Exception:
+                self._array = None
+            if "T" in self._page_axes:
+                t_count = self._page_shape[self._page_axes.index("T")]
+            elif "Z" in self._page_axes:
+                t_count = 1
+            else:
+                t_count = len(self._tif.pages)
+            z_count = self._page_shape[self._page_axes.index("Z")] if "Z" in self._page_axes else 1
+        else:
+            from PIL import Image
+            self._pil = Image.open(path)
+            t_count, z_count = getattr(self._pil, "n_frames", 1), 1
+
+        planes = {z - z_count // 2: [(t, None) for t in range(t_count)] for z in range(z_count)}
+        super().__init__(planes)
+        self._z_count = z_count
+
+    @property
+    def is_stack(self):
+        return self.frame_count > 1 or self._z_count > 1
+
+    def _page_index(self, t, z):
+        if "T" not in self._page_axes and "Z" not in self._page_axes:
+            return t
+        coords = [t if a == "T" else z if a == "Z" else 0 for a in self._page_axes]
+        return int(np.ravel_multi_index(coords, self._page_shape))
+
+    def _decode(self, plane, t):
+        if self._pil is not None:
+            self._pil.seek(t)
+            return _rgb_to_bgr(np.array(self._pil))
+        page = self._page_index(t, plane + self._z_count // 2)
+        if self._array is not None:
+            flat = self._array.reshape((-1,) + self._array.shape[-self._n_spatial:])
+            # Only this page is paged in from the mapping
+            return _rgb_to_bgr(np.array(flat[page]))
+        return _rgb_to_bgr(self._tif.pages[page].asarray())
+
+    def release(self):
+        if self._pil is not None:
+            self._pil.close()
+        elif HAS_TIFFFILE:
+            self._array = None
+            self._tif.close()
+
+
+def tiff_timepoints(data) -> int:
+    """Timepoints in an in-memory TIFF (1 for a still), from the page structure only."""
+    try:
+        source = TiffStackSource(io.BytesIO(data))
+    except Exception:
+        return 1
+    try:
+        return source.frame_count
+    finally:
+        source.release()
+
+
+def is_sequence_path(path) -> bool:
+    return os.path.isdir(path) or path.lower().endswith(SEQUENCE_EXTS)
+
+
+def open_sequence(path):
+    """
+    Opens a frame directory, zip archive or TIFF stack.
+
+    Returns None for inputs that are not multi-frame sequences (e.g. a
+    single-page TIFF, which should go through the single-image path).
+    """
+    if os.path.isdir(path):
+        source = DirectorySource(path)
+    elif path.lower().endswith(".zip"):
+        source = ZipSource(path)
+    elif path.lower().endswith((".tif", ".tiff")):
+        source = TiffStackSource(path)
+        if not source.is_stack:
+            source.release()
+            return None
+    else:
+        return None
+
+    if source.frame_count == 0:
+        source.release()
+        return None
+    return source
@@ -0,0 +1,192 @@
+"""
+Preload-then-Fork Server
+
+Loads every model (staging ResNet18-LSTM, GardnerNet, CLIP gate) ONCE in a
+parent process, freezes the garbage collector and then forks the uvicorn
+workers. Workers inherit the weight pages copy-on-write (memory-mapped weights
+stay backed by the page cache) instead of each building its own AIService.
+
+Usage:
+    python serve.py --workers 8 --port 8000
+    python serve.py --workers 8 --report-interval 60   # periodic RSS report
+    python serve.py --raw-socket /run/embryo/raw.sock  # + local raw frame ingestion
+"""
+
+import argparse
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+if CURRENT_DIR not in sys.path:
+    sys.path.append(CURRENT_DIR)
+
+from process_memory import worker_memory_report
+from runtime_config import apply_runtime_settings, load_tuning
+
+
+def _preload_models():
+    """Imports the app (which builds AIService) and loads the lazy CLIP gate."""
+    import torch
+
+    # No intra-op parallel region may run in the parent: an OpenMP pool that
+    # was active before fork() can deadlock in the children.
+    torch.set_num_threads(1)
+    os.environ["EMBRYO_PRELOADING"] = "1"
+
+    import main
+    if main.ai_service is None:
+        print("PRELOAD: AIService failed to initialize. Refusing to fork workers.")
+        sys.exit(1)
+    if getattr(main.ai_service, "simulated", False):
+        return main.app  # capacity simulation: no weights to share
+
+    modules = [main.ai_service._engine.model, main.ai_service._engine.gardner_model]
+    try:
+        import embryo_gate
+        clip_model, _ = embryo_gate._load_clip()
+        modules.append(clip_model)
+    except Exception as e:
+        print(f"PRELOAD: CLIP gate could not be preloaded ({e}). Workers will load it lazily.")
+
+    # Workers share the weights copy-on-write (plus gc.freeze() below); no
+    # share_memory(), which would copy memory-mapped weights into /dev/shm
+    for module in modules:
+        if module is None:
+            continue
+        for param in module.parameters():
+            param.requires_grad_(False)
+
+    return main.app
+
+
+def _bind_socket(host, port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _run_worker(app, sock, index, args):
+    """Body of a forked worker: serve on the inherited listening socket."""
+    import uvicorn
+
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    os.environ["EMBRYO_WORKER_INDEX"] = str(index)
+
+    tuning = load_tuning()
+    if args.threads or not tuning:
+        tuning = dict(tuning, intra_op_threads=args.threads or max(1, (os.cpu_count() or 1) // args.workers))
+    apply_runtime_settings(worker_index=index, tuning=tuning)
+
+    config = uvicorn.Config(app, host=args.host, port=args.port, access_log=args.access_log)
+    server = uvicorn.Server(config)
+    server.run(sockets=[sock])
+    os._exit(0)
+
+
+def _fork_worker(app, sock, index, args):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            _run_worker(app, sock, index, args)
+        except BaseException as e:
+            print(f"PRELOAD: Worker {index} crashed: {e}")
+        os._exit(1)
+    return pid
+
+
+def _print_report():
+    report = worker_memory_report(os.getpid())
+    print(f"MEMORY REPORT: group PSS {report['total_pss_mb']} MB "
+          f"(unique {report['total_unique_mb']} MB, naive RSS sum {report['total_rss_mb']} MB)")
+    for w in report["workers"]:
+        print(f"   worker {w['pid']}: rss={w['rss_mb']} MB unique={w['unique_mb']} MB shared={w['shared_mb']} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EMprion preload-then-fork server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", "8000")))
+    tuned_workers = load_tuning().get("workers") or 2
+    parser.add_argument("--workers", type=int, default=int(os.getenv("EMBRYO_WORKERS", tuned_workers)))
+    parser.add_argument("--threads", type=int, default=0,
+                        help="torch intra-op threads per worker (0 = runtime_tuning.json, else cores / workers)")
+    parser.add_argument("--report-interval", type=float, default=0, help="seconds between memory reports (0 = once)")
+    parser.add_argument("--access-log", action="store_true")
+    parser.add_argument("--raw-socket", default=os.getenv("EMBRYO_RAW_SOCKET", ""),
+                        help="Unix socket path for raw frame ingestion (shared by all workers)")
+    args = parser.parse_args()
+
+    print(f"PRELOAD: Loading models once in parent (pid {os.getpid()})...")
+    app = _preload_models()
+
+    # Everything allocated so far is long-lived: move it out of the GC's view
+    # so collections in the workers don't touch (and un-share) those pages.
+    gc.collect()
+    gc.freeze()
+
+    os.environ["EMBRYO_PRELOAD_PARENT"] = str(os.getpid())
+    # Workers split the container memory budget between them (memory_guard.py)
+    os.environ["EMBRYO_WORKER_COUNT"] = str(args.workers)
+    sock = _bind_socket(args.host, args.port)
+    raw_sock = None
+    if args.raw_socket:
+        import raw_ingest
+        raw_sock = raw_ingest.listening_socket(args.raw_socket)
+        os.environ["EMBRYO_RAW_SOCKET_FD"] = str(raw_sock.fileno())
+        print(f"PRELOAD: Raw frame ingestion on {args.raw_socket}")
+    print(f"PRELOAD: Forking {args.workers} workers on {args.host}:{args.port}")
+
+    workers = {}
+    for i in range(args.workers):
+        workers[_fork_worker(app, sock, i, args)] = i
+
+    stopping = False
+
+    def _shutdown(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, _shutdown)
+    signal.signal(signal.SIGTERM, _shutdown)
+
+    reported = False
+    next_report = time.monotonic() + 5
+    while workers:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid:
+            index = workers.pop(pid, None)
+            if not stopping and index is not None:
+                print(f"PRELOAD: Worker {pid} exited (status {status}). Respawning worker {index}.")
+                workers[_fork_worker(app, sock, index, args)] = index
+            continue
+
+        if not stopping and time.monotonic() >= next_report and (args.report_interval > 0 or not reported):
+            _print_report()
+            reported = True
+            next_report = time.monotonic() + (args.report_interval or 0)
+        time.sleep(0.5)
+
+    sock.close()
+    if raw_sock is not None:
+        raw_sock.close()
+        os.unlink(args.raw_socket)
+
+
+if __name__ == "__main__":
+    main()
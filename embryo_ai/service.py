@@ -20,13 +20,33 @@ except ImportError as e:
 
 # Import the CLIP-based Embryo Gate
 try:
-    from embryo_gate import validate_embryo_image
+    from embryo_gate import validate_embryo_image, validate_embryo_frames, score_embryo_frames, VIDEO_GATE_FRAMES
     HAS_GATE = True
     print("EmbryoGate: CLIP gating available.")
 except ImportError as e:
     print(f"Warning: EmbryoGate not available: {e}. Gating disabled.")
     HAS_GATE = False
 
+from runtime_config import apply_runtime_settings
+from content_cache import sha256_bytes
+from sequence_ingest import SEQUENCE_EXTS
+from embryo_detection import detect_embryos, crop_embryo, track_embryos, MAX_EMBRYOS
+from scheduler import checkpoint, JobCancelled
+from milestone_search import search_milestones
+from saliency import HeatmapService, HeatmapUnavailable
+from image_decode import decode_image, choose_reduction
+from transcode import get_transcoder, ffmpeg_transcode
+import memory_guard
+from memory_guard import MemoryBudgetExceeded, track_stage
+from structured_log import get_logger, fields
+
+log = get_logger("service")
+gate_log = get_logger("gate")
+
+VIDEO_EXTS = ('.mp4', '.avi', '.mkv', '.mov', '.webm')
+# Frames sampled from a dish time-lapse to build stable per-embryo crop tracks
+TRACK_FRAMES = int(os.getenv("EMBRYO_TRACK_FRAMES", "8"))
+
 class AIService:
     _instance = None
     _engine = None
@@ -40,38 +60,96 @@ class AIService:
     def __init__(self):
         if not HAS_ENGINE:
             raise RuntimeError("EmbryoInference engine not found.")
+
+        # Tuned CPU threading must be in place before the first forward pass
+        apply_runtime_settings()
         
         # Initial dummy instance to access _find_best_model
-        temp_engine = EmbryoInference(config_path=None)
+        temp_engine = EmbryoInference(config_path=None, precision="fp32")
         
         # Determine the best config (defaulting to video preference for the general service)
         best_config = temp_engine._find_best_model(is_video=True)
         print(f"AI Service: Initializing with best model: {best_config}")
         
         self._engine = EmbryoInference(config_path=best_config)
+        self._heatmaps = HeatmapService(self._engine, self.model_version())
         print("AI Service: Models loaded successfully.")
 
+    def diagnostics(self):
+        """Model-level settings actually in effect (for the diagnostics endpoint)."""
+        info = {"model_id": self._engine.model_id, "precision": self._engine.precision_report,
+                "compiled": self._engine.compile_report}
+        if HAS_GATE:
+            import embryo_gate
+            info["gate_precision"] = embryo_gate.precision_report()
+        return info
+
+    def model_version(self):
+        """Identifies the weights/precision that produced a result (part of the result-store key)."""
+        return f"{self._engine.model_id}|gardner:{'on' if self._engine.gardner_model is not None else 'off'}|{self._engine.precision}"
+
+    def metrics(self):
+        """Service-level metric views (gate cascade tier shares)."""
+        report = {}
+        if HAS_GATE:
+            import embryo_gate
+            report["gate"] = embryo_gate.gate_stats()
+        return report
+
+    def _memory_plan(self, plan, upload_size, keep_frames=0, gardner_frames=1, sample_count=None, min_frames=None):
+        """Fits a probed input into the per-request memory budget (may reduce sampling)."""
+        if plan is None:
+            return None
+        plan = memory_guard.plan_request(plan, upload_size, self._engine.img_size,
+                                         sample_count or self._engine._sample_count,
+                                         min_frames=self._engine._tr_len() if min_frames is None else min_frames,
+                                         keep_frames=keep_frames, gardner_frames=gardner_frames)
+        if plan.downsampled:
+            get_logger("memory").info("request downsampled", extra=fields(**plan.as_dict()))
+        return plan
+
+    def _decode_image(self, image_bytes, plan=None):
+        """Decodes an upload to BGR at the plan's reduced resolution (see image_decode)."""
+        if plan is None:
+            return decode_image(image_bytes)
+        return decode_image(image_bytes, reduction=plan.reduction, width=plan.width, height=plan.height)
+
     def predict_gardner(self, image_bytes: bytes):
         """
         Runs Gardner grading on a single image.
         """
-        # Convert bytes to numpy array
-        nparr = np.frombuffer(image_bytes, np.uint8)
-        frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        probe = memory_guard.probe_image_bytes(image_bytes)
+        if probe is not None:
+            # Large stills are decoded near model resolution (JPEG: DCT-domain scaling)
+            probe.reduction = choose_reduction(probe.width, probe.height, self._engine.img_size)
+        try:
+            plan = self._memory_plan(probe, len(image_bytes))
+        except MemoryBudgetExceeded as e:
+            return {"error": f"Input Rejected: {e}"}
+        if plan is None:
+            return {"error": "Invalid image data"}
+
+        with memory_guard.reserve(plan):
+            return self._predict_gardner(image_bytes, plan)
+
+    def _predict_gardner(self, image_bytes, plan):
+        with track_stage("decode"):
+            frame = self._decode_image(image_bytes, plan)
         
         if frame is None:
             return {"error": "Invalid image data"}
 
         # INTELLIGENT GATING (CLIP-based): Semantic validation
         if HAS_GATE:
-            is_valid, reason, confidence = validate_embryo_image(frame)
+            with track_stage("gate"):
+                is_valid, reason, confidence = validate_embryo_image(frame)
             if not is_valid:
-                print(f"CLIP GATE REJECTION: {reason}")
+                gate_log.info("gate rejected", extra=fields(input="image", reason=reason, confidence=confidence))
                 return {"error": f"Input Rejected: {reason}. Please upload a valid embryo image."}
-            print(f"CLIP GATE PASSED: {reason}")
+            gate_log.info("gate passed", extra=fields(input="image", reason=reason, confidence=confidence))
         else:
             # CLINICAL SAFETY LOCK: Do not allow analysis if the safety gate is offline
-            print("CRITICAL SAFETY ERROR: Embryo Gate is OFFLINE. Blocking analysis.")
+            gate_log.error("embryo gate offline, analysis blocked")
             return {"error": "Clinical Safety Error: Embryo Validation Gate (CLIP) is unavailable. Analysis blocked for regulatory compliance."}
 
         # Preprocess frame
@@ -79,47 +157,303 @@ class AIService:
         # Add batch and time dims -> 1 x 1 x C x H x W
         tensor = tensor.unsqueeze(0).unsqueeze(0)
         
-        results = self._engine.predict(
-            input_data=tensor,
-            is_video=False,
-            analysis_type="gardner"
-        )
+        with track_stage("inference"):
+            results = self._engine.predict(
+                input_data=tensor,
+                is_video=False,
+                analysis_type="gardner"
+            )
+        # Kept (not rendered) so the heatmap endpoint can work on it later
+        self._heatmaps.remember(sha256_bytes(image_bytes), frame=tensor[:, 0])
         return results
 
+    def predict_gardner_video(self, video_bytes: bytes, filename: str, timeline: bool = False):
+        """
+        Runs Gardner grading on a time-lapse: the sharpest late frame is graded
+        (optionally with the per-frame expansion/ICM/TE timeline).
+        """
+        import tempfile
+
+        suffix = os.path.splitext(filename)[1] or ".mp4"
+        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tfile:
+            tfile.write(video_bytes)
+            temp_path = tfile.name
+        try:
+            keep_frames = VIDEO_GATE_FRAMES if HAS_GATE else 1
+            from inference import BEST_FRAME_TOPK, GARDNER_CHUNK
+            try:
+                plan = self._memory_plan(memory_guard.probe_input(temp_path), len(video_bytes), keep_frames,
+                                         gardner_frames=GARDNER_CHUNK if timeline else BEST_FRAME_TOPK)
+            except MemoryBudgetExceeded as e:
+                return {"error": f"Input Rejected: {e}"}
+            if plan is None:
+                return {"error": "Failed to extract frames from video"}
+
+            with memory_guard.reserve(plan):
+                content_hash = sha256_bytes(video_bytes)
+                with track_stage("decode"):
+                    tensor, gate_frames = self._engine.load_input(temp_path, keep_frames=keep_frames,
+                                                                  content_hash=content_hash,
+                                                                  max_frames=plan.max_frames)
+                if tensor is None:
+                    return {"error": "Failed to extract frames from video"}
+
+                if HAS_GATE:
+                    with track_stage("gate"):
+                        is_valid, reason, confidence = validate_embryo_frames(gate_frames)
+                    if not is_valid:
+                        gate_log.info("gate rejected", extra=fields(input="video", reason=reason, confidence=confidence))
+                        return {"error": f"Input Rejected: {reason}. Please upload a valid embryo video."}
+                    gate_log.info("gate passed", extra=fields(input="video", reason=reason, confidence=confidence))
+                else:
+                    gate_log.error("embryo gate offline, analysis blocked", extra=fields(input="video"))
+                    return {"error": "Clinical Safety Error: Embryo Validation Gate (CLIP) is unavailable. Analysis blocked."}
+
+                del gate_frames
+                with track_stage("inference"):
+                    results = self._engine.predict(
+                        input_data=tensor,
+                        is_video=True,
+                        analysis_type="gardner",
+                        gardner_timeline=timeline
+                    )
+                self._remember_video(content_hash, tensor, results)
+                if suffix.lower() not in SEQUENCE_EXTS:
+                    get_transcoder().submit(content_hash, video_bytes, suffix)
+                return results
+        finally:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+
+    def _remember_video(self, content_hash, tensor, results):
+        """Keeps the staging sequence and the graded (or last) frame for later heatmaps."""
+        sequence = tensor.unsqueeze(2) if tensor.dim() == 5 else tensor
+        best = (results.get("gardner") or {}).get("best_frame_index", sequence.shape[1] - 1)
+        frames = self._engine._timeline_frames(sequence)
+        self._heatmaps.remember(content_hash, frame=frames[best:best + 1], sequence=sequence)
+
+    def heatmap(self, content_hash: str, target: str = "expansion"):
+        """
+        Saliency heatmap PNG for a stored analysis (computed on first request, then cached).
+        Returns {"png": bytes} or {"error": ..., "status": HTTP status}.
+        """
+        try:
+            return {"png": self._heatmaps.heatmap(content_hash, target)}
+        except ValueError as e:
+            return {"error": str(e), "status": 400}
+        except HeatmapUnavailable as e:
+            return {"error": str(e), "status": 404}
+
+    def predict_gardner_multi(self, file_bytes: bytes, filename: str):
+        """
+        Grades every embryo in a dish / multi-well capture (image or time-lapse video).
+
+        Each zona pellucida is detected and cropped (video: tracked over sampled
+        frames for a stable crop), each crop is gated, and all accepted crops are
+        graded in ONE batched GardnerNet forward.
+        """
+        if not HAS_GATE:
+            gate_log.error("embryo gate offline, analysis blocked")
+            return {"error": "Clinical Safety Error: Embryo Validation Gate (CLIP) is unavailable. Analysis blocked for regulatory compliance."}
+
+        is_video = os.path.splitext(filename or "")[1].lower() in VIDEO_EXTS
+        if not is_video:
+            try:
+                plan = self._memory_plan(memory_guard.probe_image_bytes(file_bytes), len(file_bytes),
+                                         gardner_frames=MAX_EMBRYOS)
+            except MemoryBudgetExceeded as e:
+                return {"error": f"Input Rejected: {e}"}
+            if plan is None:
+                return {"error": "Invalid image data"}
+            with memory_guard.reserve(plan):
+                with track_stage("decode"):
+                    ref_frame = self._decode_image(file_bytes, plan)
+                if ref_frame is None:
+                    return {"error": "Invalid image data"}
+                tracks = [{"circle": c, "hits": 1} for c in detect_embryos(ref_frame)]
+                return self._grade_multi(ref_frame, tracks, is_video)
+
+        import tempfile
+        from video_sampling import VideoFrameSource
+        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(filename)[1]) as tfile:
+            tfile.write(file_bytes)
+            temp_path = tfile.name
+        try:
+            # TRACK_FRAMES full-resolution frames are held for tracking
+            try:
+                plan = self._memory_plan(memory_guard.probe_input(temp_path), len(file_bytes),
+                                         keep_frames=TRACK_FRAMES, gardner_frames=MAX_EMBRYOS,
+                                         sample_count=lambda total, cap: min(total, cap or TRACK_FRAMES), min_frames=2)
+            except MemoryBudgetExceeded as e:
+                return {"error": f"Input Rejected: {e}"}
+            if plan is None:
+                return {"error": "Failed to extract frames from video"}
+            with memory_guard.reserve(plan):
+                with track_stage("decode"), VideoFrameSource(temp_path, content_hash=sha256_bytes(file_bytes)) as source:
+                    if source.frame_count <= 0:
+                        return {"error": "Failed to extract frames from video"}
+                    count = min(plan.max_frames or TRACK_FRAMES, source.frame_count)
+                    indices = np.linspace(0, source.frame_count - 1, count, dtype=int)
+                    frames = [frame for _, frame in source.read(indices)]
+                if not frames:
+                    return {"error": "Failed to extract frames from video"}
+                tracks = track_embryos(frames)
+                # Grade the latest appearance of each embryo
+                ref_frame = frames[-1]
+                del frames
+                return self._grade_multi(ref_frame, tracks, is_video)
+        finally:
+            os.unlink(temp_path)
+
+    def _grade_multi(self, ref_frame, tracks, is_video):
+        crops = [crop_embryo(ref_frame, t["circle"]) for t in tracks]
+        with track_stage("gate"):
+            scores, reasons = score_embryo_frames(crops)
+        keep = [i for i, score in enumerate(scores) if score > 0.5]
+        log.info("multi-embryo detections", extra=fields(detections=len(tracks), passed_gate=len(keep)))
+        if not keep:
+            return {"error": f"Input Rejected: No valid embryo detected in the field of view ({reasons[0]})."}
+
+        batch = torch.stack([self._engine._preprocess_frame(crops[i]) for i in keep])
+        with track_stage("inference"):
+            grades = self._engine.grade_batch(batch)
+
+        embryos = []
+        for n, (i, gardner) in enumerate(zip(keep, grades)):
+            x, y, r = tracks[i]["circle"]
+            embryos.append({
+                "embryo_index": n,
+                "circle": {"x": round(x, 1), "y": round(y, 1), "r": round(r, 1)},
+                "track_hits": tracks[i]["hits"],
+                "gate_score": round(float(scores[i]), 4),
+                "gardner": gardner,
+                "concordance": self._engine._generate_concordance(13, gardner.get("grade_confidence", 0.0), gardner, "Day 5", "gardner"),
+            })
+
+        return {
+            "analysis_type": "gardner_multi",
+            "is_video": is_video,
+            "embryo_count": len(embryos),
+            "rejected_detections": len(tracks) - len(keep),
+            "frame_size": {"width": int(ref_frame.shape[1]), "height": int(ref_frame.shape[0])},
+            "embryos": embryos,
+            "details": f"Model: {self._engine.model_id}\nPipeline: GARDNER (MULTI-EMBRYO)"
+        }
+
     def _convert_to_mp4(self, source_path):
-        """Converts any video to H.264 MP4 using system ffmpeg."""
-        import subprocess
-        
-        # Create output path
-        base_name = os.path.splitext(source_path)[0]
-        output_path = base_name + "_converted.mp4"
-        
-        # FFmpeg command: -y (overwrite), -i (input), -c:v libx264 (video codec), -c:a aac (audio codec)
-        # -preset fast, -crf 23 (balance quality/speed)
-        cmd = [
-            "ffmpeg", "-y", "-i", source_path,
-            "-c:v", "libx264", "-c:a", "aac",
-            "-preset", "fast", "-crf", "23",
-            output_path
-        ]
-        
+        """
+        Converts a video OpenCV can't decode to H.264 MP4 using system ffmpeg.
+        Decode fallback only: browser proxies are made in the background (transcode.py).
+        """
+        output_path = os.path.splitext(source_path)[0] + "_converted.mp4"
         try:
-            print(f"Converting {source_path} to H.264 MP4...")
-            subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if os.path.exists(output_path):
-                print(f"Conversion successful: {output_path}")
-                return output_path
+            log.info("converting to H.264 MP4", extra=fields(path=source_path))
+            # Polled so a disconnected client / expired deadline stops ffmpeg too
+            ffmpeg_transcode(source_path, output_path, checkpoint=checkpoint)
+            log.info("conversion done", extra=fields(path=output_path))
+            return output_path
+        except JobCancelled:
+            raise
         except Exception as e:
-            print(f"Video conversion failed: {e}")
+            log.warning("video conversion failed", extra=fields(error=str(e)))
             return None
-            
-        return None
 
-    def predict_morphokinetics(self, video_bytes: bytes, filename: str):
+    def _decodable(self, path):
+        """True if OpenCV can open the video and decode its first frame."""
+        cap = cv2.VideoCapture(path)
+        try:
+            return cap.isOpened() and cap.read()[0]
+        finally:
+            cap.release()
+
+    def predict_raw(self, frames, header: dict, content_hash: str):
+        """
+        Runs analysis on pre-decoded frames from an instrument integration
+        (raw_ingest message): no temp file, no codec, no conversion.
+
+        frames: T x P x H x W x 3 BGR uint8 (a view of the message payload).
+        header: the message header (analysis_type, timeline, milestones,
+        timestamps, frame_interval_minutes, first_frame_hpi).
+        """
+        from raw_ingest import ArraySource
+
+        analysis_type = header.get("analysis_type", "gardner")
+        if analysis_type not in ("gardner", "morphokinetics"):
+            return {"error": f"Unknown analysis type '{analysis_type}'. Options: gardner, morphokinetics"}
+        milestone_mode = header.get("milestones", "reference")
+        if milestone_mode not in ("reference", "adaptive"):
+            return {"error": f"Unknown milestone mode '{milestone_mode}'. Options: reference, adaptive"}
+        timepoints, planes, height, width = frames.shape[:4]
+        if analysis_type == "morphokinetics" and timepoints < 2:
+            return {"error": "Morphokinetic analysis requires multiple timepoints (single-frame input received)."}
+        if not HAS_GATE:
+            gate_log.error("embryo gate offline, analysis blocked", extra=fields(input="raw"))
+            return {"error": "Clinical Safety Error: Embryo Validation Gate (CLIP) is unavailable. Analysis blocked."}
+
+        keep_frames = VIDEO_GATE_FRAMES if timepoints > 1 else 1
+        from inference import BEST_FRAME_TOPK, GARDNER_CHUNK
+        gardner_frames = 0 if analysis_type == "morphokinetics" else (GARDNER_CHUNK if header.get("timeline") else BEST_FRAME_TOPK)
+        try:
+            # The payload is already in memory: it counts once, as the upload
+            plan = self._memory_plan(memory_guard.MemoryPlan("sequence", width, height, timepoints, planes),
+                                     timepoints * planes * height * width * 3, keep_frames, gardner_frames=gardner_frames)
+        except MemoryBudgetExceeded as e:
+            return {"error": f"Input Rejected: {e}"}
+
+        source = ArraySource(frames)
+        with memory_guard.reserve(plan):
+            if timepoints == 1:
+                frame = next(source.read([0]))[1]
+                with track_stage("gate"):
+                    is_valid, reason, confidence = validate_embryo_image(frame)
+                if not is_valid:
+                    gate_log.info("gate rejected", extra=fields(input="raw", reason=reason, confidence=confidence))
+                    return {"error": f"Input Rejected: {reason}. Please send valid embryo frames."}
+                tensor = self._engine._preprocess_frame(frame).unsqueeze(0).unsqueeze(0)
+                with track_stage("inference"):
+                    results = self._engine.predict(input_data=tensor, is_video=False, analysis_type="gardner")
+                self._heatmaps.remember(content_hash, frame=tensor[:, 0])
+                return results
+
+            gate_frames = []
+            with track_stage("preprocess"):
+                tensor = self._engine._load_sequence(source, keep_frames, gate_frames, max_frames=plan.max_frames)
+            if tensor is None:
+                return {"error": "No frames in message"}
+            with track_stage("gate"):
+                is_valid, reason, confidence = validate_embryo_frames(gate_frames)
+            if not is_valid:
+                gate_log.info("gate rejected", extra=fields(input="raw", reason=reason, confidence=confidence))
+                return {"error": f"Input Rejected: {reason}. Please send valid embryo frames."}
+            gate_log.info("gate passed", extra=fields(input="raw", reason=reason, confidence=confidence))
+
+            del gate_frames
+            with track_stage("inference"):
+                results = self._engine.predict(input_data=tensor, is_video=True, analysis_type=analysis_type,
+                                               gardner_timeline=bool(header.get("timeline")))
+            self._remember_video(content_hash, tensor, results)
+            del tensor
+
+            if milestone_mode == "adaptive" and not self._engine.is_mock and "milestones" in results:
+                with track_stage("milestones"):
+                    results["milestones"] = search_milestones(
+                        self._engine, None, source=source, frame_hpi=header.get("timestamps"),
+                        frame_interval_minutes=header.get("frame_interval_minutes"),
+                        first_frame_hpi=header.get("first_frame_hpi"))
+            return results
+
+    def predict_morphokinetics(self, video_bytes: bytes, filename: str, milestone_mode: str = "reference",
+                               frame_interval_minutes: float = None, first_frame_hpi: float = None):
         """
-        Runs Morphokinetic analysis on a video file.
+        Runs Morphokinetic analysis on a video file or time-lapse export (zip of frames, TIFF stack).
         Since video processing requires sequential frames, we save to a temporary file.
+
+        milestone_mode "adaptive" replaces the reference milestone times with
+        ones measured by a coarse-to-fine transition search over the input
+        (frame_interval_minutes / first_frame_hpi map frames to hpi).
         """
+        if milestone_mode not in ("reference", "adaptive"):
+            return {"error": f"Unknown milestone mode '{milestone_mode}'. Options: reference, adaptive"}
         import tempfile
         
         suffix = os.path.splitext(filename)[1] or ".mp4"
@@ -127,63 +461,75 @@ class AIService:
             tfile.write(video_bytes)
             temp_path = tfile.name
 
+        converted_path = None
         try:
-            # AUTO-CONVERSION: Ensure it's a valid MP4 for both backend (OpenCV) and Frontend (Chrome)
-            # If original is already mp4, we might still want to re-encode if it's HEVC,
-            # but for speed, let's checking extension or just force convert if not simple mp4.
-            # Actually, to be safe for the user's issue (ProRes/HEVC), we SHOULD try to convert.
-            
-            # For this fix, we will attempt conversion if existing tools are present
-            converted_path = self._convert_to_mp4(temp_path)
+            # Codecs OpenCV can't decode (some HEVC/ProRes builds) are converted first;
+            # image-sequence exports (zip archives, TIFF stacks) are read directly
+            if suffix.lower() not in SEQUENCE_EXTS and not self._decodable(temp_path):
+                converted_path = self._convert_to_mp4(temp_path)
             work_path = converted_path if converted_path else temp_path
             
-            # The engine has a load_input method that handles video files efficiently
-            tensor = self._engine.load_input(work_path)
-            
-            if tensor is None:
+            # Probe the input (headers only) and fit it into the memory budget before decoding
+            keep_frames = VIDEO_GATE_FRAMES if HAS_GATE else 1
+            try:
+                plan = self._memory_plan(memory_guard.probe_input(work_path), len(video_bytes), keep_frames, gardner_frames=0)
+            except MemoryBudgetExceeded as e:
+                return {"error": f"Input Rejected: {e}"}
+            if plan is None:
                 return {"error": "Failed to extract frames from video"}
-            
-            # INTELLIGENT GATING (CLIP-based) for video: Check a middle frame
-            if HAS_GATE:
-                import cv2
-                cap = cv2.VideoCapture(work_path)
-                total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-                cap.set(cv2.CAP_PROP_POS_FRAMES, total_frames // 2)
-                ret, middle_frame = cap.read()
-                cap.release()
+
+            with memory_guard.reserve(plan):
+                # The engine has a load_input method that handles video files efficiently.
+                # It also hands back K evenly spaced raw frames from the same decode pass for gating.
+                # The upload hash keys the cached keyframe index (the converted file is hashed on demand)
+                upload_hash = sha256_bytes(video_bytes)
+                content_hash = upload_hash if work_path == temp_path else None
+                with track_stage("decode"):
+                    tensor, gate_frames = self._engine.load_input(work_path, keep_frames=keep_frames,
+                                                                  content_hash=content_hash, max_frames=plan.max_frames)
+                
+                if tensor is None:
+                    return {"error": "Failed to extract frames from video"}
+                if tensor.shape[1] < 2:
+                    return {"error": "Morphokinetic analysis requires multiple timepoints (single-frame input received)."}
                 
-                if ret:
-                    is_valid, reason, confidence = validate_embryo_image(middle_frame)
+                # INTELLIGENT GATING (CLIP-based) for video: K frames, one batched forward
+                if HAS_GATE:
+                    with track_stage("gate"):
+                        is_valid, reason, confidence = validate_embryo_frames(gate_frames)
                     if not is_valid:
-                        print(f"CLIP GATE REJECTION (Video): {reason}")
+                        gate_log.info("gate rejected", extra=fields(input="video", reason=reason, confidence=confidence))
                         return {"error": f"Input Rejected: {reason}. Please upload a valid embryo video."}
-                    print(f"CLIP GATE PASSED (Video): {reason}")
-            else:
-                # CLINICAL SAFETY LOCK
-                print("CRITICAL SAFETY ERROR: Embryo Gate is OFFLINE (Video). Blocking analysis.")
-                return {"error": "Clinical Safety Error: Embryo Validation Gate (CLIP) is unavailable. Analysis blocked."}
+                    gate_log.info("gate passed", extra=fields(input="video", reason=reason, confidence=confidence))
+                else:
+                    # CLINICAL SAFETY LOCK
+                    gate_log.error("embryo gate offline, analysis blocked", extra=fields(input="video"))
+                    return {"error": "Clinical Safety Error: Embryo Validation Gate (CLIP) is unavailable. Analysis blocked."}
 
-            results = self._engine.predict(
-                input_data=tensor,
-                is_video=True,
-                analysis_type="morphokinetics"
-            )
-            
-            # Since we can't easily push the converted file back to the browser in this sync call without
-            # changing the API contract, we will trust the backend results are now valid.
-            # Ideally, we should upload the converted file to cloud/storage and return the new URL.
-            # For this local prototype, we will return the path so the frontend *could* potential stream it if we added that.
-            # But primarily this ensures the RESULTS are generated.
+                del gate_frames
+                with track_stage("inference"):
+                    results = self._engine.predict(
+                        input_data=tensor,
+                        is_video=True,
+                        analysis_type="morphokinetics"
+                    )
+                self._remember_video(upload_hash, tensor, results)
+                del tensor
+
+                if milestone_mode == "adaptive" and not self._engine.is_mock and "milestones" in results:
+                    with track_stage("milestones"):
+                        results["milestones"] = search_milestones(
+                            self._engine, work_path, frame_interval_minutes=frame_interval_minutes,
+                            first_frame_hpi=first_frame_hpi, content_hash=content_hash)
             
+            # Browser proxy, scrubbing sprite and poster are made in the background
+            if suffix.lower() not in SEQUENCE_EXTS:
+                get_transcoder().submit(upload_hash, video_bytes, suffix)
             return results
         finally:
-            if os.path.exists(temp_path):
-                os.unlink(temp_path)
-            # Clean up converted file if it exists and is different
-            # (In a real app, we'd keep it as the new artifact)
-            # For now, we clean it up to avoid filling disk.
-            # if converted_path and os.path.exists(converted_path):
-            #    os.unlink(converted_path)
+            for path in (temp_path, converted_path):
+                if path and os.path.exists(path):
+                    os.unlink(path)
 
 
 # Singleton instance
@@ -0,0 +1,312 @@
+"""
+Capacity Simulation
+
+A stand-in for AIService that behaves like the real engine under load, for
+capacity-testing the API, the frontend and proxies on machines without
+weights. It replays resource profiles recorded from real runs:
+
+  1. record on a machine with weights (one request at a time, so process
+     CPU time belongs to that request):
+
+         EMBRYO_SIM_RECORD=profile.jsonl python serve.py ...
+
+     every finished job appends its kind, per-stage wall time, CPU seconds
+     and RSS growth (decode, gate, inference...), its memory estimate and
+     whether the input was rejected
+
+  2. replay anywhere:
+
+         EMBRYO_SIMULATION=replay EMBRYO_SIM_PROFILE=profile.jsonl python serve.py ...
+
+     each call picks a recorded job of the same kind and re-enacts it: CPU is
+     burnt (in parallel threads when the real run used several cores),
+     memory is allocated and touched, the remainder of each stage is slept.
+     Jobs still go through the real Scheduler (priority classes, slots,
+     queue limit, deadlines, cancellation) and memory admission, so queueing
+     behaves like production.
+
+Without a profile, built-in placeholder timings are used (fine for smoke
+tests, not for sizing). `python simulation.py summarize profile.jsonl`
+prints the recorded latency percentiles.
+"""
+
+import contextvars
+import hashlib
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import metrics
+
+SIMULATION_MODE = os.getenv("EMBRYO_SIMULATION", "off").lower()
+PROFILE_PATH = os.getenv("EMBRYO_SIM_PROFILE", "")
+RECORD_PATH = os.getenv("EMBRYO_SIM_RECORD", "")
+# > 1 replays slower (smaller machine), < 1 faster
+TIME_SCALE = float(os.getenv("EMBRYO_SIM_TIME_SCALE", "1.0"))
+SIMULATE_MEMORY = os.getenv("EMBRYO_SIM_MEMORY", "on").lower() == "on"
+# Granularity of cancellation checks while a stage is replayed
+SLICE_SECONDS = 0.05
+MB = 1024 * 1024
+
+# Placeholder per-job stages: (stage, median seconds, cpu cores busy, rss growth MB)
+DEFAULT_PROFILE = {
+    "predict_gardner": [("decode", 0.05, 1, 60), ("gate", 0.15, 2, 40), ("inference", 0.25, 2, 80)],
+    "predict_gardner_video": [("decode", 5.0, 1, 500), ("gate", 0.4, 2, 60), ("inference", 2.5, 2, 400)],
+    "predict_morphokinetics": [("decode", 6.0, 1, 600), ("gate", 0.4, 2, 60), ("inference", 3.5, 2, 500)],
+    "predict_gardner_multi": [("decode", 0.3, 1, 120), ("gate", 0.4, 2, 60), ("inference", 0.4, 2, 120)],
+    "predict_raw": [("preprocess", 0.6, 1, 300), ("gate", 0.4, 2, 60), ("inference", 3.0, 2, 450)],
+    "heatmap": [("inference", 0.8, 2, 150)],
+}
+DEFAULT_JITTER = 0.3  # lognormal sigma around the placeholder medians
+DEFAULT_REJECT_RATE = 0.02
+
+
+# ---- recording ---------------------------------------------------------------
+
+_recording = contextvars.ContextVar("embryo_sim_recording", default=None)
+_record_lock = threading.Lock()
+
+
+@contextmanager
+def recording(job_name, priority):
+    """
+    Collects the stages of one scheduler job and appends it to EMBRYO_SIM_RECORD.
+    Yields the record (callers set "rejected"); no-op unless recording.
+    """
+    if not RECORD_PATH:
+        yield {}
+        return
+    job = {"job": job_name, "priority": priority, "stages": [], "estimate_mb": 0.0, "rejected": False}
+    ctx = _recording.set(job)
+    start, cpu_start = time.perf_counter(), time.process_time()
+    completed = False
+    try:
+        yield job
+        completed = True
+    finally:
+        _recording.reset(ctx)
+        # Cancelled and failed jobs are not representative of a real run
+        if completed:
+            job["seconds"] = round(time.perf_counter() - start, 4)
+            job["cpu_seconds"] = round(time.process_time() - cpu_start, 4)
+            with _record_lock, open(RECORD_PATH, "a") as f:
+                f.write(json.dumps(job) + "\n")
+
+
+def record_stage(name, seconds, cpu_seconds, rss_delta_mb):
+    """Called by memory_guard.track_stage for every finished stage."""
+    job = _recording.get()
+    if job is not None and name != "request":  # "request" spans the whole job
+        job["stages"].append({"stage": name, "seconds": round(seconds, 4),
+                              "cpu_seconds": round(cpu_seconds, 4), "rss_delta_mb": round(rss_delta_mb, 1)})
+
+
+def record_estimate(estimate_mb):
+    job = _recording.get()
+    if job is not None:
+        job["estimate_mb"] = max(job["estimate_mb"], round(estimate_mb, 1))
+
+
+# ---- replay ------------------------------------------------------------------
+
+def load_profile(path):
+    """{job name: [recorded job, ...]} from a recording."""
+    profile = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                job = json.loads(line)
+                profile.setdefault(job["job"], []).append(job)
+    return profile
+
+
+def _default_job(name):
+    jitter = lambda: math.exp(random.gauss(0.0, DEFAULT_JITTER))
+    stages = []
+    for stage, seconds, cores, rss in DEFAULT_PROFILE[name]:
+        seconds *= jitter()
+        stages.append({"stage": stage, "seconds": seconds, "cpu_seconds": seconds * cores, "rss_delta_mb": rss})
+    total = sum(s["seconds"] for s in stages) * 1.05
+    return {"job": name, "stages": stages, "seconds": total, "estimate_mb": max(s["rss_delta_mb"] for s in stages) * 1.5,
+            "rejected": random.random() < DEFAULT_REJECT_RATE}
+
+
+def _burn(seconds, stop=None):
+    """Keeps one core busy; hashlib releases the GIL, so burner threads really run in parallel."""
+    block = b"\x00" * MB
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end and not (stop is not None and stop.is_set()):
+        hashlib.sha256(block).digest()
+
+
+def _replay_stage(stage):
+    from scheduler import checkpoint
+
+    wall = stage["seconds"] * TIME_SCALE
+    cpu = stage["cpu_seconds"] * TIME_SCALE
+    ballast = None
+    if SIMULATE_MEMORY and stage["rss_delta_mb"] > 0:
+        # Repetition writes every byte, so the pages are really resident
+        ballast = bytearray(b"\x01") * int(stage["rss_delta_mb"] * MB)
+    end = time.perf_counter() + wall
+    cores = max(1, min(os.cpu_count() or 1, math.ceil(cpu / wall))) if wall > 0 else 1
+    per_core = min(wall, cpu / cores)
+    stop = threading.Event()
+    helpers = [threading.Thread(target=_burn, args=(per_core, stop), daemon=True) for _ in range(cores - 1)]
+    for h in helpers:
+        h.start()
+    try:
+        burn_until = time.perf_counter() + per_core
+        while time.perf_counter() < end:
+            checkpoint()
+            now = time.perf_counter()
+            if now < burn_until:
+                _burn(min(SLICE_SECONDS, burn_until - now))
+            else:
+                time.sleep(min(SLICE_SECONDS, end - now))
+    finally:
+        stop.set()  # a cancelled job must not keep the helpers busy
+        for h in helpers:
+            h.join()
+        del ballast
+    metrics.observe(f"simulation.stage_seconds.{stage['stage']}", wall)
+
+
+def generate_mock_result(analysis_type: str) -> dict:
+    # DETERMINISTIC CLINICAL BENCHMARKS (Non-Random for Compliance)
+    if analysis_type == "gardner":
+        return {
+            "stage": "Blastocyst (SIMULATED)",
+            "confidence": "94.20%",
+            "commentary": "NOTICE: This is a deterministic reference result used for system verification only. Not for clinical use.",
+            "action": "SYSTEM TEST IN PROGRESS",
+            "gardner": {
+                "expansion": "4",
+                "icm": "A",
+                "te": "A",
+                "cell_count": "120",
+                "cavity_symmetry": "95%",
+                "fragmentation": "<5%"
+            },
+            "milestones": {"unavailable": True, "reason": "Choice: Gardner Mode"},
+            "anomalies": ["None detected (Safe zone)"],
+            "concordance": {"AI_Confidence": 0.94, "Historical_Match": 0.92},
+            "analysis_type": "gardner"
+        }
+    else: # morphokinetics
+        return {
+            "stage": "Expanded Blastocyst (tEB)",
+            "confidence": "91.50%",
+            "commentary": "Kinematic alignment matches clinical developmental benchmarks.",
+            "action": "Valid for vitrification / transfer",
+            "gardner": {"expansion": "4", "icm": "A", "te": "A"},
+            "milestones": {
+                "t2": "26.5h", "t3": "37.0h", "t5": "48.5h", "t8": "54.0h",
+                "tM": "93.0h", "tB": "105.0h", "tEB": "118.0h", "s3": "10.5h"
+            },
+            "anomalies": ["Synchronous cleavage verified."],
+            "concordance": {"AI_Confidence": 0.94, "Literature_Match": 0.91},
+            "analysis_type": "morphokinetics"
+        }
+
+
+class SimulatedService:
+    """Same interface as AIService; every call replays a recorded job of its kind."""
+
+    simulated = True
+
+    def __init__(self, profile_path=None):
+        self.profile_path = profile_path or PROFILE_PATH
+        self.profile = load_profile(self.profile_path) if self.profile_path else {}
+        recorded = {name: len(jobs) for name, jobs in self.profile.items()}
+        print(f"Simulation: replaying {recorded or 'built-in placeholder timings'} (time scale {TIME_SCALE})")
+
+    def _replay(self, name, result):
+        import memory_guard
+
+        jobs = self.profile.get(name)
+        job = random.choice(jobs) if jobs else _default_job(name)
+        plan = memory_guard.MemoryPlan("simulated", 0, 0, 0)
+        plan.estimate_mb = job.get("estimate_mb", 0.0)
+        start = time.perf_counter()
+        with memory_guard.reserve(plan):
+            for stage in job["stages"]:
+                _replay_stage(stage)
+            # Work outside the tracked stages (temp files, conversion, result assembly)
+            rest = (job["seconds"] - sum(s["seconds"] for s in job["stages"])) * TIME_SCALE
+            if rest > 0:
+                _replay_stage({"stage": "other", "seconds": rest, "cpu_seconds": 0.0, "rss_delta_mb": 0.0})
+        metrics.observe(f"simulation.job_seconds.{name}", time.perf_counter() - start)
+        if job.get("rejected"):
+            return {"error": "Input Rejected: Simulated gate rejection. Please upload a valid embryo image."}
+        return result
+
+    def diagnostics(self):
+        return {"model_id": "simulation", "profile": self.profile_path or None, "time_scale": TIME_SCALE}
+
+    def model_version(self):
+        return f"simulation|{os.path.basename(self.profile_path) or 'placeholder'}"
+
+    def metrics(self):
+        return {"simulation": {name: len(jobs) for name, jobs in self.profile.items()}}
+
+    def predict_gardner(self, image_bytes: bytes):
+        return self._replay("predict_gardner", generate_mock_result("gardner"))
+
+    def predict_gardner_video(self, video_bytes: bytes, filename: str, timeline: bool = False):
+        return self._replay("predict_gardner_video", generate_mock_result("gardner"))
+
+    def predict_morphokinetics(self, video_bytes: bytes, filename: str, milestone_mode: str = "reference",
+                               frame_interval_minutes: float = None, first_frame_hpi: float = None):
+        return self._replay("predict_morphokinetics", generate_mock_result("morphokinetics"))
+
+    def predict_raw(self, frames, header: dict, content_hash: str):
+        return self._replay("predict_raw", generate_mock_result(header.get("analysis_type", "gardner")))
+
+    def predict_gardner_multi(self, file_bytes: bytes, filename: str):
+        gardner = generate_mock_result("gardner")["gardner"]
+        embryos = [{"embryo_index": i, "circle": {"x": 200.0 + 300 * i, "y": 200.0, "r": 120.0}, "track_hits": 1,
+                    "gate_score": 0.97, "gardner": dict(gardner), "concordance": {"AI_Confidence": 0.94}}
+                   for i in range(2)]
+        return self._replay("predict_gardner_multi", {
+            "analysis_type": "gardner_multi", "is_video": False, "embryo_count": len(embryos),
+            "rejected_detections": 0, "frame_size": {"width": 1000, "height": 500}, "embryos": embryos,
+            "details": "Model: simulation\nPipeline: GARDNER (MULTI-EMBRYO)"})
+
+    def heatmap(self, content_hash: str, target: str = "expansion"):
+        self._replay("heatmap", None)
+        return {"error": "Heatmaps are not available in simulation mode", "status": 404}
+
+
+def summarize(path):
+    """Per job kind: count, rejection rate, p50/p95 latency and CPU seconds."""
+    def pct(values, q):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    for name, jobs in sorted(load_profile(path).items()):
+        seconds = [j["seconds"] for j in jobs]
+        cpu = [j["cpu_seconds"] for j in jobs]
+        rejected = sum(1 for j in jobs if j.get("rejected")) / len(jobs)
+        print(f"📊 {name}: {len(jobs)} jobs, p50 {pct(seconds, 0.5):.2f}s, p95 {pct(seconds, 0.95):.2f}s, "
+              f"cpu p50 {pct(cpu, 0.5):.2f}s, rejected {rejected:.0%}")
+        stages = {}
+        for j in jobs:
+            for s in j["stages"]:
+                stages.setdefault(s["stage"], []).append(s)
+        for stage, entries in stages.items():
+            print(f"   {stage}: p50 {pct([s['seconds'] for s in entries], 0.5):.2f}s, "
+                  f"rss +{pct([s['rss_delta_mb'] for s in entries], 0.5):.0f} MB")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "summarize":
+        print("Usage: python simulation.py summarize <profile.jsonl>")
+        sys.exit(1)
+    summarize(sys.argv[2])
@@ -0,0 +1,179 @@
+"""
+Structured Logging
+
+Replaces the per-request print() calls on the analysis hot paths. Records go
+through a bounded in-memory queue to a background writer thread, so request
+threads never block on stdout (when the queue is full, lines are dropped and
+counted as log.dropped). Every line carries the request id of the analysis
+it belongs to, so one request can be followed across the API, the scheduler
+threads and the pipeline.
+
+    log = get_logger("gate")
+    log.info("gate rejected", extra=fields(reason=reason, score=0.12))
+
+  - EMBRYO_LOG_LEVEL      DEBUG, INFO (default), WARNING...
+  - EMBRYO_LOG_FORMAT     json (default) or text
+  - EMBRYO_LOG_SAMPLE     per-category share of requests logged below WARNING,
+                          e.g. "video=0.1,gate=0.25" (whole requests are kept or
+                          dropped, so sampled requests stay complete)
+
+Debug-level tensor dumps are guarded with log.isEnabledFor(logging.DEBUG), so
+they cost nothing when disabled.
+"""
+
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+import zlib
+
+import metrics
+
+LOG_LEVEL = os.getenv("EMBRYO_LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("EMBRYO_LOG_FORMAT", "json").lower()
+QUEUE_SIZE = int(os.getenv("EMBRYO_LOG_QUEUE", "10000"))
+ROOT = "embryo"
+
+
+def _parse_sampling(spec):
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        category, _, rate = item.partition("=")
+        try:
+            rates[category.strip()] = min(1.0, max(0.0, float(rate)))
+        except ValueError:
+            pass
+    return rates
+
+
+SAMPLE_RATES = _parse_sampling(os.getenv("EMBRYO_LOG_SAMPLE", ""))
+
+_request_id = contextvars.ContextVar("embryo_request_id", default=None)
+
+
+def set_request_id(request_id):
+    """Binds a request id to the current context; returns the token for reset_request_id."""
+    return _request_id.set(request_id)
+
+
+def reset_request_id(token):
+    _request_id.reset(token)
+
+
+def current_request_id():
+    return _request_id.get()
+
+
+def fields(**values):
+    """Structured fields for a record: log.info("...", extra=fields(key=value))."""
+    return {"fields": values}
+
+
+def _sampled(category, request_id):
+    rate = SAMPLE_RATES.get(category)
+    if rate is None or rate >= 1.0:
+        return True
+    if request_id is None:
+        return random.random() < rate
+    # Same decision for every line of a request
+    return zlib.crc32(request_id.encode()) % 10000 < rate * 10000
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "category": record.name[len(ROOT) + 1:] if record.name.startswith(ROOT + ".") else record.name,
+            "msg": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+            "pid": record.process,
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        category = record.name[len(ROOT) + 1:] if record.name.startswith(ROOT + ".") else record.name
+        extra = " ".join(f"{k}={v}" for k, v in (getattr(record, "fields", None) or {}).items())
+        rid = getattr(record, "request_id", None)
+        return (f"{time.strftime('%H:%M:%S', time.localtime(record.created))} {record.levelname:<7} {category}"
+                f"{f' [{rid}]' if rid else ''} {record.getMessage()}{f' {extra}' if extra else ''}")
+
+
+class _AsyncHandler(logging.handlers.QueueHandler):
+    """
+    Stamps the request id, applies sampling and enqueues without blocking.
+    The writer thread is started lazily in each process (threads don't
+    survive the preload fork).
+    """
+
+    def __init__(self, target):
+        super().__init__(queue.Queue(QUEUE_SIZE))
+        self.target = target
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self.queue = queue.Queue(QUEUE_SIZE)  # an inherited queue may hold the parent's lock state
+            self._listener = logging.handlers.QueueListener(self.queue, self.target)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def emit(self, record):
+        record.request_id = _request_id.get()
+        category = record.name[len(ROOT) + 1:]
+        if record.levelno < logging.WARNING and not _sampled(category, record.request_id):
+            return
+        self._ensure_listener()
+        super().emit(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.incr("log.dropped")
+
+    def flush(self):
+        # Used at exit: wait for queued lines to be written
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+            self._pid = None
+
+
+_handler = None
+_configure_lock = threading.Lock()
+
+
+def _configure():
+    global _handler
+    with _configure_lock:
+        if _handler is not None:
+            return
+        target = logging.StreamHandler(sys.stdout)
+        target.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+        _handler = _AsyncHandler(target)
+        root = logging.getLogger(ROOT)
+        root.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+        root.addHandler(_handler)
+        root.propagate = False
+
+
+def get_logger(category):
+    """Logger for one category (gate, decode, inference, scheduler...)."""
+    _configure()
+    return logging.getLogger(f"{ROOT}.{category}")
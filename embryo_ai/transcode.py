@@ -0,0 +1,248 @@
+"""
+Background Transcoding
+
+Browsers can't play HEVC/ProRes time-lapses, but re-encoding them inline put
+an ffmpeg run on the critical path of every analysis (and its output was
+thrown away). Transcoding now happens after the analysis, in one
+low-priority worker per process, and produces per upload (keyed by content
+hash, under <cache>/media/<hash>/):
+
+  - proxy.mp4     H.264/yuv420p, at most EMBRYO_PROXY_HEIGHT lines,
+                  faststart (plays and seeks in every browser)
+  - sprite.jpg    thumbnail sheet for timeline scrubbing, sprite.json maps
+                  tiles to frame indices / seconds
+  - poster.jpg    last frame (the most developed embryo)
+
+ffmpeg runs at the lowest CPU priority with few threads, and a job waits
+while analyses are queued (up to EMBRYO_TRANSCODE_MAX_DEFER seconds), so
+analysis never waits on transcoding. Jobs are dropped, not queued without
+bound, when the backlog is full.
+"""
+
+import json
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import metrics
+from content_cache import CACHE_DIR
+from structured_log import get_logger, fields
+
+TRANSCODE = os.getenv("EMBRYO_TRANSCODE", "on").lower() == "on"
+PROXY_HEIGHT = int(os.getenv("EMBRYO_PROXY_HEIGHT", "720"))
+SPRITE_FRAMES = int(os.getenv("EMBRYO_SPRITE_FRAMES", "100"))
+SPRITE_COLUMNS = 10
+SPRITE_THUMB_WIDTH = 160
+FFMPEG_THREADS = int(os.getenv("EMBRYO_TRANSCODE_THREADS", "1"))
+MAX_PENDING = int(os.getenv("EMBRYO_TRANSCODE_MAX_PENDING", "32"))
+MAX_DEFER_SECONDS = float(os.getenv("EMBRYO_TRANSCODE_MAX_DEFER", "300"))
+MEDIA_KINDS = {"proxy": ("proxy.mp4", "video/mp4"), "sprite": ("sprite.jpg", "image/jpeg"),
+               "sprite.json": ("sprite.json", "application/json"), "poster": ("poster.jpg", "image/jpeg")}
+
+log = get_logger("transcode")
+
+
+def media_dir(content_hash):
+    return os.path.join(CACHE_DIR, "media", content_hash)
+
+
+def manifest(content_hash):
+    """The finished job's manifest, or None if not (yet) transcoded."""
+    try:
+        with open(os.path.join(media_dir(content_hash), "manifest.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def ffmpeg_transcode(source, output, height=None, threads=None, nice=False, checkpoint=None):
+    """
+    Re-encodes `source` to browser-playable H.264 MP4 at `output`.
+
+    `checkpoint` is polled while ffmpeg runs (it may raise to stop it); the
+    partial output is removed on any failure.
+    """
+    scale = ["-vf", f"scale=-2:'min({height},ih)'"] if height else []
+    cmd = ["ffmpeg", "-y", "-loglevel", "error", "-i", source, *scale,
+           "-c:v", "libx264", "-preset", "fast", "-crf", "23", "-pix_fmt", "yuv420p",
+           "-movflags", "+faststart", "-c:a", "aac"]
+    if threads:
+        cmd += ["-threads", str(threads)]
+    cmd.append(output)
+    if nice and shutil.which("nice"):
+        cmd = ["nice", "-n", "19"] + cmd
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while proc.poll() is None:
+            if checkpoint is not None:
+                checkpoint()
+            try:
+                proc.wait(timeout=0.25)
+            except subprocess.TimeoutExpired:
+                pass
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+    except BaseException:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        if os.path.exists(output):
+            os.unlink(output)
+        raise
+    return output
+
+
+def _sprite(proxy_path, out_dir):
+    """Thumbnail sheet + tile map from the proxy, and the poster frame."""
+    from video_sampling import VideoFrameSource
+
+    source = VideoFrameSource(proxy_path)
+    try:
+        total = source.frame_count
+        if total <= 0:
+            raise ValueError("proxy has no frames")
+        indices = np.unique(np.linspace(0, total - 1, min(SPRITE_FRAMES, total), dtype=int)).tolist()
+        thumbs, read, last = [], [], None
+        for i, frame in source.read(indices):
+            h, w = frame.shape[:2]
+            thumb_h = max(1, round(h * SPRITE_THUMB_WIDTH / w))
+            thumbs.append(cv2.resize(frame, (SPRITE_THUMB_WIDTH, thumb_h), interpolation=cv2.INTER_AREA))
+            read.append(i)
+            last = frame
+        fps = source.fps or 0.0
+    finally:
+        source.release()
+    if not thumbs:
+        raise ValueError("no frames decoded from proxy")
+
+    columns = min(SPRITE_COLUMNS, len(thumbs))
+    rows = -(-len(thumbs) // columns)
+    thumb_h, thumb_w = thumbs[0].shape[:2]
+    sheet = np.zeros((rows * thumb_h, columns * thumb_w, 3), dtype=np.uint8)
+    for n, thumb in enumerate(thumbs):
+        r, c = divmod(n, columns)
+        sheet[r * thumb_h:(r + 1) * thumb_h, c * thumb_w:(c + 1) * thumb_w] = thumb[:thumb_h, :thumb_w]
+    cv2.imwrite(os.path.join(out_dir, "sprite.jpg"), sheet, [cv2.IMWRITE_JPEG_QUALITY, 80])
+    cv2.imwrite(os.path.join(out_dir, "poster.jpg"), last, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    tiles = {"columns": columns, "rows": rows, "thumb_width": thumb_w, "thumb_height": thumb_h,
+             "frames": read, "seconds": [round(i / fps, 3) for i in read] if fps else None, "frame_count": total}
+    with open(os.path.join(out_dir, "sprite.json"), "w") as f:
+        json.dump(tiles, f)
+
+
+class TranscodeQueue:
+    """One background worker per process; submit() never blocks."""
+
+    def __init__(self):
+        self._queue = queue.Queue(MAX_PENDING)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_worker(self):
+        # Threads don't survive fork: start lazily in the process that serves requests
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue, self._pending = queue.Queue(MAX_PENDING), set()
+                threading.Thread(target=self._loop, name="transcode-worker", daemon=True).start()
+                self._pid = os.getpid()
+
+    def submit(self, content_hash, video_bytes, suffix):
+        """Queues proxy/sprite/poster generation for an upload (no-op if done or pending)."""
+        if not TRANSCODE or shutil.which("ffmpeg") is None or self.status(content_hash) != "missing":
+            return False
+        self._ensure_worker()
+        with self._lock:
+            if content_hash in self._pending:
+                return False
+            if self._queue.full():
+                metrics.incr("transcode.dropped")
+                return False
+            # Spooled to disk before queueing: the backlog holds paths, not uploads
+            out_dir = media_dir(content_hash)
+            os.makedirs(out_dir, exist_ok=True)
+            source = os.path.join(out_dir, "source" + suffix)
+            try:
+                with open(source, "wb") as f:
+                    f.write(video_bytes)
+                # Other workers answer status() from the marker
+                open(os.path.join(out_dir, "pending"), "w").close()
+            except OSError as e:
+                metrics.incr("transcode.dropped")
+                log.warning("transcode spool failed", extra=fields(content_hash=content_hash[:12], error=str(e)))
+                if os.path.exists(source):
+                    os.unlink(source)
+                return False
+            # Producers hold the lock, so the queue cannot have filled up since the check
+            self._queue.put_nowait((content_hash, source, time.monotonic()))
+            self._pending.add(content_hash)
+        metrics.incr("transcode.submitted")
+        return True
+
+    def status(self, content_hash):
+        """"ready", "pending" (queued or running in any worker) or "missing"."""
+        if manifest(content_hash) is not None:
+            return "ready"
+        try:
+            # A marker older than the longest plausible wait belongs to a worker that died
+            age = time.time() - os.path.getmtime(os.path.join(media_dir(content_hash), "pending"))
+            return "pending" if age < MAX_DEFER_SECONDS + 3600 else "missing"
+        except OSError:
+            return "missing"
+
+    def _wait_for_idle(self, submitted):
+        """Defers while analyses are queued (bounded, so a busy server still gets proxies)."""
+        from scheduler import get_scheduler
+        while time.monotonic() - submitted < MAX_DEFER_SECONDS:
+            if not any(get_scheduler().stats()["queued"].values()):
+                return
+            time.sleep(1.0)
+
+    def _loop(self):
+        while True:
+            content_hash, source, submitted = self._queue.get()
+            try:
+                self._wait_for_idle(submitted)
+                self._run(content_hash, source)
+            except Exception as e:
+                metrics.incr("transcode.failed")
+                log.warning("transcode failed", extra=fields(content_hash=content_hash[:12], error=str(e)))
+            finally:
+                with self._lock:
+                    self._pending.discard(content_hash)
+                for leftover in (source, os.path.join(media_dir(content_hash), "pending")):
+                    try:
+                        os.unlink(leftover)
+                    except OSError:
+                        pass
+
+    def _run(self, content_hash, source):
+        out_dir = media_dir(content_hash)
+        start = time.perf_counter()
+        proxy = ffmpeg_transcode(source, os.path.join(out_dir, "proxy.tmp.mp4"), height=PROXY_HEIGHT,
+                                 threads=FFMPEG_THREADS, nice=True)
+        os.replace(proxy, os.path.join(out_dir, "proxy.mp4"))
+        _sprite(os.path.join(out_dir, "proxy.mp4"), out_dir)
+        elapsed = time.perf_counter() - start
+        # Written last: its presence means every artifact is complete
+        with open(os.path.join(out_dir, "manifest.json.tmp"), "w") as f:
+            json.dump({"content_hash": content_hash, "created": time.time(), "seconds": round(elapsed, 2),
+                       "files": {kind: name for kind, (name, _) in MEDIA_KINDS.items()}}, f)
+        os.replace(os.path.join(out_dir, "manifest.json.tmp"), os.path.join(out_dir, "manifest.json"))
+        metrics.observe("transcode.seconds", elapsed)
+        log.info("media ready", extra=fields(content_hash=content_hash[:12], seconds=round(elapsed, 2)))
+
+
+_transcoder = TranscodeQueue()
+
+
+def get_transcoder():
+    return _transcoder
@@ -0,0 +1,193 @@
+"""
+CPU Thread / Worker Topology Tuner
+
+Benchmarks the real EmbryoInference forwards (GardnerNet + staging model) over
+combinations of worker count x torch intra-op threads x inter-op threads, with
+optional per-worker core pinning, and writes the best configuration to
+runtime_tuning.json. The service applies that file at startup (runtime_config.py)
+and reports it at /api/diagnostics/runtime.
+
+Usage:
+    python tune_runtime.py
+    python tune_runtime.py --workers 1,2,4,8 --threads 1,2,4 --interop 1,2 --pin --duration 10
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import multiprocessing as mp
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+if CURRENT_DIR not in sys.path:
+    sys.path.append(CURRENT_DIR)
+
+from runtime_config import TUNING_FILE, apply_runtime_settings
+
+
+def _powers_of_two(limit):
+    values, v = [], 1
+    while v <= limit:
+        values.append(v)
+        v *= 2
+    return values
+
+
+def _parse_list(value, default):
+    if not value:
+        return default
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def _build_engine():
+    """Builds the same engine the service uses (best video config)."""
+    from inference import EmbryoInference
+    temp_engine = EmbryoInference(config_path=None)
+    best_config = temp_engine._find_best_model(is_video=True)
+    engine = EmbryoInference(config_path=best_config)
+    if engine.is_mock:
+        raise RuntimeError("Real model weights are required to tune the runtime.")
+    return engine
+
+
+def _example_inputs(engine):
+    import torch
+    size = engine.img_size
+    config_tr_len = int(engine.config.get('default', 'tr_len', fallback=10)) if engine.config else 10
+    video_len = max(50, config_tr_len)  # Same sampling length as load_input
+    return {
+        "gardner": torch.randn(1, 3, size, size),
+        "image": torch.randn(1, 1, 1, 3, size, size),
+        "video": torch.randn(1, video_len, 1, 3, size, size),
+    }
+
+
+def _run_workload(engine, workload, inputs):
+    import torch
+    with torch.no_grad():
+        if workload in ("image", "mixed"):
+            if engine.gardner_model is not None:
+                engine.gardner_model(inputs["gardner"])
+            engine.model(inputs["image"])
+        if workload in ("video", "mixed"):
+            engine.model(inputs["video"])
+
+
+def _bench_worker(engine, inputs, combo, index, workload, duration, barrier, results):
+    """Forked benchmark worker: apply the combo, warm up, then run for `duration` seconds."""
+    apply_runtime_settings(worker_index=index, tuning=combo)
+    for _ in range(2):
+        _run_workload(engine, workload, inputs)
+
+    barrier.wait()
+    latencies = []
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        start = time.perf_counter()
+        _run_workload(engine, workload, inputs)
+        latencies.append(time.perf_counter() - start)
+    results.put(latencies)
+
+
+def benchmark_combo(engine, inputs, combo, workload, duration):
+    """Runs one worker/thread combination and returns throughput and latency stats."""
+    ctx = mp.get_context("fork")
+    workers = combo["workers"]
+    barrier = ctx.Barrier(workers)
+    results = ctx.Queue()
+    procs = [ctx.Process(target=_bench_worker,
+                         args=(engine, inputs, combo, i, workload, duration, barrier, results))
+             for i in range(workers)]
+    for p in procs:
+        p.start()
+
+    all_latencies = []
+    for _ in procs:
+        all_latencies.extend(results.get(timeout=duration * 10 + 600))
+    for p in procs:
+        p.join()
+
+    all_latencies.sort()
+    count = len(all_latencies)
+    return {
+        **combo,
+        "throughput_per_s": round(count / duration, 3),
+        "p50_ms": round(all_latencies[count // 2] * 1000, 1) if count else None,
+        "p95_ms": round(all_latencies[int(count * 0.95)] * 1000, 1) if count else None,
+        "iterations": count,
+    }
+
+
+def main():
+    cpu_count = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description="Tune torch threads and worker topology for this machine")
+    parser.add_argument("--workers", help="comma list of worker counts (default: powers of two)")
+    parser.add_argument("--threads", help="comma list of intra-op thread counts (default: powers of two)")
+    parser.add_argument("--interop", default="1,2", help="comma list of inter-op thread counts")
+    parser.add_argument("--pin", action="store_true", help="also try pinning each worker to its own cores")
+    parser.add_argument("--workload", choices=["image", "video", "mixed"], default="mixed")
+    parser.add_argument("--duration", type=float, default=8.0, help="seconds per combination")
+    parser.add_argument("--allow-oversubscribe", action="store_true", help="include workers x threads > cores")
+    parser.add_argument("--output", default=TUNING_FILE)
+    args = parser.parse_args()
+
+    import torch
+    # Keep the parent free of parallel regions so forked workers can set their own pools
+    torch.set_num_threads(1)
+
+    print("=" * 60)
+    print(f"🧬 Runtime Tuner - {cpu_count} cores, workload '{args.workload}'")
+    print("=" * 60)
+
+    engine = _build_engine()
+    inputs = _example_inputs(engine)
+
+    combos = []
+    for w in _parse_list(args.workers, _powers_of_two(cpu_count)):
+        for t in _parse_list(args.threads, _powers_of_two(cpu_count)):
+            if w * t > cpu_count and not args.allow_oversubscribe:
+                continue
+            for i in _parse_list(args.interop, [1, 2]):
+                for pin in ([False, True] if args.pin else [False]):
+                    combos.append({"workers": w, "intra_op_threads": t, "interop_threads": i, "pin_cores": pin})
+
+    print(f"Benchmarking {len(combos)} combinations x {args.duration:.0f}s...")
+    results = []
+    for combo in combos:
+        res = benchmark_combo(engine, inputs, combo, args.workload, args.duration)
+        results.append(res)
+        print(f"   workers={res['workers']:<3} threads={res['intra_op_threads']:<3} interop={res['interop_threads']} "
+              f"pin={str(res['pin_cores']):<5} -> {res['throughput_per_s']:.2f}/s  p50={res['p50_ms']}ms")
+
+    if not results:
+        print("❌ No valid combinations (use --allow-oversubscribe?).")
+        return 1
+
+    # Highest throughput wins; lower p95 breaks near-ties (within 2%)
+    best_tp = max(r["throughput_per_s"] for r in results)
+    finalists = [r for r in results if r["throughput_per_s"] >= best_tp * 0.98]
+    best = min(finalists, key=lambda r: r["p95_ms"] or float("inf"))
+
+    tuning = {
+        "workers": best["workers"],
+        "intra_op_threads": best["intra_op_threads"],
+        "interop_threads": best["interop_threads"],
+        "pin_cores": best["pin_cores"],
+        "cpu_count": cpu_count,
+        "workload": args.workload,
+        "torch_version": torch.__version__,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "benchmark": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(tuning, f, indent=2)
+
+    print(f"\n✅ Best: {best['workers']} workers x {best['intra_op_threads']} threads "
+          f"(interop {best['interop_threads']}, pin={best['pin_cores']}) -> {best['throughput_per_s']:.2f}/s")
+    print(f"   Written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
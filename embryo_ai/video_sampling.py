@@ -0,0 +1,241 @@
+"""
+Keyframe-Indexed Video Sampling
+
+Time-lapse videos can hold 10,000+ frames of which the staging model keeps ~50.
+Reading every frame with cap.read() up to the last sample throws almost all of
+that decode work away. This module:
+
+  1. Builds a keyframe / PTS index from the container WITHOUT decoding
+     (PyAV demuxing if installed, else ffprobe packet flags) and caches it per
+     video content hash (memory + disk).
+  2. For a set of target frames, estimates the decode cost of
+        sequential - grab() every frame up to the last target
+        seek       - jump to the keyframe before each target, grab() forward
+     from the GOP structure and picks the cheaper plan.
+  3. Only retrieves (colour-converts) the target frames.
+"""
+
+import bisect
+import json
+import os
+import subprocess
+import time
+from collections import OrderedDict
+
+import cv2
+
+import metrics
+from content_cache import cache_path, sha256_file
+from structured_log import get_logger, fields
+
+log = get_logger("decode")
+
+try:
+    import av
+    HAS_AV = True
+except ImportError:
+    HAS_AV = False
+
+# A seek costs roughly this many decoded frames (demuxer reset + decoder flush)
+SEEK_OVERHEAD_FRAMES = int(os.getenv("EMBRYO_SEEK_OVERHEAD_FRAMES", "8"))
+# Seek only when it decodes clearly fewer frames than sequential grabbing
+SEEK_ADVANTAGE = float(os.getenv("EMBRYO_SEEK_ADVANTAGE", "0.8"))
+# "auto", "seek" or "sequential"
+SAMPLING_MODE = os.getenv("EMBRYO_SAMPLING_MODE", "auto").lower()
+
+_INDEX_CACHE_SIZE = 256
+_index_cache = OrderedDict()
+
+
+def _index_with_pyav(path):
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        packets = [(p.pts, p.is_keyframe) for p in container.demux(stream) if p.pts is not None]
+    return packets
+
+
+def _index_with_ffprobe(path):
+    cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0",
+           "-show_entries", "packet=pts,flags", "-of", "csv=p=0", path]
+    out = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True).stdout
+    packets = []
+    for line in out.splitlines():
+        parts = line.strip().split(",")
+        if len(parts) < 2 or parts[0] in ("", "N/A"):
+            continue
+        packets.append((int(parts[0]), "K" in parts[1]))
+    return packets
+
+
+def build_keyframe_index(path):
+    """
+    Keyframe positions in presentation order, from packet metadata only.
+
+    Returns:
+        dict: {"frame_count", "keyframes": [frame indices], "source"} or None
+    """
+    packets, source = None, None
+    for name, fn in (("pyav", _index_with_pyav if HAS_AV else None), ("ffprobe", _index_with_ffprobe)):
+        if fn is None:
+            continue
+        try:
+            packets, source = fn(path), name
+            break
+        except Exception as e:
+            log.warning("keyframe index failed", extra=fields(indexer=name, error=str(e)))
+    if not packets:
+        return None
+
+    # Decode order != presentation order with B-frames: rank packets by PTS
+    packets.sort(key=lambda p: p[0])
+    keyframes = [i for i, (_, is_key) in enumerate(packets) if is_key]
+    if not keyframes or keyframes[0] != 0:
+        keyframes.insert(0, 0)
+    return {"frame_count": len(packets), "keyframes": keyframes, "source": source}
+
+
+def get_keyframe_index(path, content_hash=None):
+    """Keyframe index for a video, cached in memory and on disk by content hash."""
+    content_hash = content_hash or sha256_file(path)
+    if content_hash in _index_cache:
+        _index_cache.move_to_end(content_hash)
+        return _index_cache[content_hash]
+
+    disk_path = cache_path("keyframes", f"{content_hash}.json")
+    index = None
+    if os.path.exists(disk_path):
+        try:
+            with open(disk_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = None
+    if index is None:
+        start = time.perf_counter()
+        index = build_keyframe_index(path)
+        metrics.observe("video.keyframe_index.seconds", time.perf_counter() - start)
+        if index is not None:
+            tmp = disk_path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp, disk_path)
+
+    _index_cache[content_hash] = index
+    if len(_index_cache) > _INDEX_CACHE_SIZE:
+        _index_cache.popitem(last=False)
+    return index
+
+
+def plan_sampling(targets, keyframes):
+    """
+    Chooses between seek-and-decode and sequential grabbing.
+
+    Returns:
+        tuple: (mode, estimated frames decoded by seek, by sequential)
+    """
+    if not targets:
+        return "sequential", 0, 0
+    sequential_cost = targets[-1] + 1
+    if not keyframes:
+        return "sequential", sequential_cost, sequential_cost
+
+    seek_cost, pos = 0, 0
+    for t in targets:
+        kf = keyframes[bisect.bisect_right(keyframes, t) - 1]
+        if kf <= pos <= t:
+            seek_cost += t - pos + 1        # keep decoding forward, no seek needed
+        else:
+            seek_cost += t - kf + 1 + SEEK_OVERHEAD_FRAMES
+        pos = t + 1
+
+    if SAMPLING_MODE in ("seek", "sequential"):
+        return SAMPLING_MODE, seek_cost, sequential_cost
+    mode = "seek" if seek_cost < sequential_cost * SEEK_ADVANTAGE else "sequential"
+    return mode, seek_cost, sequential_cost
+
+
+class VideoFrameSource:
+    """
+    Random-access frame reader over a video file.
+
+    read(indices) yields (index, BGR frame) for the requested frames in
+    ascending order, using the cheapest decode plan for the GOP structure.
+    """
+
+    def __init__(self, path, content_hash=None):
+        self.path = path
+        self.cap = cv2.VideoCapture(path)
+        self.frame_count = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self._content_hash = content_hash
+        self._index = None
+        self._pos = 0  # index of the next frame grab() will return
+        self.last_plan = None
+
+    def keyframes(self):
+        if self._index is None:
+            self._index = get_keyframe_index(self.path, self._content_hash) or {}
+        return self._index.get("keyframes", [])
+
+    def _seek(self, frame_idx):
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+        actual = int(self.cap.get(cv2.CAP_PROP_POS_FRAMES))
+        self._pos = actual
+        return actual == frame_idx
+
+    def _reopen(self):
+        self.cap.release()
+        self.cap = cv2.VideoCapture(self.path)
+        self._pos = 0
+
+    def read(self, indices):
+        targets = sorted(set(int(i) for i in indices if 0 <= i < max(self.frame_count, 1)))
+        if not targets:
+            return
+
+        # Sequential from the start never needs the index
+        keyframes = self.keyframes() if targets[-1] > SEEK_OVERHEAD_FRAMES else []
+        mode, seek_cost, seq_cost = plan_sampling(targets, keyframes)
+        self.last_plan = {"mode": mode, "est_seek_frames": seek_cost, "est_sequential_frames": seq_cost,
+                          "keyframes": len(keyframes)}
+        metrics.incr(f"video.sampling.{mode}")
+
+        decoded = 0
+        start = time.perf_counter()
+        for t in targets:
+            if mode == "seek":
+                kf = keyframes[bisect.bisect_right(keyframes, t) - 1]
+                if not (kf <= self._pos <= t):
+                    if not self._seek(kf):
+                        # Container seeking is unreliable here; finish sequentially
+                        mode = "sequential"
+                        metrics.incr("video.sampling.seek_fallback")
+            if self._pos > t:
+                # Sequential readers can only move forward
+                self._reopen()
+            while self._pos < t:
+                if not self.cap.grab():
+                    break
+                self._pos += 1
+                decoded += 1
+            if self._pos != t or not self.cap.grab():
+                break
+            self._pos += 1
+            decoded += 1
+            ret, frame = self.cap.retrieve()
+            if not ret:
+                break
+            yield t, frame
+
+        metrics.observe("video.decode.frames_decoded", decoded)
+        metrics.observe("video.decode.seconds", time.perf_counter() - start)
+
+    def release(self):
+        self.cap.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
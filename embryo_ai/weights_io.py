@@ -0,0 +1,141 @@
+"""
+Fast Model Loading
+
+Startup used to build every module with randomly initialised parameters,
+torch.load the whole weights pickle into fresh memory, copy it again into a
+prefix-stripped OrderedDict and finally copy it into the parameters. This
+module instead:
+
+  1. constructs models on the meta device (no parameter memory, no init)
+  2. reads weights memory-mapped: a converted .safetensors file if present,
+     else torch.load(mmap=True) on zipfile-format checkpoints
+  3. strips DataParallel "module." prefixes by renaming keys only
+  4. load_state_dict(assign=True): parameters become the mapped tensors
+     themselves, so nothing is copied; pages are read on first use and are
+     shared through the page cache by preloaded/forked workers
+
+Legacy pickles can be converted once:
+
+    python weights_io.py convert modelres18LSTM_... gardner_net_best.pth
+
+If any step isn't supported (old torch, non-zipfile checkpoint, a module that
+keeps non-persistent buffers) loading falls back to the regular path.
+"""
+
+import os
+import sys
+import time
+
+import torch
+
+import metrics
+
+try:
+    from safetensors.torch import load_file as load_safetensors, save_file as save_safetensors
+    HAS_SAFETENSORS = True
+except ImportError:
+    HAS_SAFETENSORS = False
+
+FAST_LOAD = os.getenv("EMBRYO_FAST_LOAD", "on").lower() == "on"
+STRIP_PREFIX = "module."
+
+
+def converted_path(weights_path):
+    return weights_path + ".safetensors"
+
+
+def build_module(factory):
+    """
+    Module from `factory()` constructed on the meta device (parameters have no
+    storage until weights are assigned). Falls back to a normal CPU build.
+    """
+    # torch.device is a context manager from torch 2.0
+    if FAST_LOAD and hasattr(torch.device, "__enter__"):
+        try:
+            with torch.device("meta"):
+                return factory()
+        except Exception as e:
+            print(f"Weights: meta-device construction failed ({e}), building on CPU")
+    return factory()
+
+
+def _strip_prefix(state_dict):
+    if state_dict and all(k.startswith(STRIP_PREFIX) for k in state_dict):
+        return {k[len(STRIP_PREFIX):]: v for k, v in state_dict.items()}
+    return state_dict
+
+
+def read_state_dict(weights_path):
+    """(state dict, format) with tensors memory-mapped where the format allows."""
+    converted = converted_path(weights_path)
+    if (FAST_LOAD and HAS_SAFETENSORS and os.path.exists(converted)
+            and os.path.getmtime(converted) >= os.path.getmtime(weights_path)):
+        return load_safetensors(converted, device="cpu"), "safetensors"
+    if FAST_LOAD:
+        try:
+            return _strip_prefix(torch.load(weights_path, map_location="cpu", mmap=True, weights_only=True)), "mmap"
+        except Exception:
+            pass  # legacy (non-zipfile) pickle or older torch
+    return _strip_prefix(torch.load(weights_path, map_location="cpu")), "pickle"
+
+
+def _on_meta(module):
+    return [n for n, t in list(module.named_parameters()) + list(module.named_buffers()) if t.is_meta]
+
+
+def load_weights(module, weights_path, factory=None, name="model"):
+    """
+    Loads weights into `module` (as returned by build_module) and returns it in eval mode.
+
+    Meta modules get the mapped tensors assigned directly. If something is
+    left on the meta device, the module is rebuilt on CPU with `factory` and
+    loaded the regular way.
+    """
+    start = time.perf_counter()
+    state_dict, fmt = read_state_dict(weights_path)
+    is_meta = bool(_on_meta(module))
+    if is_meta:
+        try:
+            module.load_state_dict(state_dict, assign=True)
+        except TypeError:
+            pass  # torch without assign=
+        leftover = _on_meta(module)
+        if leftover:
+            if factory is None:
+                raise RuntimeError(f"{name}: tensors not in the checkpoint are left uninitialised: {leftover[:5]}")
+            print(f"Weights: {name} keeps tensors outside its checkpoint ({leftover[:3]}...), loading on CPU")
+            module = factory()
+            module.load_state_dict(state_dict)
+            is_meta = False
+    else:
+        module.load_state_dict(state_dict)
+    module.eval()
+    elapsed = time.perf_counter() - start
+    metrics.observe(f"weights.load_seconds.{name}", elapsed)
+    print(f"Weights: {name} loaded from {fmt} in {elapsed:.2f}s ({'zero-copy' if is_meta else 'copied'})")
+    return module
+
+
+def convert(weights_path):
+    """One-time conversion of a checkpoint to <path>.safetensors (prefix stripped, contiguous)."""
+    if not HAS_SAFETENSORS:
+        raise RuntimeError("safetensors is not installed (pip install safetensors)")
+    state_dict = _strip_prefix(torch.load(weights_path, map_location="cpu"))
+    tensors = {k: v.contiguous() for k, v in state_dict.items() if isinstance(v, torch.Tensor)}
+    skipped = sorted(set(state_dict) - set(tensors))
+    if skipped:
+        print(f"   ⚠️  Non-tensor entries dropped: {skipped[:5]}")
+    out = converted_path(weights_path)
+    save_safetensors(tensors, out + ".tmp")
+    os.replace(out + ".tmp", out)
+    return out
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] != "convert":
+        print("Usage: python weights_io.py convert <weights> [<weights> ...]")
+        sys.exit(1)
+    for path in sys.argv[2:]:
+        start = time.perf_counter()
+        out = convert(path)
+        print(f"✅ {path} -> {out} ({time.perf_counter() - start:.1f}s)")